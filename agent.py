@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+This module contain the client side of the remote helper agent.
+
+The agent (remote_agent.py) is sent to the Xen server python interpreter once
+per run, and all the file-system operations on the backup directory are sent
+to it in batches, so a whole VM metadata tree or all the retention probes of
+a VM, cost one round trip instead of one SSH command per file / line.
+"""
+# Built-in modules
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import threading
+
+# 3ed party modules
+
+# Local modules
+
+logger = logging.getLogger(__name__)
+
+AGENT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "remote_agent.py")
+
+# Python code that read the agent source (length prefixed) from STDIN and run it
+BOOTSTRAP = "import sys;n=int(sys.stdin.readline());exec(compile(sys.stdin.read(n),'remote_agent','exec'))"
+
+
+class AgentError(Exception):
+    pass
+
+
+class RemoteAgent:
+    def __init__(self, command, python="python3"):
+        """
+        Initialize the agent object, the agent is started on the first request.
+
+        Args:
+            command (list): the command prefix that run a command on the remote host,
+                            empty list for running the agent locally
+            python (str): the python interpreter on the remote host
+        """
+        self._command = command
+        self._python = python if command else sys.executable
+        self._proc = None
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def start(self):
+        """
+        Start the agent process and send it its source code
+
+        Raise:
+            AgentError : if the agent cannot be started
+        """
+        if self._command:
+            command = self._command + [f"{self._python} -u -c {shlex.quote(BOOTSTRAP)}"]
+        else:
+            command = [self._python, "-u", "-c", BOOTSTRAP]
+        logger.info(f"Starting the remote agent : {command}")
+        with open(AGENT_SOURCE, "r") as fh:
+            source = fh.read()
+        try:
+            self._proc = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+                bufsize=1,
+            )
+            self._proc.stdin.write(f"{len(source)}\n{source}")
+            self._proc.stdin.flush()
+        except Exception as ex:
+            self.close()
+            raise AgentError(f"Cannot start the remote agent: {ex}")
+        # verify that the agent is up and running
+        self._send([{"op": "stat", "path": "/"}])
+
+    def _send(self, requests):
+        try:
+            self._proc.stdin.write(json.dumps(requests) + "\n")
+            self._proc.stdin.flush()
+            line = self._proc.stdout.readline()
+        except Exception as ex:
+            line = ""
+            logger.error(f"Communication with the remote agent failed : {ex}")
+        if line == "":
+            self.close()
+            raise AgentError("The remote agent is not responding")
+        try:
+            return json.loads(line)
+        except ValueError as ex:
+            # the next replies cannot be trusted to match their requests either
+            self.close()
+            raise AgentError(f"Invalid reply from the remote agent : {ex}")
+
+    def request(self, requests):
+        """
+        Send batch of operations to the agent, and wait for all the results.
+        If the agent is not running (or died) it is (re)started once.
+
+        Args:
+            requests (list): list of operations (dict), see remote_agent.py
+
+        Return:
+            list : list of results (dict), in the same order of the requests
+
+        Raise:
+            AgentError : if the agent cannot be started or is not responding
+        """
+        with self._lock:
+            for attempt in range(2):
+                if self._proc is None:
+                    self.start()
+                try:
+                    self.requests += 1
+                    logger.info(f"Sending {len(requests)} operation(s) to the remote agent")
+                    results = self._send(requests)
+                    break
+                except AgentError:
+                    if attempt:
+                        raise
+        for req, res in zip(requests, results):
+            if not res["ok"]:
+                logger.error(f"Remote agent {req['op']} failed : {res['error']}")
+        return results
+
+    def close(self):
+        """
+        Stop the agent process
+        """
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+            self._proc.wait(timeout=10)
+        except Exception:
+            self._proc.kill()
+        self._proc = None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    agent = RemoteAgent([])
+    print(agent.request([{"op": "list", "path": "."}, {"op": "df", "path": "/"}]))
+    agent.close()
@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+"""
+This module contain the backends that run the snapshot / cleanup operations
+of the backup on the Xen server.
+
+    XeBackend      - run the 'xe' CLI commands on the Xen server (over SSH)
+    XenApiBackend  - call the XenAPI directly, with the logged-in session,
+                     one XML-RPC round trip per operation, no SSH and no
+                     process spawn.
+"""
+# Built-in modules
+import abc
+import logging
+
+# 3ed party modules
+
+# Local modules
+
+logger = logging.getLogger(__name__)
+
+
+class Backend(abc.ABC):
+    name = "base"
+
+    @abc.abstractmethod
+    def find_vm_by_name(self, name):
+        """
+        Args:
+            name (str): the VM (or VM snapshot) name-label
+
+        Return:
+            list : the UUIDs of all the VMs with this name-label
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def is_vm_running(self, name):
+        """
+        Args:
+            name (str): the VM name-label
+
+        Return:
+            bool : True if the VM is running, otherwise False
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vm_snapshot(self, vm_uuid, name):
+        """
+        Take a snapshot of a VM
+
+        Args:
+            vm_uuid (str): the VM UUID
+            name (str): the name-label of the new snapshot
+
+        Return:
+            str : the UUID of the snapshot, empty string on failure
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vm_set_exportable(self, snap_uuid):
+        """
+        Change the snapshot so it can be exported (not a template, no HA)
+
+        Args:
+            snap_uuid (str): the snapshot UUID
+
+        Return:
+            bool : True on success, otherwise False
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vm_uninstall(self, uuid):
+        """
+        Destroy VM (snapshot) and its disks
+
+        Args:
+            uuid (str): the VM (snapshot) UUID
+
+        Return:
+            bool : True on success, otherwise False
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_exists(self, uuid):
+        """
+        Args:
+            uuid (str): the VDI UUID
+
+        Return:
+            bool : True if the VDI exists, otherwise False
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def find_vdi_by_name(self, name):
+        """
+        Args:
+            name (str): the VDI name-label
+
+        Return:
+            list : the UUIDs of all the VDIs with this name-label
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_snapshot(self, uuid):
+        """
+        Take a snapshot of a VDI
+
+        Args:
+            uuid (str): the VDI UUID
+
+        Return:
+            str : the UUID of the snapshot, empty string on failure
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_set_name_label(self, uuid, name):
+        """
+        Args:
+            uuid (str): the VDI UUID
+            name (str): the new name-label
+
+        Return:
+            bool : True on success, otherwise False
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_destroy(self, uuid):
+        """
+        Args:
+            uuid (str): the VDI UUID
+
+        Return:
+            bool : True on success, otherwise False
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vm_disks(self, uuid):
+        """
+        Args:
+            uuid (str): the VM (or VM snapshot) UUID
+
+        Return:
+            dict : the disk device (xvda, xvdb ...) -> the VDI UUID
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vm_destroy(self, uuid):
+        """
+        Destroy VM (snapshot) record, and keep its disks
+
+        Args:
+            uuid (str): the VM (snapshot) UUID
+
+        Return:
+            bool : True on success, otherwise False
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_enable_cbt(self, uuid):
+        """
+        Enable the changed block tracking of a VDI (does nothing if already enabled)
+
+        Args:
+            uuid (str): the VDI UUID
+
+        Return:
+            bool : True on success, otherwise False
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_list_changed_blocks(self, from_uuid, to_uuid):
+        """
+        Args:
+            from_uuid (str): the UUID of the older VDI snapshot (can be metadata only snapshot)
+            to_uuid (str): the UUID of the newer VDI snapshot
+
+        Return:
+            str : the base64 encoded bitmap of the changed blocks (64 KiB each), empty string on failure
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_nbd_info(self, uuid):
+        """
+        Args:
+            uuid (str): the VDI UUID
+
+        Return:
+            list : the NBD servers that serve the VDI (address, port, exportname, cert, subject),
+                   empty list if the VDI is not served over NBD
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_data_destroy(self, uuid):
+        """
+        Destroy the data of a VDI snapshot, and keep its metadata (and CBT log)
+        as the base for the next changed blocks list
+
+        Args:
+            uuid (str): the VDI snapshot UUID
+
+        Return:
+            bool : True on success, otherwise False
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_sr(self, uuid):
+        """
+        Args:
+            uuid (str): the VDI UUID
+
+        Return:
+            str : the UUID of the SR the VDI is on, empty string if not found
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def vdi_virtual_size(self, uuid):
+        """
+        Args:
+            uuid (str): the VDI UUID
+
+        Return:
+            int : the virtual size of the VDI in bytes (the size of its raw export), 0 if not found
+        """
+        raise NotImplementedError
+
+
+class XeBackend(Backend):
+    name = "xe"
+
+    def __init__(self, cmd):
+        """
+        Args:
+            cmd (Command): the command object to run the xe commands with
+        """
+        self._cmd = cmd
+
+    def _uuids(self, command):
+        results = self._cmd.run_xe(command, out_format="string")
+        if "Error in command" in results:
+            return []
+        return [uuid for uuid in results.split(",") if uuid != ""]
+
+    def find_vm_by_name(self, name):
+        return self._uuids(f"vm-list name-label='{name}' params=uuid --minimal")
+
+    def is_vm_running(self, name):
+        return self._cmd.check_if_vm_is_running(name)
+
+    def vm_snapshot(self, vm_uuid, name):
+        command = f'vm-snapshot vm={vm_uuid} new-name-label="{name}"'
+        result = self._cmd.run_xe(command, out_format="last")
+        return "" if "Error in command" in result else result
+
+    def vm_set_exportable(self, snap_uuid):
+        command = f"template-param-set is-a-template=false ha-always-run=false uuid={snap_uuid}"
+        return self._cmd.run_xe(command, out_format="rc") == 0
+
+    def vm_uninstall(self, uuid):
+        return self._cmd.run_xe(f"vm-uninstall uuid={uuid} force=true", out_format="rc") == 0
+
+    def vdi_exists(self, uuid):
+        # vdi-list exit with 0 also when no VDI match, the VDI exists if its uuid is listed
+        return uuid in self._uuids(f"vdi-list uuid={uuid} params=uuid --minimal")
+
+    def find_vdi_by_name(self, name):
+        return self._uuids(f"vdi-list name-label='{name}' params=uuid --minimal")
+
+    def vdi_snapshot(self, uuid):
+        result = self._cmd.run_xe(f"vdi-snapshot uuid={uuid}", out_format="last")
+        return "" if "Error in command" in result else result
+
+    def vdi_set_name_label(self, uuid, name):
+        return self._cmd.run_xe(f'vdi-param-set uuid={uuid} name-label="{name}"', out_format="rc") == 0
+
+    def vdi_destroy(self, uuid):
+        return self._cmd.destroy_vdi_snapshot(uuid) == "success"
+
+    def vm_disks(self, uuid):
+        disks = dict()
+        results = self._cmd.run_xe(f"vbd-list vm-uuid={uuid} type=Disk params=device,vdi-uuid", out_format="list")
+        device = ""
+        for line in results:
+            if ":" not in line:
+                continue
+            key, value = [part.strip() for part in line.split(":", 1)]
+            if key.startswith("device"):
+                device = value
+            elif key.startswith("vdi-uuid") and value != "<not in database>":
+                disks[device] = value
+        return disks
+
+    def vm_destroy(self, uuid):
+        return self._cmd.run_xe(f"snapshot-destroy snapshot-uuid={uuid}", out_format="rc") == 0
+
+    def vdi_enable_cbt(self, uuid):
+        return self._cmd.run_xe(f"vdi-enable-cbt uuid={uuid}", out_format="rc") == 0
+
+    def vdi_list_changed_blocks(self, from_uuid, to_uuid):
+        command = f"vdi-list-changed-blocks vdi-from-uuid={from_uuid} vdi-to-uuid={to_uuid}"
+        result = self._cmd.run_xe(command, out_format="last")
+        return "" if "Error in command" in result else result
+
+    def vdi_nbd_info(self, uuid):
+        # xe has no command for the NBD connection details of a VDI
+        return []
+
+    def vdi_data_destroy(self, uuid):
+        return self._cmd.run_xe(f"vdi-data-destroy uuid={uuid}", out_format="rc") == 0
+
+    def vdi_sr(self, uuid):
+        result = self._cmd.run_xe(f"vdi-param-get uuid={uuid} param-name=sr-uuid", out_format="last")
+        return "" if "Error in command" in result else result
+
+    def vdi_virtual_size(self, uuid):
+        result = self._cmd.run_xe(f"vdi-param-get uuid={uuid} param-name=virtual-size", out_format="last")
+        return int(result) if result.isdigit() else 0
+
+
+class XenApiBackend(Backend):
+    name = "xenapi"
+
+    def __init__(self, xapi):
+        """
+        Args:
+            xapi (object): the XenAPI session proxy (session.xenapi)
+        """
+        self._xapi = xapi
+
+    def _call(self, description, func, *args):
+        """
+        Call XenAPI function, and log the failure
+
+        Return:
+            bool, object : True and the function result, or False and None on failure
+        """
+        logger.info(f"XenAPI: {description}")
+        try:
+            return True, func(*args)
+        except Exception as ex:
+            logger.error(f"XenAPI {description} failed : {ex}")
+            return False, None
+
+    def find_vm_by_name(self, name):
+        ok, uuids = self._call(
+            f"VM.get_by_name_label {name}",
+            lambda: [self._xapi.VM.get_uuid(ref) for ref in self._xapi.VM.get_by_name_label(name)],
+        )
+        return uuids if ok else []
+
+    def is_vm_running(self, name):
+        ok, running = self._call(
+            f"VM.get_by_name_label {name}",
+            lambda: any(
+                self._xapi.VM.get_power_state(ref) == "Running" for ref in self._xapi.VM.get_by_name_label(name)
+            ),
+        )
+        return bool(ok and running)
+
+    def vm_snapshot(self, vm_uuid, name):
+        ok, snap_uuid = self._call(
+            f"VM.snapshot {vm_uuid} {name}",
+            lambda: self._xapi.VM.get_uuid(self._xapi.VM.snapshot(self._xapi.VM.get_by_uuid(vm_uuid), name)),
+        )
+        return snap_uuid if ok else ""
+
+    def vm_set_exportable(self, snap_uuid):
+        def set_exportable():
+            ref = self._xapi.VM.get_by_uuid(snap_uuid)
+            self._xapi.VM.set_is_a_template(ref, False)
+            self._xapi.VM.set_ha_always_run(ref, False)
+
+        ok, _ = self._call(f"VM.set_is_a_template {snap_uuid} false", set_exportable)
+        return ok
+
+    def vm_uninstall(self, uuid):
+        def uninstall():
+            ref = self._xapi.VM.get_by_uuid(uuid)
+            # like 'xe vm-uninstall', destroy the disks that are used only by this VM
+            vdis = list()
+            for vbd in self._xapi.VM.get_VBDs(ref):
+                if self._xapi.VBD.get_type(vbd).lower() != "disk":
+                    continue
+                vdi = self._xapi.VBD.get_VDI(vbd)
+                users = [self._xapi.VBD.get_VM(other) for other in self._xapi.VDI.get_VBDs(vdi)]
+                if all(user == ref for user in users):
+                    vdis.append(vdi)
+            self._xapi.VM.destroy(ref)
+            for vdi in vdis:
+                self._xapi.VDI.destroy(vdi)
+
+        ok, _ = self._call(f"VM.destroy {uuid}", uninstall)
+        return ok
+
+    def vdi_exists(self, uuid):
+        ok, _ = self._call(f"VDI.get_by_uuid {uuid}", self._xapi.VDI.get_by_uuid, uuid)
+        return ok
+
+    def find_vdi_by_name(self, name):
+        ok, uuids = self._call(
+            f"VDI.get_by_name_label {name}",
+            lambda: [self._xapi.VDI.get_uuid(ref) for ref in self._xapi.VDI.get_by_name_label(name)],
+        )
+        return uuids if ok else []
+
+    def vdi_snapshot(self, uuid):
+        ok, snap_uuid = self._call(
+            f"VDI.snapshot {uuid}",
+            lambda: self._xapi.VDI.get_uuid(self._xapi.VDI.snapshot(self._xapi.VDI.get_by_uuid(uuid), {})),
+        )
+        return snap_uuid if ok else ""
+
+    def vdi_set_name_label(self, uuid, name):
+        ok, _ = self._call(
+            f"VDI.set_name_label {uuid} {name}",
+            lambda: self._xapi.VDI.set_name_label(self._xapi.VDI.get_by_uuid(uuid), name),
+        )
+        return ok
+
+    def vdi_destroy(self, uuid):
+        ok, _ = self._call(
+            f"VDI.destroy {uuid}",
+            lambda: self._xapi.VDI.destroy(self._xapi.VDI.get_by_uuid(uuid)),
+        )
+        return ok
+
+    def vm_disks(self, uuid):
+        def disks():
+            result = dict()
+            for vbd in self._xapi.VM.get_VBDs(self._xapi.VM.get_by_uuid(uuid)):
+                if self._xapi.VBD.get_type(vbd).lower() == "disk" and not self._xapi.VBD.get_empty(vbd):
+                    result[self._xapi.VBD.get_device(vbd)] = self._xapi.VDI.get_uuid(self._xapi.VBD.get_VDI(vbd))
+            return result
+
+        ok, result = self._call(f"VM.get_VBDs {uuid}", disks)
+        return result if ok else {}
+
+    def vm_destroy(self, uuid):
+        ok, _ = self._call(f"VM.destroy {uuid}", lambda: self._xapi.VM.destroy(self._xapi.VM.get_by_uuid(uuid)))
+        return ok
+
+    def vdi_enable_cbt(self, uuid):
+        ok, _ = self._call(
+            f"VDI.enable_cbt {uuid}", lambda: self._xapi.VDI.enable_cbt(self._xapi.VDI.get_by_uuid(uuid))
+        )
+        return ok
+
+    def vdi_list_changed_blocks(self, from_uuid, to_uuid):
+        ok, bitmap = self._call(
+            f"VDI.list_changed_blocks {from_uuid} {to_uuid}",
+            lambda: self._xapi.VDI.list_changed_blocks(
+                self._xapi.VDI.get_by_uuid(from_uuid), self._xapi.VDI.get_by_uuid(to_uuid)
+            ),
+        )
+        return bitmap if ok else ""
+
+    def vdi_nbd_info(self, uuid):
+        ok, servers = self._call(
+            f"VDI.get_nbd_info {uuid}", lambda: self._xapi.VDI.get_nbd_info(self._xapi.VDI.get_by_uuid(uuid))
+        )
+        return servers if ok else []
+
+    def vdi_data_destroy(self, uuid):
+        ok, _ = self._call(
+            f"VDI.data_destroy {uuid}", lambda: self._xapi.VDI.data_destroy(self._xapi.VDI.get_by_uuid(uuid))
+        )
+        return ok
+
+    def vdi_sr(self, uuid):
+        ok, sr_uuid = self._call(
+            f"VDI.get_SR {uuid}",
+            lambda: self._xapi.SR.get_uuid(self._xapi.VDI.get_SR(self._xapi.VDI.get_by_uuid(uuid))),
+        )
+        return sr_uuid if ok else ""
+
+    def vdi_virtual_size(self, uuid):
+        ok, size = self._call(
+            f"VDI.get_virtual_size {uuid}",
+            lambda: self._xapi.VDI.get_virtual_size(self._xapi.VDI.get_by_uuid(uuid)),
+        )
+        return int(size) if ok else 0
+
+
+def get_backend(name, cmd, xapi):
+    """
+    Create backend object by its name
+
+    Args:
+        name (str): the backend name : xenapi / xe
+        cmd (Command): the command object, for the xe backend
+        xapi (object): the XenAPI session proxy, for the xenapi backend
+
+    Return:
+        Backend : the backend object
+    """
+    if name == XeBackend.name:
+        return XeBackend(cmd)
+    return XenApiBackend(xapi)
+
+
+if __name__ == "__main__":
+    print([cls.name for cls in Backend.__subclasses__()])
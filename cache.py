@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+This module contain a TTL cache (memoization) for read-only queries.
+
+The same read-only facts (xe list commands, XenAPI getters, backup directory
+listing) are fetched many times during a run. The cache keeps each result for
+a time-to-live, and the results are grouped by tags (usually the object class,
+or the directory path), so a mutating command invalidates all the results
+that it can change.
+"""
+# Built-in modules
+import copy
+import logging
+import threading
+import time
+
+# 3ed party modules
+
+# Local modules
+
+logger = logging.getLogger(__name__)
+
+# XenAPI classes that are changed by the mutating calls of another class
+# e.g. VM.snapshot create new VBDs and VDIs
+RELATED_CLASSES = {
+    "vm": ["vm", "vbd", "vdi"],
+    "template": ["vm", "vbd", "vdi"],
+    "snapshot": ["vm", "vbd", "vdi"],
+    "vdi": ["vdi", "vbd"],
+    "vbd": ["vbd", "vdi"],
+}
+
+
+class TTLCache:
+    def __init__(self, default_ttl=30, clock=time.monotonic):
+        """
+        Initialize the cache object
+
+        Args:
+            default_ttl (int): the default time-to-live (in seconds) of an entry
+            clock (function): the time source (for testing)
+        """
+        self._default_ttl = default_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (expire time, value)
+        self._tags = {}  # tag -> set of keys
+        self._counters = {}  # name -> {"hits": int, "misses": int, "invalidations": int}
+
+    def _count(self, name, counter):
+        counters = self._counters.setdefault(name, {"hits": 0, "misses": 0, "invalidations": 0})
+        counters[counter] += 1
+
+    def get(self, key, name="default"):
+        """
+        Get an entry from the cache
+
+        Args:
+            key (hashable): the entry key
+            name (str): the counters group name of the entry
+
+        Return:
+            bool, object : True and the value if the entry is cached and not expired, otherwise False, None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self._count(name, "hits")
+                return True, entry[1]
+            self._count(name, "misses")
+            return False, None
+
+    def set(self, key, value, ttl=None, tags=()):
+        """
+        Put an entry in the cache
+
+        Args:
+            key (hashable): the entry key
+            value (object): the entry value
+            ttl (int): the entry time-to-live in seconds, default is the cache default TTL
+            tags (list): tags to invalidate the entry by
+        """
+        ttl = self._default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl, value)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+    def invalidate(self, *tags, name="default"):
+        """
+        Remove from the cache all the entries with any of the tags
+
+        Args:
+            tags (str): the tags of the entries to remove
+            name (str): the counters group name
+        """
+        with self._lock:
+            for tag in tags:
+                keys = self._tags.pop(tag, set())
+                for key in keys:
+                    if self._entries.pop(key, None) is not None:
+                        self._count(name, "invalidations")
+
+    def invalidate_prefix(self, prefix, name="default"):
+        """
+        Remove from the cache all the entries with tags that start with the prefix
+
+        Args:
+            prefix (str): the tags prefix
+            name (str): the counters group name
+        """
+        with self._lock:
+            tags = [tag for tag in self._tags if tag.startswith(prefix)]
+        self.invalidate(*tags, name=name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        """
+        Return:
+            dict : copy of the hit / miss / invalidation counters, per counters group name
+        """
+        with self._lock:
+            return {name: dict(counters) for name, counters in self._counters.items()}
+
+    def report(self):
+        """
+        Log the counters of all the counters groups
+        """
+        for name, counters in self.stats().items():
+            logger.info(
+                f"Cache {name}: {counters['hits']} hit(s) (round trips saved), {counters['misses']} miss(es), "
+                f"{counters['invalidations']} invalidation(s)"
+            )
+
+
+class _CachedMethod:
+    def __init__(self, proxy, class_name, method):
+        self._proxy = proxy
+        self._class_name = class_name
+        self._method = method
+
+    def __call__(self, *args):
+        proxy = self._proxy
+        call = getattr(getattr(proxy._xenapi, self._class_name), self._method)
+        tag = self._class_name.lower()
+        if not self._method.startswith("get_"):
+            # mutating call - invalidate the cached results of the object class (and related classes)
+            result = call(*args)
+            proxy._cache.invalidate(*RELATED_CLASSES.get(tag, [tag]), name="xenapi")
+            return result
+
+        key = ("xenapi", self._class_name, self._method, repr(args))
+        # the records (dict / list) are copied in and out, so the callers cannot change the cached values
+        found, value = proxy._cache.get(key, name="xenapi")
+        if found:
+            return copy.deepcopy(value)
+        value = call(*args)
+        ttl = proxy._ttls.get(self._method)
+        proxy._cache.set(key, copy.deepcopy(value), ttl=ttl, tags=[tag])
+        return value
+
+
+class _CachedClass:
+    def __init__(self, proxy, class_name):
+        self._proxy = proxy
+        self._class_name = class_name
+
+    def __getattr__(self, method):
+        return _CachedMethod(self._proxy, self._class_name, method)
+
+
+class CachedXenAPI:
+    def __init__(self, xenapi, cache, ttls=None):
+        """
+        Wrap the XenAPI session proxy (session.xenapi), the read-only calls
+        (get_*) are cached, and all the other calls invalidate the cached
+        results of the same class.
+
+        Args:
+            xenapi (object): the session XenAPI proxy (session.xenapi)
+            cache (TTLCache): the cache to use
+            ttls (dict): method name -> TTL for methods with non default TTL
+        """
+        self._xenapi = xenapi
+        self._cache = cache
+        self._ttls = ttls or {}
+
+    def __getattr__(self, class_name):
+        return _CachedClass(self, class_name)
+
+
+if __name__ == "__main__":
+    c = TTLCache(default_ttl=1)
+    c.set("a", 1, tags=["vm"])
+    print(c.get("a"))
+    c.invalidate("vm")
+    print(c.get("a"))
+    print(c.stats())
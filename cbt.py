@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+This module contain the changed block tracking (CBT) incremental backup helpers.
+
+With CBT enabled on a VDI, XAPI log the changed blocks (64 KiB each), and
+VDI.list_changed_blocks return the bitmap of the blocks that changed between
+two snapshots of the VDI. The data of the older snapshot can be destroyed
+(VDI.data_destroy), and its metadata (with the CBT log) is kept as the base
+for the next backup, so no full snapshot is kept between the backups.
+
+Each backup directory has a state file (cbt.json) :
+
+    {
+        "base": "backup-20240101-010000",   # the backup this one depends on, null for full backup
+        "depth": 1,                         # number of delta backups since the full backup
+        "disks": {
+            "xvda": {
+                "vdi": "<VDI uuid>",
+                "snapshot": "<the metadata only snapshot uuid (the next backup base)>",
+                "file": "<vm>-xvda.raw / <vm>-xvda.delta",
+                "bitmap": "<vm>-xvda.bitmap (delta only)",
+                "changed_blocks": 123,
+                "size": <the disk size in bytes>,
+            }
+        }
+    }
+
+The delta file contain only the changed blocks, in their order in the disk,
+and the bitmap file contain the raw bitmap (bit per block, the most
+significant bit of the first byte is the first block). When the disk grew
+since the base backup, all the blocks after the end of the bitmap are in
+the delta file too.
+"""
+# Built-in modules
+import base64
+import itertools
+import json
+import logging
+import os
+
+# 3ed party modules
+
+# Local modules
+from exporter import Stage, load_extents
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024
+STATE_FILE = "cbt.json"
+
+
+def decode_bitmap(bitmap):
+    """
+    Args:
+        bitmap (str): the base64 encoded bitmap (as VDI.list_changed_blocks return)
+
+    Return:
+        bytes : the raw bitmap
+    """
+    return base64.b64decode(bitmap)
+
+
+def count_changed(bitmap):
+    """
+    Args:
+        bitmap (bytes): the raw bitmap
+
+    Return:
+        int : the number of changed blocks
+    """
+    return sum(bin(byte).count("1") for byte in bitmap)
+
+
+def is_changed(bitmap, block):
+    """
+    Args:
+        bitmap (bytes): the raw bitmap
+        block (int): the block number
+
+    Return:
+        bool : True if the block is changed (or after the end of the bitmap - the disk grew)
+    """
+    index = block >> 3
+    if index >= len(bitmap):
+        return True
+    return bool(bitmap[index] & (0x80 >> (block & 7)))
+
+
+def changed_runs(bitmap, size, block_size=BLOCK_SIZE):
+    """
+    Args:
+        bitmap (bytes): the raw bitmap
+        size (int): the disk size in bytes, the blocks after the end of the bitmap are changed (the disk grew)
+        block_size (int): the size of the blocks in the bitmap
+
+    Return:
+        generator : the (offset, length) runs of the consecutive changed blocks, in the order of the disk
+    """
+    start = None
+    blocks = (size + block_size - 1) // block_size
+    for block in range(blocks + 1):
+        if block < blocks and is_changed(bitmap, block):
+            if start is None:
+                start = block
+        elif start is not None:
+            yield start * block_size, min(block * block_size, size) - start * block_size
+            start = None
+
+
+class DeltaStage(Stage):
+    def __init__(self, bitmap, block_size=BLOCK_SIZE):
+        """
+        Pass only the changed blocks of the raw disk stream to the next stage
+
+        Args:
+            bitmap (bytes): the raw bitmap of the changed blocks
+            block_size (int): the size of the blocks in the bitmap
+        """
+        super().__init__()
+        self._bitmap = bitmap
+        self._block_size = block_size
+        self.changed_blocks = 0
+
+    def write(self, data):
+        while len(data):
+            block = self.bytes_in // self._block_size
+            size = min(len(data), self._block_size - self.bytes_in % self._block_size)
+            if is_changed(self._bitmap, block):
+                self.next.write(data[:size])
+                if self.bytes_in % self._block_size == 0:
+                    self.changed_blocks += 1
+            self.bytes_in += size
+            data = data[size:]
+
+
+def new_state(base=None, depth=0):
+    """
+    Return:
+        dict : empty backup state, see the module documentation
+    """
+    return {"base": base, "depth": depth, "disks": {}}
+
+
+def parse_state(data):
+    """
+    Args:
+        data (str): the content of the state file, None if it cannot be read
+
+    Return:
+        dict : the backup state, None for a backup without state (not incremental)
+    """
+    if data is None:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError as ex:
+        logger.warning(f"Invalid CBT state : {ex}")
+        return None
+
+
+def dump_state(state):
+    return json.dumps(state, indent=2, sort_keys=True)
+
+
+def chain_dependencies(states, keep):
+    """
+    Find all the backups that the kept backups depend on (their bases, and
+    the bases of the bases)
+
+    Args:
+        states (dict): backup directory name -> its state (None for backup without state)
+        keep (list): the backup directories names to keep
+
+    Return:
+        set : the names of the backup directories that must be kept
+    """
+    needed = set()
+    for name in keep:
+        while name is not None and name not in needed:
+            needed.add(name)
+            state = states.get(name)
+            name = state.get("base") if state else None
+    return needed
+
+
+def restore_chain(files, target, block_size=BLOCK_SIZE):
+    """
+    Rebuild a raw disk image from the full backup and the deltas that follow it
+
+    Args:
+        files (list): the raw file of the full backup, followed by (delta file, bitmap file[, disk size])
+                      tuples, oldest first
+        target (str): the path of the raw image to create
+    """
+    # a sparse full image has an extent map, only its data extents are copied (the target is sparse too)
+    extents = load_extents(files[0])
+    with open(files[0], "rb") as src, open(target, "wb") as dst:
+        if extents is None:
+            extents = [[0, os.fstat(src.fileno()).st_size]]
+        for offset, length in extents:
+            src.seek(offset)
+            dst.seek(offset)
+            while length > 0:
+                data = src.read(min(length, 1024 * 1024))
+                if not data:
+                    break
+                dst.write(data)
+                length -= len(data)
+        dst.truncate(os.fstat(src.fileno()).st_size)
+    with open(target, "r+b") as dst:
+        for delta_file, bitmap_file, *size in files[1:]:
+            with open(bitmap_file, "rb") as fh:
+                bitmap = fh.read()
+            with open(delta_file, "rb") as delta:
+                # the blocks after the end of the bitmap (the disk grew) are in the delta too
+                for block in itertools.count():
+                    if not is_changed(bitmap, block):
+                        continue
+                    data = delta.read(block_size)
+                    if not data:
+                        break
+                    dst.seek(block * block_size)
+                    dst.write(data)
+            if size:
+                dst.truncate(size[0])
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from exporter import FileWriter
+
+    logging.basicConfig(level=logging.INFO)
+    base_image = os.urandom(BLOCK_SIZE * 16)
+    new_image = bytearray(base_image)
+    new_image[BLOCK_SIZE * 2 + 5] ^= 0xFF
+    new_image[BLOCK_SIZE * 9] ^= 0xFF
+    bitmap = bytes([0b00100000, 0b01000000])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        full, delta, bits, out = [os.path.join(tmp_dir, name) for name in ["full", "delta", "bitmap", "out"]]
+        with open(full, "wb") as fh:
+            fh.write(base_image)
+        with open(bits, "wb") as fh:
+            fh.write(bitmap)
+        stage = DeltaStage(bitmap)
+        stage.next = FileWriter(delta)
+        stage.write(memoryview(bytes(new_image)))
+        stage.close()
+        print(stage.changed_blocks, os.path.getsize(delta) == 2 * BLOCK_SIZE)
+        restore_chain([full, (delta, bits)], out)
+        with open(out, "rb") as fh:
+            print(fh.read() == new_image)
+        # the disk grew by 2.5 blocks since the base
+        grown_image = bytes(new_image) + os.urandom(BLOCK_SIZE * 5 // 2)
+        stage = DeltaStage(bitmap)
+        stage.next = FileWriter(delta)
+        stage.write(memoryview(grown_image))
+        stage.close()
+        restore_chain([full, (delta, bits, len(grown_image))], out)
+        with open(out, "rb") as fh:
+            print(stage.changed_blocks, fh.read() == grown_image)
+    print(chain_dependencies({"b3": {"base": "b2"}, "b2": {"base": "b1"}, "b1": {"base": None}, "b0": None}, ["b3"]))
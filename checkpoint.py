@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+This module contain the checkpoints of the resumable exports.
+
+While a raw VDI is exported, the written data is flushed to the disk every
+checkpoint interval, and the checkpoint file (<backup file>.checkpoint) is
+replaced atomically with the offset that was written, the hashes of the
+blocks before it, and the snapshot that is exported :
+
+    {
+        "snapshot": "<VDI snapshot uuid>",
+        "started": <the time of the first checkpoint of the backup (epoch)>,
+        "time": <the time of this checkpoint (epoch)>,
+        "offset": <bytes>,
+        "algorithm": "sha256",
+        "block_size": 4194304,
+        "blocks": ["<block hash>", ...],
+        "extents": [[<offset>, <length>], ...]    # sparse image only
+    }
+
+When the export fails, the partial file (<backup file>.part), the checkpoint
+and the snapshot are kept. The next run (within the resume window) reuse the
+backup directory and the snapshot, re-hash the partial file blocks and
+continue the export from the last verified block.
+"""
+# Built-in modules
+import json
+import logging
+import os
+import time
+
+# 3ed party modules
+
+# Local modules
+from exporter import Stage
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+DEFAULT_INTERVAL = 1024 * 1024 * 1024
+
+
+def load(path):
+    """
+    Args:
+        path (str): the backup file path
+
+    Return:
+        dict : the checkpoint of the backup file, None if there is no (valid) checkpoint
+    """
+    try:
+        with open(f"{path}{CHECKPOINT_SUFFIX}", "r") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as ex:
+        logger.warning(f"Invalid checkpoint of {path} : {ex}")
+        return None
+
+
+def save(path, state):
+    """
+    Replace the checkpoint of the backup file atomically
+
+    Args:
+        path (str): the backup file path
+        state (dict): the checkpoint, see the module documentation
+    """
+    tmp_path = f"{path}{CHECKPOINT_SUFFIX}.tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(state, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, f"{path}{CHECKPOINT_SUFFIX}")
+
+
+def remove(path):
+    if os.path.exists(f"{path}{CHECKPOINT_SUFFIX}"):
+        os.remove(f"{path}{CHECKPOINT_SUFFIX}")
+
+
+class CheckpointStage(Stage):
+    def __init__(self, snapshot, hasher, writer, interval=DEFAULT_INTERVAL, started=None):
+        """
+        Write the checkpoints of the export (the stage before the hasher)
+
+        Args:
+            snapshot (str): the UUID of the exported VDI snapshot
+            hasher (IntegrityStage): the stage that hash the blocks
+            writer (FileWriter): the last stage, that write the file
+            interval (int): the number of bytes between the checkpoints
+            started (float): the time of the first checkpoint (resumed export), None for a new export
+        """
+        super().__init__()
+        self._snapshot = snapshot
+        self._hasher = hasher
+        self._writer = writer
+        self._interval = interval
+        self._started = started or time.time()
+        self._last = writer.bytes_in
+
+    def save(self):
+        """
+        Flush the written data, and write the checkpoint of the blocks that were hashed
+
+        Return:
+            int : the checkpoint offset
+        """
+        offset = self._hasher.drain()
+        self._writer.sync()
+        state = {
+            "snapshot": self._snapshot,
+            "started": self._started,
+            "time": time.time(),
+            "offset": offset,
+            "algorithm": self._hasher.algorithm,
+            "block_size": self._hasher.block_size,
+            "blocks": self._hasher.blocks,
+        }
+        if hasattr(self._writer, "extents"):
+            state["extents"] = self._writer.extents
+        save(self._writer.path, state)
+        self._last = self._writer.bytes_in
+        return offset
+
+    def write(self, data):
+        super().write(data)
+        if self._writer.bytes_in - self._last >= self._interval:
+            self.save()
+
+    def close(self):
+        super().close()
+        remove(self._writer.path)
+
+    def abort(self):
+        try:
+            offset = self.save()
+            logger.info(f"Export of {self._writer.path} failed, checkpoint at {offset} bytes")
+        except (OSError, ValueError) as ex:
+            logger.warning(f"Failed to write the checkpoint of {self._writer.path} : {ex}")
+        super().abort()
+
+
+if __name__ == "__main__":
+    import hashlib
+    import tempfile
+
+    from exporter import FileWriter
+    from integrity import IntegrityStage
+
+    logging.basicConfig(level=logging.INFO)
+    image = os.urandom(1024 * 1024) * 10
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "disk.raw")
+        # the first export fail after 7 MB
+        hasher = IntegrityStage(block_size=1024 * 1024)
+        writer = FileWriter(path, keep_partial=True)
+        stage = CheckpointStage("snap-uuid", hasher, writer, interval=2 * 1024 * 1024)
+        stage.next, hasher.next = hasher, writer
+        stage.write(memoryview(image[: 7 * 1024 * 1024 + 100]))
+        stage.abort()
+        # resume from the checkpoint
+        state = load(path)
+        hasher = IntegrityStage(block_size=state["block_size"])
+        offset = hasher.resume(f"{path}.part", state["blocks"])
+        writer = FileWriter(path, offset=offset, keep_partial=True)
+        stage = CheckpointStage(state["snapshot"], hasher, writer, started=state["started"])
+        stage.next, hasher.next = hasher, writer
+        stage.write(memoryview(image[offset:]))
+        stage.close()
+        print(offset, hasher.hexdigest() == hashlib.sha256(image).hexdigest(), load(path))
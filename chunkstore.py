@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+"""
+This module contain the deduplicated chunk store of the backup data.
+
+The export stream is cut into content-defined chunks, each unique chunk is
+stored once (named by its sha256), and each backup file is replaced by a
+manifest - the list of its chunks. Consecutive backups of a VM, and VMs that
+were cloned from the same template, share most of their chunks.
+
+The chunk boundaries are content-defined at sector (512 bytes) granularity :
+a chunk ends after a sector whose crc32 match the boundary mask, so a change
+in one place of the disk does not move the boundaries in the rest of it
+(the disk images and the XVA streams are sector aligned).
+
+Store layout (under the store root) :
+
+    chunks/ab/abcdef...    - the chunks, by their sha256
+    index.db               - sqlite3 table of the chunks size and reference count
+    store.lock             - the writers (from the first chunk to the manifest) hold a shared
+                             lock on it, the garbage collection an exclusive lock
+
+Each backup file <name> is replaced by <name>.manifest (JSON) :
+
+    {"file": "<name>", "size": <bytes>, "sha256": "<file sha256>", "chunks": [["<sha256>", <size>], ...]}
+
+The reference count of a chunk is the number of its occurrences in all the
+manifests. Removing a backup decrement the counts (release), and the garbage
+collection delete the chunks that are not referenced anymore.
+
+Usage :
+
+    python chunkstore.py restore <store> <manifest> <target file / - for STDOUT>
+    python chunkstore.py gc <store>
+    python chunkstore.py stats <store>
+"""
+# Built-in modules
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import uuid
+import zlib
+
+# 3ed party modules
+
+# Local modules
+from exporter import Stage
+
+logger = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+MANIFEST_SUFFIX = ".manifest"
+LOCK_FILE = "store.lock"
+
+
+class ChunkError(Exception):
+    pass
+
+
+def find_boundary(chunk, scanned=0, avg_size=AVG_CHUNK_SIZE):
+    """
+    Find the content-defined end of a chunk
+
+    Args:
+        chunk (bytearray): the data of the current chunk (start at a boundary, so it is sector aligned)
+        scanned (int): the size (sector aligned) of the chunk start that was already scanned
+        avg_size (int): the average chunk size (power of 2)
+
+    Return:
+        int, int : the chunk size if a boundary was found (otherwise None), and the scanned size
+    """
+    mask = avg_size // SECTOR_SIZE - 1
+    with memoryview(chunk) as view:
+        while scanned + SECTOR_SIZE <= len(chunk):
+            sector = view[scanned : scanned + SECTOR_SIZE]
+            scanned += SECTOR_SIZE
+            if scanned < MIN_CHUNK_SIZE:
+                continue
+            if scanned >= MAX_CHUNK_SIZE or zlib.crc32(sector) & mask == mask:
+                return scanned, scanned
+    return None, scanned
+
+
+class ChunkStore:
+    def __init__(self, root):
+        """
+        Open (or create) the chunk store
+
+        Args:
+            root (str): the store directory
+        """
+        self.root = root
+        os.makedirs(os.path.join(root, "chunks"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "index.db"), check_same_thread=False, timeout=60)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER, refs INTEGER NOT NULL)"
+            )
+
+    def lock(self, exclusive=False, wait=True):
+        """
+        Lock the store, the writers hold a shared lock until their manifest is committed (their chunks
+        are not referenced yet), the garbage collection hold an exclusive lock
+
+        Args:
+            exclusive (bool): exclusive lock (garbage collection), otherwise shared lock (writer)
+            wait (bool): wait for the lock, otherwise return None if the store is locked
+
+        Return:
+            int : the lock file descriptor (close it to unlock), None if the store is locked
+        """
+        fd = os.open(os.path.join(self.root, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def chunk_path(self, digest):
+        return os.path.join(self.root, "chunks", digest[:2], digest)
+
+    def put(self, data):
+        """
+        Store a chunk, if it is not already stored
+
+        Args:
+            data (bytes): the chunk data
+
+        Return:
+            str, bool : the chunk sha256, and True if the chunk is new
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+        return digest, True
+
+    def get(self, digest):
+        """
+        Args:
+            digest (str): the chunk sha256
+
+        Return:
+            bytes : the chunk data
+
+        Raises:
+            ChunkError : if the chunk is missing or corrupted
+        """
+        try:
+            with open(self.chunk_path(digest), "rb") as fh:
+                data = fh.read()
+        except OSError as ex:
+            raise ChunkError(f"Missing chunk {digest} : {ex}")
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ChunkError(f"Corrupted chunk {digest}")
+        return data
+
+    def _change_refs(self, chunks, delta):
+        with self._lock, self._db:
+            for digest, size in chunks:
+                self._db.execute(
+                    "INSERT INTO chunks (hash, size, refs) VALUES (?, ?, ?) "
+                    "ON CONFLICT(hash) DO UPDATE SET refs = refs + ?",
+                    (digest, size, max(delta, 0), delta),
+                )
+
+    def commit(self, manifest, path):
+        """
+        Write the manifest of a backup file, and reference its chunks
+
+        Args:
+            manifest (dict): the manifest, see the module documentation
+            path (str): the manifest file path
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(manifest, fh)
+        self._change_refs(manifest["chunks"], 1)
+        os.replace(tmp_path, path)
+
+    def release(self, path):
+        """
+        Release the chunks of a manifest (before the backup is deleted)
+
+        Args:
+            path (str): the manifest file path
+        """
+        with open(path, "r") as fh:
+            manifest = json.load(fh)
+        self._change_refs(manifest["chunks"], -1)
+        os.remove(path)
+
+    def release_dir(self, path):
+        """
+        Release all the manifests in a backup directory
+
+        Args:
+            path (str): the backup directory
+
+        Return:
+            int : the number of the released manifests
+        """
+        count = 0
+        if not os.path.isdir(path):
+            return count
+        for name in sorted(os.listdir(path)):
+            if name.endswith(MANIFEST_SUFFIX):
+                self.release(os.path.join(path, name))
+                count += 1
+        return count
+
+    def gc(self, wait=False):
+        """
+        Delete the chunks that are not referenced by any manifest (and chunks
+        that were stored by backups that failed before their manifest was written).
+        Runs only when no backup is writing to the store (exclusive store lock).
+
+        Args:
+            wait (bool): wait for the writers to end, otherwise skip the garbage collection if the store is in use
+
+        Return:
+            int, int : the number of deleted chunks, and their total size in bytes
+        """
+        fd = self.lock(exclusive=True, wait=wait)
+        if fd is None:
+            logger.info("Chunk store GC skipped, the store is in use by other backups")
+            return 0, 0
+        try:
+            return self._gc()
+        finally:
+            os.close(fd)
+
+    def _gc(self):
+        with self._lock, self._db:
+            referenced = {row[0] for row in self._db.execute("SELECT hash FROM chunks WHERE refs > 0")}
+            self._db.execute("DELETE FROM chunks WHERE refs <= 0")
+        count = freed = 0
+        chunks_dir = os.path.join(self.root, "chunks")
+        for prefix in os.listdir(chunks_dir):
+            for name in os.listdir(os.path.join(chunks_dir, prefix)):
+                if name in referenced:
+                    continue
+                path = os.path.join(chunks_dir, prefix, name)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                count += 1
+        logger.info(f"Chunk store GC : {count} chunk(s) deleted, {freed / (1024 ** 3):.2f} GB freed")
+        return count, freed
+
+    def stats(self):
+        """
+        Return:
+            dict : the number of the unique chunks, their total size, and the total referenced size (bytes)
+        """
+        with self._lock:
+            row = self._db.execute("SELECT COUNT(*), SUM(size), SUM(size * refs) FROM chunks WHERE refs > 0").fetchone()
+        return {"chunks": row[0], "stored": row[1] or 0, "referenced": row[2] or 0}
+
+    def restore(self, path):
+        """
+        Re-assemble a backup file from its manifest (generator)
+
+        Args:
+            path (str): the manifest file path
+
+        Return:
+            bytes : the file data, chunk by chunk
+        """
+        with open(path, "r") as fh:
+            manifest = json.load(fh)
+        file_hash = hashlib.sha256()
+        for digest, _ in manifest["chunks"]:
+            data = self.get(digest)
+            file_hash.update(data)
+            yield data
+        if file_hash.hexdigest() != manifest["sha256"]:
+            raise ChunkError(f"The restored file {manifest['file']} checksum does not match")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ChunkStage(Stage):
+    def __init__(self, store, path):
+        """
+        Store the data in the chunk store, and write its manifest (the last stage of the chain)
+
+        Args:
+            store (ChunkStore): the chunk store
+            path (str): the backup file path, the manifest is written to <path>.manifest
+        """
+        super().__init__()
+        self.path = f"{path}{MANIFEST_SUFFIX}"
+        self.new_bytes = 0
+        self._store = store
+        self._name = os.path.basename(path)
+        self._chunk = bytearray()
+        self._scanned = 0
+        self._chunks = list()
+        self._hash = hashlib.sha256()
+        # the stored chunks are not referenced until the manifest is committed, keep the GC out
+        self._lock_fd = store.lock()
+
+    def _unlock(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _put(self, data):
+        digest, new = self._store.put(data)
+        self._chunks.append([digest, len(data)])
+        if new:
+            self.new_bytes += len(data)
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._hash.update(data)
+        self._chunk += data
+        while True:
+            size, self._scanned = find_boundary(self._chunk, self._scanned)
+            if size is None:
+                break
+            self._put(bytes(self._chunk[:size]))
+            del self._chunk[:size]
+            self._scanned = 0
+
+    def close(self):
+        if self._chunk:
+            self._put(bytes(self._chunk))
+            self._chunk.clear()
+        manifest = {"file": self._name, "size": self.bytes_in, "sha256": self._hash.hexdigest(), "chunks": self._chunks}
+        try:
+            self._store.commit(manifest, self.path)
+        finally:
+            self._unlock()
+        logger.info(
+            f"Stored {self._name} : {len(self._chunks)} chunk(s), {self.bytes_in} bytes, {self.new_bytes} new bytes"
+        )
+
+    def abort(self):
+        # the chunks that were stored are removed by the next garbage collection
+        self._chunks.clear()
+        self._unlock()
+
+
+def store_file(store, path, buffer_size=AVG_CHUNK_SIZE * 4):
+    """
+    Move a file into the chunk store (replace it by its manifest)
+
+    Args:
+        store (ChunkStore): the chunk store
+        path (str): the file to store
+
+    Return:
+        ChunkStage : the stage that stored the file (manifest path, sizes)
+    """
+    stage = ChunkStage(store, path)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    try:
+        with open(path, "rb") as fh:
+            while True:
+                size = fh.readinto(buffer)
+                if not size:
+                    break
+                stage.write(view[:size])
+    except BaseException:
+        stage.abort()
+        raise
+    stage.close()
+    os.remove(path)
+    return stage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="The backup chunk store maintenance")
+    parser.add_argument("action", choices=["restore", "gc", "stats"])
+    parser.add_argument("store", help="the chunk store directory")
+    parser.add_argument("manifest", nargs="?", help="the manifest to restore")
+    parser.add_argument("target", nargs="?", default="-", help="the restored file, - for STDOUT")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    store = ChunkStore(args.store)
+    if args.action == "gc":
+        store.gc(wait=True)
+    elif args.action == "stats":
+        print(json.dumps(store.stats()))
+    else:
+        out = sys.stdout.buffer if args.target == "-" else open(args.target, "wb")
+        for data in store.restore(args.manifest):
+            out.write(data)
+        out.flush()
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
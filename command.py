@@ -1,24 +1,201 @@
 #!/usr/bin/env python
 
 # Built-in modules
+import collections
+import copy
 import json
 import logging
 import os.path
+import selectors
 import subprocess
+import threading
+import time
 
 # 3ed party modules
 
 # Local modules
+import agent
+import cache
 import constnts
+import sshpool
 
 
 logger = logging.getLogger(__name__)
+ERROR = "Error in command"
+STREAM_FORMATS = ["stream", "chunks"]
+
+# xe sub-commands (suffix) that only read, and can be cached
+XE_READ_ONLY = ("-list", "-param-get", "-param-list")
+# xe sub-commands that are not read-only, but do not change any object
+XE_NON_MUTATING = ["vm-export", "vdi-export", "pool-dump-database"]
+# per sub-command time-to-live (in seconds) of the cached results
+XE_CACHE_TTL = {"pool-list": 3600, "host-list": 3600}
+# remote commands that only read, and can run again when the SSH connection was lost
+REMOTE_READ_ONLY = ["ls", "cat", "test", "df", "du", "stat"]
+
+
+def is_read_only(cmd):
+    """
+    Args:
+        cmd (str): the remote command
+
+    Returns:
+        bool : True if running the command again has no side effects
+    """
+    if any(char in cmd for char in ">|;&`$"):
+        return False
+    words = cmd.split()
+    if not words:
+        return False
+    name = os.path.basename(words[0])
+    if name == "xe":
+        return len(words) > 1 and words[1].endswith(XE_READ_ONLY)
+    return name in REMOTE_READ_ONLY
+
+
+class CommandStream:
+    def __init__(self, command, timeout=600, mode="stream", chunk_size=65536, max_line=1024 * 1024, **kwargs):
+        """
+        Run a command, and iterate its STDOUT while it is running, without
+        holding all the output in memory.
+
+        Args:
+            command (list): the command to execute
+            timeout (int): the command timeout in seconds, the command is killed when passed
+            mode (str): 'stream' to iterate the output lines (str) or 'chunks' to iterate bytes chunks
+            chunk_size (int): the maximum size of each read from the command output
+            max_line (int): longer lines are returned in parts of this size
+            kwargs (dict): dictionary of argument as subprocess get
+        """
+        self._command = command
+        self._timeout = timeout
+        self._mode = mode
+        self._chunk_size = chunk_size
+        self._max_line = max_line
+        self._cancelled = False
+        self._drained = False  # the whole STDOUT was read
+        self._stderr = collections.deque(maxlen=100)  # last lines of STDERR
+        self.timed_out = False
+        for key in ["stdout", "stderr"]:
+            kwargs[key] = subprocess.PIPE
+        kwargs.setdefault("stdin", subprocess.DEVNULL)
+        try:
+            self._proc = subprocess.Popen(command, **kwargs)
+        except Exception as ex:
+            logger.error(f"The command didn't ran: {ex}")
+            self._proc = None
+            self._stderr.append(str(ex))
+            return
+        self._err_thread = threading.Thread(target=self._read_stderr, daemon=True)
+        self._err_thread.start()
+
+    def _read_stderr(self):
+        for line in self._proc.stderr:
+            self._stderr.append(line.decode(errors="replace").rstrip())
+
+    def _chunks(self):
+        deadline = time.monotonic() + self._timeout
+        fd = self._proc.stdout.fileno()
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while not self._cancelled:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error(f"The command {self._command} timed out after {self._timeout} Sec.")
+                    self.timed_out = True
+                    break
+                if not sel.select(timeout=min(remaining, 1)):
+                    continue
+                data = os.read(fd, self._chunk_size)
+                if not data:
+                    self._drained = True
+                    break
+                yield data
+
+    def __iter__(self):
+        if self._proc is None:
+            return
+        try:
+            if self._mode == "chunks":
+                yield from self._chunks()
+                return
+            buffer = bytearray()
+            for data in self._chunks():
+                buffer += data
+                start = 0
+                while True:
+                    end = buffer.find(b"\n", start)
+                    if end < 0:
+                        break
+                    yield buffer[start:end].decode(errors="replace")
+                    start = end + 1
+                del buffer[:start]
+                while len(buffer) >= self._max_line:
+                    yield buffer[: self._max_line].decode(errors="replace")
+                    del buffer[: self._max_line]
+            if buffer and not self._cancelled and not self.timed_out:
+                yield buffer.decode(errors="replace")
+        finally:
+            self._finish()
+
+    def _finish(self):
+        # when the iteration stopped before the end of the output nobody read the rest of it,
+        # and the command could block on the full pipe until the timeout, so it is killed
+        killed = self._proc.poll() is None and (self._cancelled or self.timed_out or not self._drained)
+        if killed:
+            self._proc.kill()
+        self._proc.stdout.close()
+        try:
+            self._proc.wait(timeout=self._timeout)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._err_thread.join(timeout=5)
+        if killed and not self.timed_out:
+            logger.debug(f"The command {self._command} was stopped before the end of its output")
+        elif self._proc.returncode:
+            logger.error(f"Command finished with non zero exitcode ({self._proc.returncode}): {self.stderr}")
+
+    def cancel(self):
+        """
+        Stop the command, the iteration ends after the current line / chunk
+        """
+        self._cancelled = True
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+
+    @property
+    def returncode(self):
+        """
+        The command exit code, None while it is running (1 if it didn't ran)
+        """
+        if self._proc is None:
+            return 1
+        return self._proc.poll()
+
+    @property
+    def stderr(self):
+        """
+        The last lines of the command STDERR
+        """
+        return "\n".join(self._stderr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self._proc is not None and self._proc.poll() is None:
+            self.cancel()
+            self._finish()
 
 
 class Command:
-    def __init__(self, host="localhost", user="root"):
+    def __init__(self, host="localhost", user="root", pool=None):
         self._host = host
         self._user = user
+        self._pool = pool
+        self._agent = None
+        self._cache = None
         if host != "localhost":
             self._rcmd = f"ssh {self.user()}@{self.host()}"
         else:
@@ -37,6 +214,20 @@ class Command:
             self._rcmd = f"ssh {value}@{self.host()}"
         return self._user
 
+    def pool(self, value=None):
+        """
+        Set / Get the SSH connection pool that the remote commands run over.
+
+        Args:
+            value (SshPool): the connection pool to use
+
+        Returns:
+            SshPool : the connection pool in use, None if not using a pool
+        """
+        if value is not None:
+            self._pool = value
+        return self._pool
+
     def run(self, cmd, timeout=600, out_format="string", **kwargs):
         """
         Running command on the OS and return the STDOUT & STDERR outputs
@@ -47,45 +238,82 @@ class Command:
                 Note: if the command contain quoted argument(s), use the list format of the command
                 and not the one string format
             timeout (int): the command timeout in seconds, default is 10 Min.
-            out_format (str): in which format to return the output: string / list / json / last
+            out_format (str): in which format to return the output: string / list / json / last / rc,
+                or stream / chunks for iterating the output lines / bytes chunks while the command runs
             kwargs (dict): dictionary of argument as subprocess get
 
         Returns:
             list or str : all STDOUT and STDERR output as list of lines, or one string separated by NewLine
+            CommandStream : for the stream / chunks formats
 
         """
+        if "out_format" in kwargs:
+            out_format = kwargs["out_format"]
+            del kwargs["out_format"]
+
+        logger.info(f"Going to format output as {out_format}")
+        if out_format in STREAM_FORMATS:
+            command = cmd.split() if isinstance(cmd, str) else cmd
+            logger.info(f"Going to stream {cmd} with timeout of {timeout}")
+            return CommandStream(command, timeout=timeout, mode=out_format, **kwargs)
 
-        ERROR = "Error in command"
+        rc, output = self._run(cmd, timeout=timeout, **kwargs)
+        return self._format(rc, output, out_format)
+
+    def _run(self, cmd, timeout=600, **kwargs):
+        """
+        Running command on the OS
+
+        Args:
+            cmd (str/list): the command to execute
+            timeout (int): the command timeout in seconds
+            kwargs (dict): dictionary of argument as subprocess get
+
+        Returns:
+            int, str : the command exit code, and all STDOUT and STDERR output
+        """
         if isinstance(cmd, str):
             command = cmd.split()
         elif isinstance(cmd, list):
             command = cmd
         else:
-            return ERROR
+            return 1, ERROR
 
         for key in ["stdout", "stderr", "stdin"]:
             kwargs[key] = subprocess.PIPE
 
-        if "out_format" in kwargs:
-            out_format = kwargs["out_format"]
-            del kwargs["out_format"]
-
-        logger.info(f"Going to format output as {out_format}")
         logger.info(f"Going to run {cmd} with timeout of {timeout}")
         try:
             cp = subprocess.run(command, timeout=timeout, **kwargs)
+            rc = cp.returncode
             output = cp.stdout.decode().strip()
             err = cp.stderr.decode().strip()
             # exit code is not zero
-            if cp.returncode:
-                logger.error(f"Command finished with non zero exitcode ({cp.returncode}): {err}")
-                output += f"\n{ERROR} ({cp.returncode}): {err}"
+            if rc:
+                logger.error(f"Command finished with non zero exitcode ({rc}): {err}")
+                output += f"\n{ERROR} ({rc}): {err}"
         except Exception as ex:
             logger.error(f"The command didn't ran: {ex}")
-            output = f"Error in command: {ex}"
+            rc = 1
+            output = f"{ERROR}: {ex}"
+
+        return rc, output
+
+    @staticmethod
+    def _format(rc, output, out_format):
+        """
+        Format the command output
+
+        Args:
+            rc (int): the command exit code
+            output (str): the command output
+            out_format (str): in which format to return the output: string / list / json / last / rc
 
+        Returns:
+            the formatted output
+        """
         if out_format == "rc":
-            return cp.returncode
+            return rc
 
         if out_format in ["list", "last"]:
             output = output.split("\n")  # convert output to list
@@ -107,12 +335,114 @@ class Command:
         return output
 
     def run_remote(self, cmd, timeout=600, out_format="string", **kwargs):
-        command = f"{self._rcmd} {cmd}"
-        return self.run(command, timeout=timeout, out_format=out_format, **kwargs)
+        if out_format in STREAM_FORMATS:
+            if self._pool is not None and self._rcmd != "":
+                command = self._pool.args(self._user, self._host) + cmd.split()
+            else:
+                command = f"{self._rcmd} {cmd}"
+            return self.run(command, timeout=timeout, out_format=out_format, **kwargs)
+
+        logger.info(f"Going to format output as {out_format}")
+        rc, output = self._run_remote(cmd, timeout=timeout, **kwargs)
+        return self._format(rc, output, out_format)
+
+    def _run_remote(self, cmd, timeout=600, **kwargs):
+        if self._pool is None or self._rcmd == "":
+            return self._run(f"{self._rcmd} {cmd}", timeout=timeout, **kwargs)
+
+        # running over the multiplexed connection, when the connection was lost it is reopened,
+        # and only the read-only commands are run again (the others may have ran on the host)
+        for attempt in range(2):
+            prefix = self._pool.args(self._user, self._host)
+            start = time.monotonic()
+            rc, output = self._run(prefix + cmd.split(), timeout=timeout, **kwargs)
+            self._pool.record(self._user, self._host, time.monotonic() - start)
+            if rc != sshpool.SSH_ERROR or attempt:
+                break
+            if not self._pool.reconnect(self._user, self._host, prefix) or not is_read_only(cmd):
+                break
+        return rc, output
+
+    def run_xe(self, cmd, out_format="last", ttl=None):
+        """
+        Run xe command on the host. when a cache is set, the results of
+        read-only commands (list / param-get) are cached, and other commands
+        invalidate the cached results of the object class they change.
 
-    def run_xe(self, cmd, out_format="last"):
+        Args:
+            cmd (str): the xe command (without the 'xe') to execute
+            out_format (str): in which format to return the output, see run()
+            ttl (int): the time-to-live (in seconds) of the cached results, default by the sub-command
+
+        Returns:
+            the formatted output, see run()
+        """
         command = f'{os.path.join(constnts.xe_path, "xe")} {cmd}'
-        return self.run_remote(command, out_format=out_format)
+        if self._cache is None or out_format in STREAM_FORMATS:
+            return self.run_remote(command, out_format=out_format)
+
+        sub_command = cmd.split()[0]
+        obj_class = sub_command.split("-")[0]
+        if sub_command.endswith(XE_READ_ONLY):
+            key = ("xe", cmd)
+            found, value = self._cache.get(key, name="xe")
+            if found:
+                logger.info(f"Using cached result of : xe {cmd}")
+                return self._format(*value, out_format)
+            rc, output = self._run_remote(command)
+            if rc == 0:
+                ttl = XE_CACHE_TTL.get(sub_command) if ttl is None else ttl
+                self._cache.set(key, (rc, output), ttl=ttl, tags=[obj_class])
+            return self._format(rc, output, out_format)
+
+        rc, output = self._run_remote(command)
+        if sub_command not in XE_NON_MUTATING:
+            self._cache.invalidate(*cache.RELATED_CLASSES.get(obj_class, [obj_class]), name="xe")
+        return self._format(rc, output, out_format)
+
+    def cache(self, value=None):
+        """
+        Set / Get the cache for the read-only xe commands and directory listing
+
+        Args:
+            value (TTLCache): the cache to use
+
+        Returns:
+            TTLCache : the cache in use, None if not using a cache
+        """
+        if value is not None:
+            self._cache = value
+        return self._cache
+
+    def _cached(self, key, path, func):
+        # cache a directory (path) query, see path_changed()
+        if self._cache is None:
+            return func()
+        found, value = self._cache.get(key, name="fs")
+        if found:
+            return copy.deepcopy(value)
+        value = func()
+        self._cache.set(key, copy.deepcopy(value), tags=[f"fs:{os.path.normpath(path)}"])
+        return value
+
+    def path_changed(self, *paths):
+        """
+        Invalidate the cached directory queries (dir_list / backup_dir_state) of
+        changed paths, their parents and their sub-directories. The file
+        operations of this class call it, the files that are written by other
+        means (the HTTP exports, or the host) must call it too.
+
+        Args:
+            paths (str): the changed paths
+        """
+        if self._cache is None:
+            return
+        for path in paths:
+            path = os.path.normpath(path)
+            self._cache.invalidate_prefix(f"fs:{path}", name="fs")
+            while path not in [os.sep, "."]:
+                path = os.path.dirname(path)
+                self._cache.invalidate(f"fs:{path}", name="fs")
 
     def run_df(self, log_msg, path):
         logger.info(log_msg)
@@ -134,26 +464,241 @@ class Command:
         else:
             return "success"
 
+    def start_agent(self, python="python3"):
+        """
+        Start the remote helper agent on the host, all the file-system operations
+        will be sent to it in batches. if the agent cannot be started, the
+        operations are done with shell commands.
+
+        Args:
+            python (str): the python interpreter on the remote host
+
+        Returns:
+            bool : True if the agent is running, otherwise False
+        """
+        if self._rcmd == "":
+            prefix = []
+        elif self._pool is not None:
+            prefix = self._pool.args(self._user, self._host)
+        else:
+            prefix = self._rcmd.split()
+        self._agent = agent.RemoteAgent(prefix, python=python)
+        try:
+            self._agent.start()
+        except agent.AgentError as ex:
+            logger.warning(f"Cannot use the remote agent, using shell commands : {ex}")
+            self._agent = None
+        return self._agent is not None
+
+    def stop_agent(self):
+        if self._agent is not None:
+            self._agent.close()
+            self._agent = None
+
+    def batch(self, requests):
+        """
+        Send batch of file-system operations to the remote agent
+
+        Args:
+            requests (list): list of operations (dict), see remote_agent.py
+
+        Returns:
+            list : list of results (dict), None if the agent is not running
+        """
+        if self._agent is None:
+            return None
+        try:
+            return self._agent.request(requests)
+        except agent.AgentError as ex:
+            logger.error(f"The remote agent failed, using shell commands : {ex}")
+            self._agent = None
+            return None
+
     def dir_list(self, path):
-        results = self.run_remote(f"ls {path}", out_format="list")
-        if len(results) > 1:
-            results.sort()
-        return results
+        return self._cached(("ls", path), os.path.dirname(path) if "*" in path else path, lambda: self._dir_list(path))
+
+    def _dir_list(self, path):
+        if self._agent is not None:
+            dirname, pattern = os.path.split(path)
+            if any(c in pattern for c in "*?["):
+                results = self.batch([{"op": "list", "path": dirname, "glob": pattern}])
+                if results is not None:
+                    return [os.path.join(dirname, name) for name in results[0].get("names", [])]
+            else:
+                results = self.batch([{"op": "list", "path": path}])
+                if results is not None:
+                    return results[0].get("names", [])
+
+        # the names are read as they arrive, without holding (and copying) the whole output,
+        # and the errors (STDERR) are not taken as names
+        return sorted(name for name in self.run_remote(f"ls {path}", out_format="stream") if name != "")
 
     def path_exists(self, path):
+        self.path_changed(path)
+        results = self.batch([{"op": "touch", "path": path}])
+        if results is not None:
+            return 0 if results[0]["ok"] else 1
         command = f"/usr/bin/touch {path}"
         return self.run_remote(command, out_format="rc")
 
-    def path_delete(self, path):
-        command = f"rm -rf {path}"
+    def exists(self, path):
+        """
+        Check (without creating anything) if a file or directory exists
+
+        Args:
+            path (str): the full path of the file / directory
+
+        Returns:
+            int : 0 if the path exists, otherwise 1
+        """
+        results = self.batch([{"op": "stat", "path": path}])
+        if results is not None:
+            return 0 if results[0]["ok"] and results[0]["exists"] else 1
+        return self.run_remote(f"test -e {path}", out_format="rc")
+
+    def path_delete(self, *paths):
+        self.path_changed(*paths)
+        results = self.batch([{"op": "remove_tree", "paths": list(paths)}])
+        if results is not None:
+            return 0 if results[0]["ok"] else 1
+        command = f"rm -rf {' '.join(paths)}"
         return self.run_remote(command, out_format="rc")
 
+    def mkdir(self, path):
+        self.path_changed(path)
+        results = self.batch([{"op": "mkdir", "path": path}])
+        if results is not None:
+            return 0 if results[0]["ok"] else 1
+        return self.run_remote(f"mkdir -p {path}", out_format="rc")
+
     def write_to_file(self, filename, data):
-        for line in data:
+        self.path_changed(filename)
+        data = "".join(f"{line}\n" for line in data)
+        results = self.batch([{"op": "write_file", "path": filename, "data": data, "append": True}])
+        if results is not None:
+            return
+        for line in data.splitlines():
             command = f"echo '{line}' >> {filename}"
             if self.run_remote(command, out_format="rc") != 0:
-                logger.debug(f"cannot write to the file : {logger.debug}")
+                logger.debug(f"cannot write to the file : {filename}")
+
+    def write_files(self, files):
+        """
+        Write (replace) number of text files, the directories are created if needed.
+
+        Args:
+            files (dict): the files to write, full path of the file -> list of lines
 
+        Returns:
+            int : number of files that failed to be written
+        """
+        self.path_changed(*files)
+        requests = [
+            {"op": "write_file", "path": filename, "data": "".join(f"{line}\n" for line in data)}
+            for filename, data in files.items()
+        ]
+        results = self.batch(requests)
+        if results is not None:
+            return len([res for res in results if not res["ok"]])
+
+        failed = 0
+        for filename, data in files.items():
+            if self.mkdir(os.path.dirname(filename)) != 0:
+                failed += 1
+                continue
+            self.run_remote(f"rm -f {filename}", out_format="rc")
+            self.write_to_file(filename, data)
+        return failed
+
+    def read_files(self, *paths):
+        """
+        Read number of (small) text files
+
+        Args:
+            paths (str): the full path of the files
+
+        Returns:
+            dict : the file path -> its content, None for files that cannot be read
+        """
+        results = self.batch([{"op": "read_file", "path": path} for path in paths])
+        if results is not None:
+            return {path: res["data"] if res["ok"] else None for path, res in zip(paths, results)}
+
+        contents = dict()
+        for path in paths:
+            rc, output = self._run_remote(f"cat {path}")
+            contents[path] = output if rc == 0 else None
+        return contents
+
+    def backup_dir_state(self, path, marker="success*"):
+        """
+        Get the list of backup directories, and the directories that contain
+        the marker file, in one round trip when the agent is running.
+
+        Args:
+            path (str): the path of the backups
+            marker (str): the (glob) name of the marker file
+
+        Returns:
+            list, list : sorted list of the backup directories, and the directories with the marker
+        """
+        return self._cached(("state", path, marker), path, lambda: self._backup_dir_state(path, marker))
+
+    def _backup_dir_state(self, path, marker):
+        results = self.batch(
+            [
+                {"op": "list", "path": path},
+                {"op": "list", "path": path, "glob": f"*/{marker}"},
+            ]
+        )
+        if results is not None:
+            dirs = results[0].get("names", [])
+            marked = {name.split("/")[0] for name in results[1].get("names", [])}
+        else:
+            dirs = self.dir_list(path)
+            marked = {
+                name.rstrip("/").split("/")[-2]
+                for name in self.run_remote(f"ls -d {path}/*/{marker}", out_format="stream")
+                if name.startswith(path)
+            }
+        return dirs, sorted(marked)
+
+    def file_size(self, path):
+        """
+        Get the disk usage of a file (like 'du -m')
+
+        Args:
+            path (str): the path of the file
+
+        Returns:
+            int : the disk usage in MB
+        """
+        results = self.batch([{"op": "stat", "path": path}])
+        if results is not None:
+            return int(results[0].get("usage", 0) / (1024 * 1024))
+        try:
+            return int(self.run_remote(f"du -m {path}", out_format="last").split()[0])
+        except (IndexError, ValueError):
+            return 0
+
+    def disk_free(self, path):
+        """
+        Get the file-system capacity of a path
+
+        Args:
+            path (str): a path in the file-system
+
+        Returns:
+            dict : the 'total', 'used' and 'avail' capacity in bytes, empty dict on failure
+        """
+        results = self.batch([{"op": "df", "path": path}])
+        if results is not None:
+            return {key: results[0][key] for key in ["total", "used", "avail"] if key in results[0]}
+        try:
+            line = self.run_remote(f"df -kP {path}", out_format="last").split()
+            return {key: int(value) * 1024 for key, value in zip(["total", "used", "avail"], line[1:4])}
+        except (IndexError, ValueError):
+            return {}
 
 if __name__ == "__main__":
     c = Command()
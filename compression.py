@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+This module contain the parallel compression of the backup files.
+
+The data is split into blocks, and the blocks are compressed on a pool of
+processes (one per core by default), and written in their original order.
+Each block is compressed as an independent member (gzip) or frame (zstd), and
+the concatenation of the members is a valid gzip / zstd file, that the
+standard tools (gunzip, zstd -d) decompress.
+The memory use is capped by the number of blocks in flight.
+"""
+# Built-in modules
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import logging
+import multiprocessing
+import os
+import threading
+
+# 3ed party modules
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Local modules
+from exporter import FileWriter, Stage
+
+logger = logging.getLogger(__name__)
+
+CODECS = {"gzip": ".gz", "zstd": ".zst"}
+DEFAULT_LEVELS = {"gzip": 1, "zstd": 3}
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def check_codec(codec):
+    """
+    Args:
+        codec (str): the compression codec name : gzip / zstd
+
+    Raises:
+        ValueError : if the codec is unknown, or its module is not installed
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression {codec}, should be one of {list(CODECS)}")
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("The zstd compression needs the zstandard module (pip install zstandard)")
+
+
+def compress_block(codec, level, data):
+    """
+    Compress one block as an independent gzip member / zstd frame (run in the worker process)
+
+    Return:
+        bytes : the compressed block
+    """
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def get_executor(workers=None):
+    """
+    The process pool is shared by all the exports, so parallel exports do not
+    use more processes than cores. The pool processes are started by a fork
+    server, since the backup threads are running when it is created.
+
+    Args:
+        workers (int): number of processes, default is the number of cores (used on the first call only)
+
+    Return:
+        ProcessPoolExecutor : the shared process pool
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            context = multiprocessing.get_context("forkserver")
+            _executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context)
+        return _executor
+
+
+class ParallelCompressStage(Stage):
+    def __init__(self, codec="gzip", level=None, workers=None, block_size=DEFAULT_BLOCK_SIZE, in_flight=None):
+        """
+        Compress the data on the shared process pool (export stage)
+
+        Args:
+            codec (str): gzip / zstd
+            level (int): the compression level, default by the codec
+            workers (int): number of compression processes, default is the number of cores
+            block_size (int): the size of the blocks to compress
+            in_flight (int): maximum blocks that are compressed / waiting to be written, default is twice the workers
+        """
+        super().__init__()
+        check_codec(codec)
+        self.codec = codec
+        self.bytes_out = 0
+        self._level = DEFAULT_LEVELS[codec] if level is None else int(level)
+        self._block_size = block_size
+        self._in_flight = in_flight or 2 * (workers or os.cpu_count())
+        self._executor = get_executor(workers)
+        self._block = bytearray()
+        self._pending = collections.deque()
+
+    def _submit(self):
+        if len(self._pending) >= self._in_flight:
+            self._write_oldest()
+        self._pending.append(self._executor.submit(compress_block, self.codec, self._level, bytes(self._block)))
+        self._block.clear()
+
+    def _write_oldest(self):
+        compressed = self._pending.popleft().result()
+        self.bytes_out += len(compressed)
+        self.next.write(memoryview(compressed))
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        while len(data):
+            room = self._block_size - len(self._block)
+            self._block += data[:room]
+            data = data[room:]
+            if len(self._block) == self._block_size:
+                self._submit()
+
+    def close(self):
+        if self._block or self.bytes_in == 0:
+            self._submit()
+        while self._pending:
+            self._write_oldest()
+        super().close()
+
+    def abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        super().abort()
+
+    def ratio(self):
+        """
+        Return:
+            float : the compressed size / the original size
+        """
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+
+def compress_file(path, codec="gzip", level=None, workers=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Compress a file (in parallel), and remove the original file
+
+    Args:
+        path (str): the file to compress
+        codec (str): gzip / zstd
+        level (int): the compression level, default by the codec
+        workers (int): number of compression processes, default is the number of cores
+        block_size (int): the size of the blocks to compress
+
+    Return:
+        str : the compressed file path (the path + .gz / .zst)
+    """
+    target = f"{path}{CODECS[codec]}"
+    stage = ParallelCompressStage(codec, level=level, workers=workers, block_size=block_size)
+    stage.next = FileWriter(target)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    try:
+        with open(path, "rb") as fh:
+            while True:
+                size = fh.readinto(buffer)
+                if not size:
+                    break
+                stage.write(view[:size])
+        stage.close()
+    except Exception:
+        stage.abort()
+        raise
+    os.remove(path)
+    logger.info(f"Compressed {path} with {codec} : {stage.bytes_in} -> {stage.bytes_out} bytes ({stage.ratio():.2f})")
+    return target
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        name = os.path.join(tmp_dir, "disk.raw")
+        data = (os.urandom(1024) + bytes(3 * 1024)) * 64 * 1024
+        with open(name, "wb") as fh:
+            fh.write(data)
+        start = time.monotonic()
+        name = compress_file(name)
+        print(f"{time.monotonic() - start:.2f} Sec.", gzip.open(name).read() == data)
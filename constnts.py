@@ -14,13 +14,73 @@ DEFAULT_XENSERVER = " localhost"
 # modify these hard coded default values, only used if not specified in config file
 DEFAULT_POOL_DB_BACKUP = 0
 DEFAULT_MAX_BACKUPS = 4
+# The daily / weekly / monthly retention tiers (number of days / weeks / months to keep a backup of)
+DEFAULT_KEEP_DAILY = 0
+DEFAULT_KEEP_WEEKLY = 0
+DEFAULT_KEEP_MONTHLY = 0
+# How many VMs to back up in parallel
+DEFAULT_MAX_PARALLEL_EXPORTS = 1
+DEFAULT_PREPARE_WORKERS = 1
+DEFAULT_CLEANUP_WORKERS = 1
+DEFAULT_PIPELINE_QUEUE_SIZE = 1
 
 # xe vdi-export options: 'raw' or 'vhd'
 DEFAULT_VDI_EXPORT_FORMAT = "raw"
 
+# SSH connection pool: run all remote commands over persistent multiplexed
+# connections, number of connections per host and idle time (in seconds)
+DEFAULT_SSH_MULTIPLEX = "true"
+DEFAULT_SSH_POOL_SIZE = 2
+DEFAULT_SSH_CONTROL_PERSIST = 600
+
+# Remote helper agent: send the backup directory file-system operations in
+# batches to a helper running on the xen server python interpreter
+DEFAULT_REMOTE_AGENT = "true"
+DEFAULT_AGENT_PYTHON = "python3"
+
+# Cache of read-only xe / XenAPI queries and backup directories listing: the
+# default time-to-live (in seconds) of the cached results, 0 to disable the cache
+DEFAULT_CACHE_TTL = 30
+# XenAPI getters of fields that never change, cached for the whole run
+XENAPI_CACHE_TTL = {"get_uuid": 3600, "get_is_a_snapshot": 3600}
+
+# The backend for the snapshot / cleanup operations: 'xenapi' (direct XenAPI
+# calls) or 'xe' (xe CLI commands over SSH)
+DEFAULT_BACKEND = "xenapi"
+DEFAULT_EXPORT_DISPATCH = "master"
+DEFAULT_HOST_EXPORT_LIMIT = 1
+DEFAULT_EXPORT_METHOD = "xe"
+DEFAULT_COMPRESSION = "none"
+DEFAULT_COMPRESSION_WORKERS = 0
+DEFAULT_INCREMENTAL = "false"
+DEFAULT_CBT_FULL_EVERY = 7
+DEFAULT_DEDUP = "false"
+DEFAULT_SPARSE = "false"
+DEFAULT_THROTTLE_RATE = 0
+DEFAULT_THROTTLE_SR_RATE = 0
+DEFAULT_THROTTLE_HOST_RATE = 0
+DEFAULT_THROTTLE_ADAPTIVE = "false"
+DEFAULT_THROTTLE_LATENCY_FACTOR = 2
+DEFAULT_INTEGRITY = "true"
+DEFAULT_INTEGRITY_ALGORITHM = "sha256"
+# Hash the xe exports after the export (re-read the whole file)
+DEFAULT_INTEGRITY_BLOCK_SIZE = 4
+DEFAULT_RESUME_WINDOW = 0
+DEFAULT_CHECKPOINT_INTERVAL = 1024
+DEFAULT_BACKUP_TARGET = "posix"
+DEFAULT_WRITE_STRATEGY = "default"
+DEFAULT_WRITE_BUFFER_SIZE = 8
+DEFAULT_S3_REGION = "us-east-1"
+DEFAULT_S3_PART_SIZE = 64
+DEFAULT_S3_UPLOAD_CONCURRENCY = 4
+
 # For paths on Linux & Windows systems
 DEFAULT_BACKUP_DIR = "/backups"
 DEFAULT_STATUS_LOG = "status.log"
+# The backups duration history (for ordering the backups), created next to the status log
+DEFAULT_HISTORY_FILE = "vmbackup-history.json"
+# The pool inventory cache (with the XenAPI event token), created next to the status log
+DEFAULT_INVENTORY_CACHE = "vmbackup-inventory.db"
 
 # ############################ OPTIONAL
 # optional email may be triggered by configure next 3 parameters then find MAIL_ENABLE
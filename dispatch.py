@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+This module contain the dispatcher that choose the pool member (host) that run
+each export.
+
+By default all the xe commands run on the configured xen_server, so all the
+exports are streamed through one dom0 and one NIC. With the 'affine' dispatch
+the export of a VM run on the host that the VM is resident on, or on the least
+loaded host that can reach all the VM storage (SRs with attached PBD), and
+the number of concurrent exports on each host is limited.
+
+Note: the xe vm-export / vdi-export write the backup file on the host that
+run it, so the backup_dir must be mounted on all the pool members.
+"""
+# Built-in modules
+import contextlib
+import logging
+import threading
+
+# 3ed party modules
+
+# Local modules
+from command import Command
+
+logger = logging.getLogger(__name__)
+
+NULL_REF = "OpaqueRef:NULL"
+DISPATCH_MODES = ["master", "affine"]
+
+
+class HostDispatcher:
+    def __init__(self, xapi, cmd, mode="master", host_limit=1):
+        """
+        Initialize the dispatcher object
+
+        Args:
+            xapi (object): the XenAPI session proxy (session.xenapi)
+            cmd (Command): the command object of the configured xen_server
+            mode (str): 'master' to run all the exports with cmd, 'affine' to spread them on the pool members
+            host_limit (int): maximum concurrent exports on each host (affine mode only, with master the
+                              exports are limited only by the number of the export workers)
+        """
+        self._xapi = xapi
+        self._cmd = cmd
+        self._mode = mode if cmd.host() != "localhost" else "master"
+        self._host_limit = max(int(host_limit), 1)
+        self._lock = threading.Lock()
+        self._free = threading.Condition(self._lock)  # notified when an export slot is released
+        self._commands = {}  # host address -> Command
+        self._load = {}  # host address -> number of running exports
+        self._exports = {}  # host address -> total number of exports
+
+    def _enabled_hosts(self):
+        """
+        Return:
+            dict : host reference -> host address, of all the enabled hosts
+        """
+        records = self._xapi.host.get_all_records()
+        return {ref: record["address"] for ref, record in records.items() if record["enabled"]}
+
+    def _vm_srs(self, vm_ref):
+        """
+        Return:
+            set : the references of the SRs of all the VM disks
+        """
+        srs = set()
+        for vbd in self._xapi.VM.get_VBDs(vm_ref):
+            vdi = self._xapi.VBD.get_VDI(vbd)
+            if vdi != NULL_REF:
+                srs.add(self._xapi.VDI.get_SR(vdi))
+        return srs
+
+    def _connected_hosts(self, srs):
+        """
+        Return:
+            set : the references of the hosts that have attached PBD to all the SRs
+        """
+        hosts = None
+        for sr in srs:
+            attached = set()
+            for pbd in self._xapi.SR.get_PBDs(sr):
+                if self._xapi.PBD.get_currently_attached(pbd):
+                    attached.add(self._xapi.PBD.get_host(pbd))
+            hosts = attached if hosts is None else hosts & attached
+        return hosts
+
+    def _candidates(self, vm_uuid):
+        """
+        Find the hosts that can export the VM (or its disk)
+
+        Args:
+            vm_uuid (str): the UUID of the VM
+
+        Return:
+            list, str : the addresses of the hosts that can reach all the VM storage, and the address of the
+                        host that the VM is resident on (empty string if it is not a candidate)
+        """
+        try:
+            vm_ref = self._xapi.VM.get_by_uuid(vm_uuid)
+            enabled = self._enabled_hosts()
+            connected = self._connected_hosts(self._vm_srs(vm_ref))
+            resident = self._xapi.VM.get_resident_on(vm_ref)
+        except Exception as ex:
+            logger.warning(f"Cannot find the host of VM {vm_uuid}, using {self._cmd.host()} : {ex}")
+            return [self._cmd.host()], ""
+
+        # without disks (connected is None) the VM can be exported from any host
+        candidates = [enabled[ref] for ref in enabled if connected is None or ref in connected]
+        if not candidates:
+            logger.warning(f"No host can reach the storage of VM {vm_uuid}, using {self._cmd.host()}")
+            return [self._cmd.host()], ""
+        return candidates, enabled[resident] if resident in enabled and enabled[resident] in candidates else ""
+
+    def _pick(self, candidates, resident):
+        # called with the lock held - the resident host if it has a free slot, otherwise the least loaded one
+        free = [address for address in candidates if self._load.get(address, 0) < self._host_limit]
+        if not free:
+            return None
+        if resident in free:
+            return resident
+        return min(free, key=lambda address: (self._load.get(address, 0), self._exports.get(address, 0)))
+
+    def command(self, address):
+        """
+        Args:
+            address (str): the host address, empty string for the configured xen_server
+
+        Return:
+            Command : the command object to run the xe commands on the host with
+        """
+        if address in ("", self._cmd.host()):
+            return self._cmd
+        with self._lock:
+            if address not in self._commands:
+                host_cmd = Command(host=address, user=self._cmd.user(), pool=self._cmd.pool())
+                if self._cmd.cache() is not None:
+                    host_cmd.cache(self._cmd.cache())
+                self._commands[address] = host_cmd
+            return self._commands[address]
+
+    @contextlib.contextmanager
+    def slot(self, vm_uuid):
+        """
+        Choose the host to export the VM (or its disk) on, and wait for a free
+        export slot on it (context manager). The host is chosen when a slot is
+        free, so an export does not wait for a busy host while another host
+        that can run it is free. The host that the VM is resident on is
+        preferred, if it is not fully loaded. In the master mode all the
+        exports run on the configured xen_server, without per-host limit
+        (max_parallel_exports limit the exports)
+
+        Args:
+            vm_uuid (str): the UUID of the VM
+
+        Return:
+            Command : the command object to run the export with
+        """
+        if self._mode == "master":
+            address = self._cmd.host()
+            with self._lock:
+                self._load[address] = self._load.get(address, 0) + 1
+                self._exports[address] = self._exports.get(address, 0) + 1
+        else:
+            # the XenAPI calls run without the lock, only the choice of the host is under it
+            candidates, resident = self._candidates(vm_uuid)
+            with self._free:
+                self._free.wait_for(lambda: self._pick(candidates, resident) is not None)
+                address = self._pick(candidates, resident)
+                self._load[address] = self._load.get(address, 0) + 1
+                self._exports[address] = self._exports.get(address, 0) + 1
+        try:
+            yield self.command(address)
+        finally:
+            with self._free:
+                self._load[address] -= 1
+                self._free.notify_all()
+
+    def report(self):
+        """
+        Log the number of exports that ran on each host
+        """
+        with self._lock:
+            for address, count in sorted(self._exports.items()):
+                logger.info(f"Host {address}: {count} export(s)")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    dispatcher = HostDispatcher(None, Command())
+    with dispatcher.slot("") as host_cmd:
+        print(host_cmd.run("uname -n"))
+    dispatcher.report()
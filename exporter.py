@@ -0,0 +1,700 @@
+#!/usr/bin/env python
+"""
+This module contain the HTTP exporter, that stream the VM / VDI export
+directly from the XAPI HTTP handlers (/export and /export_raw_vdi) with the
+logged-in session, instead of running 'xe vm-export' / 'xe vdi-export'.
+
+The export body is read into one reusable buffer, and pass through a chain of
+stages (e.g. compress -> checksum -> write), so the memory is bounded, and the
+data can be processed while it is downloaded.
+
+    stages = [GzipStage(), ChecksumStage(), FileWriter("/backups/vm.xva.gz")]
+    stats = HttpExporter("xen1", session_ref).export_vm(vm_uuid, stages)
+
+The raw disk images are mostly unallocated (zeros), the SparseFileWriter
+skip the zero blocks (holes) instead of writing them, and write the extent
+map of the data next to the image (<image>.extents), so restore and
+verification can skip the holes without reading them :
+
+    {"size": <image size>, "extents": [[<offset>, <length>], ...]}
+
+The LargeFileWriter write multi-hundred-GB files without filling the page
+cache of the backup host : the expected size is preallocated, the data is
+written in large aligned batches, and the written pages are dropped behind
+the writer (sync_file_range + fadvise DONTNEED), or bypass the page cache
+(O_DIRECT).
+"""
+# Built-in modules
+import ctypes
+import ctypes.util
+import fcntl
+import hashlib
+import http.client
+import json
+import logging
+import mmap
+import os
+import ssl
+import time
+import urllib.parse
+import zlib
+
+# 3ed party modules
+
+# Local modules
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+MAX_REDIRECTS = 3
+SPARSE_BLOCK_SIZE = 64 * 1024
+ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+EXTENTS_SUFFIX = ".extents"
+# fallocate(2) flags
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+# sync_file_range(2) flags
+SYNC_FILE_RANGE_WAIT_BEFORE = 0x01
+SYNC_FILE_RANGE_WRITE = 0x02
+SYNC_FILE_RANGE_WAIT_AFTER = 0x04
+WRITE_STRATEGIES = ["batched", "dontneed", "direct"]
+DEFAULT_WRITE_SIZE = 8 * 1024 * 1024
+DIRECT_ALIGN = 4096
+
+
+class ExportError(Exception):
+    pass
+
+
+class Stage:
+    """
+    Base class of the export stages, each stage process the data and pass it
+    to the next stage in the chain.
+    """
+
+    def __init__(self):
+        self.next = None
+        self.bytes_in = 0
+
+    def write(self, data):
+        """
+        Process a block of data
+
+        Args:
+            data (memoryview): the data, valid only until the call return
+        """
+        self.bytes_in += len(data)
+        self.next.write(data)
+
+    def close(self):
+        """
+        Flush the stage and close the rest of the chain
+        """
+        if self.next is not None:
+            self.next.close()
+
+    def abort(self):
+        """
+        Discard the stage output (the export failed), and abort the rest of the chain
+        """
+        if self.next is not None:
+            self.next.abort()
+
+
+class GzipStage(Stage):
+    def __init__(self, level=1):
+        """
+        Compress the data to gzip format
+
+        Args:
+            level (int): the compression level (1 - fast ... 9 - small)
+        """
+        super().__init__()
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.next.write(memoryview(compressed))
+
+    def close(self):
+        self.next.write(memoryview(self._compressor.flush()))
+        super().close()
+
+
+class ChecksumStage(Stage):
+    def __init__(self, algorithm="sha256"):
+        """
+        Calculate the checksum of the data that pass through the stage
+
+        Args:
+            algorithm (str): the hashlib algorithm name
+        """
+        super().__init__()
+        self.algorithm = algorithm
+        self._hash = hashlib.new(algorithm)
+
+    def write(self, data):
+        self._hash.update(data)
+        super().write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class FileWriter(Stage):
+    def __init__(self, path, offset=0, keep_partial=False):
+        """
+        Write the data to a file (the last stage of the chain). The data is
+        written to a temporary file, that is renamed to the path on close, so
+        a failed export does not leave a partial backup file.
+
+        Args:
+            path (str): the file path
+            offset (int): continue the temporary file of a failed export from this offset
+            keep_partial (bool): keep the temporary file when the export fails (to resume it)
+        """
+        super().__init__()
+        self.path = path
+        self._tmp_path = f"{path}.part"
+        self._keep_partial = keep_partial
+        self._fh = self._open(offset)
+        self.bytes_in = offset
+
+    def _open(self, offset):
+        """
+        Return:
+            file : the temporary file, positioned at the offset
+        """
+        if offset > 0:
+            fh = open(self._tmp_path, "r+b")
+            fh.truncate(offset)
+            fh.seek(offset)
+            return fh
+        return open(self._tmp_path, "wb")
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._fh.write(data)
+
+    def sync(self):
+        """
+        Flush the written data to the disk
+        """
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def close(self):
+        self._fh.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._fh.close()
+        if not self._keep_partial and os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class SparseFileWriter(FileWriter):
+    def __init__(self, path, block_size=SPARSE_BLOCK_SIZE, offset=0, extents=None, keep_partial=False):
+        """
+        Write raw disk image, the all-zero blocks are not written (the file
+        position is moved, so they are holes in the file), and write the
+        extent map of the data to <path>.extents
+
+        Args:
+            path (str): the file path
+            block_size (int): the size of the blocks to check for zeros (up to SPARSE_BLOCK_SIZE)
+            offset (int): continue the temporary file of a failed export from this offset
+            extents (list): the extents of the data that was written before the offset
+            keep_partial (bool): keep the temporary file when the export fails (to resume it)
+        """
+        super().__init__(path, offset=offset, keep_partial=keep_partial)
+        self._block_size = block_size
+        self.extents = trim_extents(extents or [], offset)  # [offset, length] of the data, adjacent are merged
+        self.hole_bytes = offset - sum(length for _, length in self.extents)
+
+    def _add_extent(self, offset, length):
+        if self.extents and self.extents[-1][0] + self.extents[-1][1] == offset:
+            self.extents[-1][1] += length
+        else:
+            self.extents.append([offset, length])
+
+    def write(self, data):
+        while len(data):
+            # split the data at the blocks boundaries of the file
+            size = min(len(data), self._block_size - self.bytes_in % self._block_size)
+            if data[:size].tobytes() == ZERO_BLOCK[:size]:
+                self._fh.seek(size, os.SEEK_CUR)
+                self.hole_bytes += size
+            else:
+                self._fh.write(data[:size])
+                self._add_extent(self.bytes_in, size)
+            self.bytes_in += size
+            data = data[size:]
+
+    def sync(self):
+        # holes at the end of the image are not written, so set the file size
+        self._fh.truncate(self.bytes_in)
+        super().sync()
+
+    def close(self):
+        # holes at the end of the image are not written, so set the file size
+        self._fh.truncate(self.bytes_in)
+        self._fh.close()
+        write_extents(self.path, self.bytes_in, self.extents)
+        os.replace(self._tmp_path, self.path)
+        logger.info(f"Wrote {self.path} : {self.bytes_in - self.hole_bytes} data bytes, {self.hole_bytes} hole bytes")
+
+    def abort(self):
+        super().abort()
+        if os.path.exists(f"{self.path}{EXTENTS_SUFFIX}"):
+            os.remove(f"{self.path}{EXTENTS_SUFFIX}")
+
+
+class LargeFileWriter(FileWriter):
+    def __init__(
+        self, path, size=0, write_size=DEFAULT_WRITE_SIZE, strategy="dontneed", offset=0, keep_partial=False
+    ):
+        """
+        Write a large file (the last stage of the chain) with large aligned
+        writes from a page aligned buffer, the expected size is preallocated
+        (so the file is not fragmented), and with the strategy :
+            batched  - the written pages stay in the page cache
+            dontneed - the written pages are flushed and dropped from the page
+                       cache behind the writer (one batch behind, so the disk
+                       write of a batch overlap the next batch)
+            direct   - the data bypass the page cache (O_DIRECT), fallback to
+                       dontneed if the file-system does not support it
+
+        Args:
+            path (str): the file path
+            size (int): the expected file size to preallocate, 0 if unknown
+            write_size (int): the size of the writes (a multiple of 4096)
+            strategy (str): batched / dontneed / direct
+            offset (int): continue the temporary file of a failed export from this offset
+            keep_partial (bool): keep the temporary file when the export fails (to resume it)
+        """
+        self._size = size
+        self._write_size = max(write_size // DIRECT_ALIGN, 1) * DIRECT_ALIGN
+        self.strategy = strategy
+        self._direct = False  # the file is open with O_DIRECT
+        self.writes = 0
+        self._buffer = mmap.mmap(-1, self._write_size)  # page aligned, for O_DIRECT
+        self._view = memoryview(self._buffer)
+        self._filled = 0
+        self._written = offset  # the file offset of the data in the buffer
+        self._pending = None  # the (offset, length) of the batch that is written back
+        self._started = time.monotonic()
+        super().__init__(path, offset=offset, keep_partial=keep_partial)
+
+    def _open(self, offset):
+        flags = os.O_WRONLY | os.O_CREAT | (0 if offset > 0 else os.O_TRUNC)
+        fd = None
+        if self.strategy == "direct" and offset % DIRECT_ALIGN == 0:
+            try:
+                fd = os.open(self._tmp_path, flags | os.O_DIRECT, 0o644)
+                self._direct = True
+            except OSError as ex:
+                logger.warning(f"O_DIRECT is not supported for {self._tmp_path} ({ex}), using dontneed")
+        if fd is None:
+            if self.strategy == "direct":
+                self.strategy = "dontneed"
+            fd = os.open(self._tmp_path, flags, 0o644)
+        if offset > 0:
+            os.ftruncate(fd, offset)
+            os.lseek(fd, offset, os.SEEK_SET)
+        if self._size > offset:
+            try:
+                _preallocate(fd, offset, self._size - offset)
+            except OSError as ex:
+                logger.debug(f"Cannot preallocate {self._tmp_path} : {ex}")
+        return open(fd, "wb", buffering=0)
+
+    def _flush(self, size):
+        """
+        Write the first size bytes of the buffer, and move the rest to its start
+        """
+        view = self._view[:size]
+        while len(view):
+            view = view[self._fh.write(view) :]
+            self.writes += 1
+        rest = self._filled - size
+        self._view[:rest] = self._view[size : self._filled]
+        self._filled = rest
+        if self.strategy == "dontneed" and size:
+            fd = self._fh.fileno()
+            _sync_file_range(fd, self._written, size, SYNC_FILE_RANGE_WRITE)
+            if self._pending is not None:
+                wait = SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER
+                _sync_file_range(fd, *self._pending, wait)
+                os.posix_fadvise(fd, *self._pending, os.POSIX_FADV_DONTNEED)
+            self._pending = (self._written, size)
+        self._written += size
+
+    def _flush_all(self):
+        """
+        Write all the buffer, the unaligned tail of a direct file is written without O_DIRECT
+        """
+        if self._direct:
+            self._flush(self._filled // DIRECT_ALIGN * DIRECT_ALIGN)
+            if self._filled:
+                fd = self._fh.fileno()
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+                self._direct = False
+        self._flush(self._filled)
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        while len(data):
+            size = min(len(data), self._write_size - self._filled)
+            self._view[self._filled : self._filled + size] = data[:size]
+            self._filled += size
+            data = data[size:]
+            if self._filled == self._write_size:
+                self._flush(self._write_size)
+
+    def sync(self):
+        if self._direct:
+            # keep the unaligned tail in the buffer, the checkpoints are at aligned offsets
+            self._flush(self._filled // DIRECT_ALIGN * DIRECT_ALIGN)
+        else:
+            self._flush(self._filled)
+        os.fsync(self._fh.fileno())
+
+    def stats(self):
+        """
+        Return:
+            dict : the number of write syscalls, the bytes written and the throughput (MB/Sec.)
+        """
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        return {"writes": self.writes, "bytes": self.bytes_in, "throughput": self.bytes_in / elapsed / (1024 * 1024)}
+
+    def close(self):
+        self._flush_all()
+        fd = self._fh.fileno()
+        # the preallocated space after the data is released
+        os.ftruncate(fd, self.bytes_in)
+        if self.strategy != "batched":
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        self._release()
+        super().close()
+        stats = self.stats()
+        logger.info(
+            f"Wrote {self.path} : {stats['bytes']} bytes in {stats['writes']} writes, "
+            f"{stats['throughput']:.1f} MB/Sec. ({self.strategy})"
+        )
+
+    def abort(self):
+        self._release()
+        super().abort()
+
+    def _release(self):
+        self._view.release()
+        self._buffer.close()
+
+
+def trim_extents(extents, size):
+    """
+    Args:
+        extents (list): the [offset, length] of the data extents
+        size (int): the size to cut the extents at
+
+    Return:
+        list : the extents (copy) of the data before the size
+    """
+    trimmed = list()
+    for offset, length in extents:
+        if offset >= size:
+            break
+        trimmed.append([offset, min(length, size - offset)])
+    return trimmed
+
+
+def write_extents(path, size, extents):
+    """
+    Write the extent map of an image
+
+    Args:
+        path (str): the image path, the map is written to <path>.extents
+        size (int): the image size
+        extents (list): the [offset, length] of the data extents
+    """
+    tmp_path = f"{path}{EXTENTS_SUFFIX}.part"
+    with open(tmp_path, "w") as fh:
+        json.dump({"size": size, "extents": extents}, fh)
+    os.replace(tmp_path, f"{path}{EXTENTS_SUFFIX}")
+
+
+def load_extents(path):
+    """
+    Args:
+        path (str): the image path
+
+    Return:
+        list : the [offset, length] of the image data extents, None if the image has no extent map
+    """
+    try:
+        with open(f"{path}{EXTENTS_SUFFIX}", "r") as fh:
+            return json.load(fh)["extents"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        if hasattr(_libc, "sync_file_range"):
+            _libc.sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+    return _libc
+
+
+def _check(result):
+    if result != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def _punch_hole(fd, offset, length):
+    _check(_get_libc().fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length))
+
+
+def _preallocate(fd, offset, length):
+    # the file size is not changed, so a partial file has the size of its data
+    _check(_get_libc().fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length))
+
+
+def _sync_file_range(fd, offset, length, flags):
+    libc = _get_libc()
+    if not hasattr(libc, "sync_file_range"):
+        os.fdatasync(fd)
+        return
+    _check(libc.sync_file_range(fd, offset, length, flags))
+
+
+def sparsify_file(path, block_size=SPARSE_BLOCK_SIZE):
+    """
+    Punch holes (fallocate) in the all-zero blocks of an existing raw image,
+    and write its extent map
+
+    Args:
+        path (str): the image path
+        block_size (int): the size of the blocks to check for zeros (up to SPARSE_BLOCK_SIZE)
+
+    Return:
+        int : the number of bytes that were turned into holes
+    """
+    extents = list()
+    holes = 0
+    buffer = bytearray(block_size)
+    with open(path, "r+b") as fh:
+        offset = 0
+        while True:
+            size = fh.readinto(buffer)
+            if not size:
+                break
+            if buffer[:size] == ZERO_BLOCK[:size]:
+                _punch_hole(fh.fileno(), offset, size)
+                holes += size
+            elif extents and extents[-1][0] + extents[-1][1] == offset:
+                extents[-1][1] += size
+            else:
+                extents.append([offset, size])
+            offset += size
+    write_extents(path, offset, extents)
+    logger.info(f"Sparsified {path} : {holes} bytes turned into holes")
+    return holes
+
+
+class HttpExporter:
+    def __init__(self, host, session_ref, scheme="https", buffer_size=DEFAULT_BUFFER_SIZE, timeout=600):
+        """
+        Initialize the exporter object
+
+        Args:
+            host (str): the XAPI host (name or address, with optional :port)
+            session_ref (str): the reference of the logged-in session (session._session)
+            scheme (str): https / http
+            buffer_size (int): the size of the read buffer
+            timeout (int): the timeout (in seconds) of each socket operation
+        """
+        self._host = host
+        self._session_ref = session_ref
+        self._scheme = scheme
+        self._buffer = bytearray(buffer_size)
+        self._timeout = timeout
+
+    def _connect(self, scheme, host):
+        if scheme == "https":
+            # XAPI use self signed certificate by default
+            context = ssl._create_unverified_context()
+            return http.client.HTTPSConnection(host, timeout=self._timeout, context=context)
+        return http.client.HTTPConnection(host, timeout=self._timeout)
+
+    def _open(self, path, query, offset=0):
+        """
+        Send the export request, and follow the redirects to the host that run the export
+
+        Args:
+            path (str): the HTTP handler path
+            query (dict): the handler parameters
+            offset (int): request the body from this offset (HTTP range)
+
+        Return:
+            HTTPConnection, HTTPResponse, int : the connection, the response to read the export body from,
+                                                and the number of bytes to skip (the range was not honored)
+        """
+        query = dict(query, session_id=self._session_ref)
+        scheme, host = self._scheme, self._host
+        url = f"{path}?{urllib.parse.urlencode(query)}"
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+        for _ in range(MAX_REDIRECTS + 1):
+            conn = self._connect(scheme, host)
+            conn.request("GET", url, headers=headers)
+            response = conn.getresponse()
+            if response.status in (301, 302, 303, 307):
+                location = urllib.parse.urlsplit(response.getheader("Location", ""))
+                conn.close()
+                scheme = location.scheme or scheme
+                host = location.netloc or host
+                url = f"{location.path}?{location.query}"
+                logger.info(f"The export redirected to {host}")
+                continue
+            if response.status == 206 and offset > 0:
+                return conn, response, 0
+            if response.status != 200:
+                conn.close()
+                raise ExportError(f"The export {path} failed : {response.status} {response.reason}")
+            return conn, response, offset
+        raise ExportError(f"The export {path} failed : too many redirects")
+
+    def _skip(self, response, size):
+        """
+        Read and discard the start of the body (resume without HTTP range support)
+        """
+        while size > 0:
+            read = response.readinto(memoryview(self._buffer)[: min(size, len(self._buffer))])
+            if not read:
+                raise ExportError("The export ended before the resume offset")
+            size -= read
+
+    def _stream(self, path, query, stages, offset=0):
+        """
+        Stream the export body through the stages
+
+        Args:
+            path (str): the HTTP handler path
+            query (dict): the handler parameters
+            stages (list): the chain of stages, the last one should write the data
+            offset (int): resume the export from this offset (the stages already have the data before it)
+
+        Return:
+            dict : the export statistics : bytes, seconds, throughput (MB/Sec.)
+        """
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+        view = memoryview(self._buffer)
+        start = time.monotonic()
+        total = 0
+        try:
+            conn, response, skip = self._open(path, query, offset)
+            try:
+                if skip > 0:
+                    logger.info(f"The host does not support HTTP range, skipping {skip} bytes")
+                    self._skip(response, skip)
+                while True:
+                    size = response.readinto(self._buffer)
+                    if not size:
+                        break
+                    stages[0].write(view[:size])
+                    total += size
+                if response.length:
+                    # readinto() return 0 when the connection is closed before the end of the body
+                    raise ExportError(f"The export {path} ended {response.length} bytes before its end")
+            finally:
+                conn.close()
+            stages[0].close()
+        except Exception:
+            stages[0].abort()
+            raise
+        seconds = time.monotonic() - start
+        stats = {
+            "bytes": total,
+            "seconds": seconds,
+            "throughput": total / (1024 * 1024) / seconds if seconds > 0 else 0.0,
+        }
+        logger.info(f"Exported {total} bytes in {seconds:.1f} Sec. ({stats['throughput']:.1f} MB/Sec.)")
+        return stats
+
+    def export_vm(self, vm_uuid, stages):
+        """
+        Export VM (or VM snapshot) in XVA format
+
+        Args:
+            vm_uuid (str): the VM UUID
+            stages (list): the chain of stages, the last one should write the data
+
+        Return:
+            dict : the export statistics, see _stream()
+        """
+        return self._stream("/export", {"uuid": vm_uuid}, stages)
+
+    def export_metadata(self, vm_uuid, stages):
+        """
+        Export the VM metadata (like 'xe vm-export metadata=true'), a tar with the ova.xml
+
+        Args:
+            vm_uuid (str): the VM UUID
+            stages (list): the chain of stages, the last one should write the data
+
+        Return:
+            dict : the export statistics, see _stream()
+        """
+        return self._stream("/export_metadata", {"uuid": vm_uuid}, stages)
+
+    def export_vdi(self, vdi_uuid, stages, export_format="raw", offset=0):
+        """
+        Export VDI (or VDI snapshot)
+
+        Args:
+            vdi_uuid (str): the VDI UUID
+            stages (list): the chain of stages, the last one should write the data
+            export_format (str): raw / vhd
+            offset (int): resume a raw export from this offset
+
+        Return:
+            dict : the export statistics, see _stream()
+        """
+        return self._stream("/export_raw_vdi", {"vdi": vdi_uuid, "format": export_format}, stages, offset=offset)
+
+
+if __name__ == "__main__":
+    # run against a local HTTP stand-in that serve a synthetic image
+    import http.server
+    import tempfile
+    import threading
+
+    logging.basicConfig(level=logging.INFO)
+    image = os.urandom(1024 * 1024) * 16
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    checksum = ChecksumStage()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        exporter = HttpExporter(f"127.0.0.1:{server.server_port}", "OpaqueRef:demo", scheme="http")
+        print(exporter.export_vdi("vdi-uuid", [checksum, FileWriter(os.path.join(tmp_dir, "disk.raw"))]))
+    print(checksum.hexdigest() == hashlib.sha256(image).hexdigest())
+    server.shutdown()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""
+This module contain the integrity manifest of the backups.
+
+The export stream is hashed while it is written : the whole file, and each
+fixed size block of it, so a later verification can re-hash the blocks in
+parallel and point to the corrupted blocks (instead of one checksum of
+terabytes). The manifest (integrity.json) is written atomically into the
+backup directory, with an entry for each backup file in it :
+
+    {
+        "algorithm": "sha256",
+        "block_size": 4194304,
+        "files": {
+            "<name>": {"size": <bytes>, "hash": "<file hash>", "blocks": ["<block hash>", ...]}
+        }
+    }
+
+The size of the backup is taken from the manifest, instead of 'du' on the
+backup host.
+
+Usage :
+
+    python integrity.py verify <backup directory> [--workers N]
+"""
+# Built-in modules
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+
+# 3ed party modules
+
+# Local modules
+from exporter import ZERO_BLOCK, ChecksumStage, Stage, load_extents
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "integrity.json"
+ALGORITHMS = ["sha256", "blake2b"]
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_WORKERS = 4
+manifest_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(workers=DEFAULT_WORKERS):
+    """
+    Return:
+        ThreadPoolExecutor : the shared pool of the block hashing (hashlib release the GIL)
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="integrity")
+        return _executor
+
+
+def hash_block(algorithm, data):
+    return hashlib.new(algorithm, data).hexdigest()
+
+
+class IntegrityStage(ChecksumStage):
+    def __init__(self, algorithm="sha256", block_size=DEFAULT_BLOCK_SIZE, in_flight=8):
+        """
+        Calculate the checksum of the whole file, and of each block of it
+        (the blocks are hashed on the shared thread pool)
+
+        Args:
+            algorithm (str): the hashlib algorithm name (sha256 / blake2b)
+            block_size (int): the size of the blocks
+            in_flight (int): maximum blocks that are hashed at the same time
+        """
+        super().__init__(algorithm)
+        self.block_size = block_size
+        self._block = bytearray()
+        self._futures = collections.deque()
+        self._in_flight = in_flight
+        self.blocks = list()
+
+    def _submit(self, data):
+        while len(self._futures) >= self._in_flight:
+            self.blocks.append(self._futures.popleft().result())
+        self._futures.append(get_executor().submit(hash_block, self.algorithm, data))
+
+    def write(self, data):
+        super().write(data)
+        while len(data):
+            size = min(len(data), self.block_size - len(self._block))
+            if size == self.block_size:
+                self._submit(data[:size].tobytes())
+            else:
+                self._block += data[:size]
+                if len(self._block) == self.block_size:
+                    self._submit(bytes(self._block))
+                    self._block.clear()
+            data = data[size:]
+
+    def drain(self):
+        """
+        Wait for the blocks that are hashed
+
+        Return:
+            int : the size of the data that all its blocks are hashed (a multiple of the block size)
+        """
+        while self._futures:
+            self.blocks.append(self._futures.popleft().result())
+        return len(self.blocks) * self.block_size
+
+    def resume(self, path, blocks):
+        """
+        Continue the hashing of a file that was partially written : re-hash
+        its blocks, and stop at the first block that does not match the
+        blocks hashes of the checkpoint
+
+        Args:
+            path (str): the partially written file
+            blocks (list): the blocks hashes of the checkpoint
+
+        Return:
+            int : the verified offset, to continue writing from
+        """
+        file_hash = self._hash.copy()
+        verified = list()
+        with open(path, "rb") as fh:
+            for expected in blocks:
+                data = fh.read(self.block_size)
+                if len(data) != self.block_size or hash_block(self.algorithm, data) != expected:
+                    break
+                file_hash.update(data)
+                verified.append(expected)
+        # the stage is changed only when the file was read
+        self._hash = file_hash
+        self.blocks += verified
+        self.bytes_in += len(verified) * self.block_size
+        return self.bytes_in
+
+    def close(self):
+        if self._block:
+            self._submit(bytes(self._block))
+            self._block.clear()
+        self.drain()
+        super().close()
+
+    def entry(self):
+        """
+        Return:
+            dict : the manifest entry of the file, see the module documentation
+        """
+        return {"size": self.bytes_in, "hash": self.hexdigest(), "blocks": self.blocks}
+
+
+class _NullStage(Stage):
+    def write(self, data):
+        self.bytes_in += len(data)
+
+
+def hash_file(path, algorithm="sha256", block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Hash an existing file (the files that are not written by this script)
+
+    Return:
+        dict : the manifest entry of the file, see the module documentation
+    """
+    stage = IntegrityStage(algorithm, block_size)
+    stage.next = _NullStage()
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(path, "rb") as fh:
+        while True:
+            size = fh.readinto(buffer)
+            if not size:
+                break
+            stage.write(view[:size])
+    stage.close()
+    return stage.entry()
+
+
+def load_manifest(backup_dir):
+    """
+    Args:
+        backup_dir (str): the backup directory
+
+    Return:
+        dict : the integrity manifest, None if the directory has no manifest
+    """
+    try:
+        with open(os.path.join(backup_dir, MANIFEST_FILE), "r") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def add_file(backup_dir, name, entry, algorithm, block_size):
+    """
+    Add (or replace) the entry of a backup file in the manifest, the manifest
+    is replaced atomically
+
+    Args:
+        backup_dir (str): the backup directory
+        name (str): the backup file name
+        entry (dict): the file entry, see IntegrityStage.entry()
+        algorithm (str): the hashlib algorithm name
+        block_size (int): the size of the blocks
+    """
+    path = os.path.join(backup_dir, MANIFEST_FILE)
+    with manifest_lock:
+        manifest = load_manifest(backup_dir) or {"algorithm": algorithm, "block_size": block_size, "files": {}}
+        if manifest["algorithm"] != algorithm or manifest["block_size"] != block_size:
+            raise ValueError(f"{path} use {manifest['algorithm']} / {manifest['block_size']} blocks")
+        manifest["files"][name] = entry
+        tmp_path = f"{path}.part"
+        with open(tmp_path, "w") as fh:
+            json.dump(manifest, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, path)
+
+
+def manifest_size(backup_dir):
+    """
+    Return:
+        int : the total size in bytes of the backup files in the manifest, None if there is no manifest
+    """
+    manifest = load_manifest(backup_dir)
+    if manifest is None:
+        return None
+    return sum(entry["size"] for entry in manifest["files"].values())
+
+
+def _in_hole(extents, ends, offset, size):
+    """
+    Args:
+        extents (list): the image data extents (sorted), None for image without extents map
+        ends (list): the end offsets of the extents
+
+    Return:
+        bool : True if the block has no data in the image extents map (all zeros)
+    """
+    if extents is None:
+        return False
+    index = bisect.bisect_right(ends, offset)
+    return index == len(extents) or extents[index][0] >= offset + size
+
+
+def _verify_block(path, algorithm, offset, size, expected, extents, ends):
+    if _in_hole(extents, ends, offset, size):
+        data = ZERO_BLOCK * (size // len(ZERO_BLOCK)) + ZERO_BLOCK[: size % len(ZERO_BLOCK)]
+    else:
+        with open(path, "rb") as fh:
+            data = os.pread(fh.fileno(), size, offset)
+    return hash_block(algorithm, data) == expected
+
+
+def verify(backup_dir, workers=DEFAULT_WORKERS):
+    """
+    Re-hash the blocks of the backup files in parallel, and compare them to the manifest.
+    The blocks in the holes of sparse images are not read.
+
+    Args:
+        backup_dir (str): the backup directory
+        workers (int): the number of the hashing threads
+
+    Return:
+        list : the errors - (file name, block number or None for the file, description), empty if valid
+
+    Raises:
+        FileNotFoundError : if the directory has no manifest
+    """
+    manifest = load_manifest(backup_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {MANIFEST_FILE} in {backup_dir}")
+    algorithm, block_size = manifest["algorithm"], manifest["block_size"]
+    errors = list()
+    futures = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, entry in sorted(manifest["files"].items()):
+            path = os.path.join(backup_dir, name)
+            try:
+                size = os.path.getsize(path)
+            except OSError as ex:
+                errors.append((name, None, f"cannot read : {ex}"))
+                continue
+            if size != entry["size"]:
+                errors.append((name, None, f"size {size}, expected {entry['size']}"))
+                continue
+            extents = load_extents(path)
+            ends = [start + length for start, length in extents] if extents is not None else None
+            for block, expected in enumerate(entry["blocks"]):
+                offset = block * block_size
+                length = min(block_size, size - offset)
+                future = executor.submit(_verify_block, path, algorithm, offset, length, expected, extents, ends)
+                futures[future] = (name, block)
+        for future in concurrent.futures.as_completed(futures):
+            name, block = futures[future]
+            try:
+                if not future.result():
+                    errors.append((name, block, f"checksum mismatch at offset {block * block_size}"))
+            except OSError as ex:
+                errors.append((name, block, f"cannot read : {ex}"))
+    return sorted(errors, key=lambda error: (error[0], -1 if error[1] is None else error[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify a backup directory with its integrity manifest")
+    parser.add_argument("action", choices=["verify"])
+    parser.add_argument("backup_dir", help="the backup directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    try:
+        errors = verify(args.backup_dir, workers=args.workers)
+    except FileNotFoundError as ex:
+        print(ex)
+        sys.exit(2)
+    for name, block, description in errors:
+        print(f"{name} block {block} : {description}" if block is not None else f"{name} : {description}")
+    print(f"{args.backup_dir} : {'valid' if not errors else f'{len(errors)} error(s)'}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+"""
+This module contain the inventory of the pool objects, loaded in bulk.
+
+Instead of one XenAPI round trip per object and field (VM.get_record,
+VBD.get_record, VDI.get_record ... for every VM), the inventory load all the
+records of each class with one get_all_records call, keep only the fields the
+backups use (as compact named tuples), and index them :
+
+    by reference    - the record of an object
+    by UUID         - the reference of an object
+    by name-label   - the references of the VMs with a name
+    by parent       - the VBDs / VIFs of a VM (by the VBD.VM / VIF.VM fields)
+
+    inventory = Inventory(xapi)
+    inventory.load()
+    vm_ref = inventory.vms_by_name("vm1")[0]
+    for vbd in inventory.vm_vbds(vm_ref):
+        print(inventory.get("VDI", vbd.VDI).virtual_size)
+
+The inventory is a snapshot of the pool at load time, the objects that are
+created during the run (the backup snapshots) are not in it.
+
+The inventory can be persisted in an InventoryCache (sqlite3), with the
+XenAPI event.from token of the snapshot. The next run restore the records
+from the cache and apply only the events since that token (sync), instead
+of reading the whole pool again :
+
+    inventory = load_inventory(xapi, "/var/log/vmbackup-inventory.db", pool="xen1")
+"""
+# Built-in modules
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# 3ed party modules
+
+# Local modules
+
+logger = logging.getLogger(__name__)
+
+# the fields of each class that are kept in the inventory
+FIELDS = {
+    "VM": [
+        "uuid",
+        "name_label",
+        "is_a_snapshot",
+        "is_a_template",
+        "is_control_domain",
+        "power_state",
+        "resident_on",
+        "affinity",
+        "VBDs",
+        "VIFs",
+        "tags",
+        "other_config",
+    ],
+    "VBD": ["uuid", "VM", "VDI", "device", "userdevice", "bootable", "mode", "type", "unpluggable", "empty"],
+    "VDI": [
+        "uuid",
+        "name_label",
+        "name_description",
+        "virtual_size",
+        "physical_utilisation",
+        "type",
+        "sharable",
+        "read_only",
+        "SR",
+    ],
+    "SR": ["uuid", "name_label"],
+    "host": ["uuid", "name_label"],
+    "VIF": ["uuid", "VM", "device", "MTU", "MAC", "other_config", "network"],
+    "network": ["uuid", "name_label"],
+}
+RECORDS = {name: collections.namedtuple(f"{name}Record", ["ref"] + fields) for name, fields in FIELDS.items()}
+# the event.from class names (lower case) -> the inventory class names
+EVENT_CLASSES = {name.lower(): name for name in FIELDS}
+
+
+class Inventory:
+    def __init__(self, xapi):
+        """
+        Args:
+            xapi (object): the XenAPI session proxy (session.xenapi)
+        """
+        self._xapi = xapi
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.token = ""  # the event.from token of the inventory snapshot, "" if unknown
+        self._changed = set()  # the (class, ref) that were changed since the last take_changes()
+        self._records = {name: {} for name in FIELDS}  # class -> ref -> record
+        self._uuids = {name: {} for name in FIELDS}  # class -> uuid -> ref
+        self._vm_names = collections.defaultdict(list)  # name-label -> VM refs
+        self._children = collections.defaultdict(list)  # (class, parent ref) -> records
+
+    def load(self):
+        """
+        Load all the records of the inventory classes (one call per class) and build the indexes
+        """
+        start = time.monotonic()
+        records = {name: getattr(self._xapi, name).get_all_records() for name in FIELDS}
+        self.add_records(records)
+        self.loaded = True
+        logger.info(
+            f"Inventory loaded in {time.monotonic() - start:.2f} Sec. : "
+            + ", ".join(f"{len(self._records[name])} {name}" for name in FIELDS)
+        )
+
+    def add_records(self, records):
+        """
+        Add (or replace) records in the inventory
+
+        Args:
+            records (dict): class name -> {ref: the XenAPI record}
+        """
+        with self._lock:
+            for name, objects in records.items():
+                record_type = RECORDS[name]
+                for ref, record in objects.items():
+                    self._remove(name, ref)
+                    item = record_type(ref, *[record.get(field) for field in FIELDS[name]])
+                    self._records[name][ref] = item
+                    self._changed.add((name, ref))
+                    self._uuids[name][item.uuid] = ref
+                    if name == "VM":
+                        self._vm_names[item.name_label].append(ref)
+                    elif name in ["VBD", "VIF"]:
+                        self._children[(name, item.VM)].append(item)
+
+    def remove(self, name, ref):
+        """
+        Remove an object from the inventory
+
+        Args:
+            name (str): the class name
+            ref (str): the object reference
+        """
+        with self._lock:
+            self._remove(name, ref)
+
+    def _remove(self, name, ref):
+        item = self._records[name].pop(ref, None)
+        if item is None:
+            return
+        self._changed.add((name, ref))
+        self._uuids[name].pop(item.uuid, None)
+        if name == "VM":
+            self._vm_names[item.name_label].remove(ref)
+        elif name in ["VBD", "VIF"]:
+            self._children[(name, item.VM)].remove(item)
+
+    def sync(self, timeout=0.0):
+        """
+        Apply the pool events since the inventory token (with an empty token, all
+        the objects of the pool are returned as 'add' events, like a full load)
+
+        Args:
+            timeout (float): how long to wait (in seconds) for events, 0 to return immediately
+
+        Return:
+            int : the number of the events that were applied
+        """
+        start = time.monotonic()
+        result = getattr(self._xapi.event, "from")(list(EVENT_CLASSES), self.token, float(timeout))
+        added, removed = dict(), list()
+        for event in result.get("events", []):
+            name = EVENT_CLASSES.get(event.get("class", "").lower())
+            if name is None:
+                continue
+            if event.get("operation") == "del":
+                removed.append((name, event["ref"]))
+                added.get(name, {}).pop(event["ref"], None)
+            elif "snapshot" in event:
+                added.setdefault(name, {})[event["ref"]] = event["snapshot"]
+        for name, ref in removed:
+            self.remove(name, ref)
+        self.add_records(added)
+        self.token = result["token"]
+        self.loaded = True
+        events = len(result.get("events", []))
+        logger.info(f"Inventory synced with {events} events in {time.monotonic() - start:.2f} Sec.")
+        return events
+
+    def take_changes(self):
+        """
+        Return:
+            set : the (class, ref) that were added, changed or removed since the last call
+        """
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            return changed
+
+    def get(self, name, ref):
+        """
+        Args:
+            name (str): the class name (VM / VBD / VDI / SR / host / VIF / network)
+            ref (str): the object reference
+
+        Return:
+            namedtuple : the record of the object (with its ref), None if it is not in the inventory
+        """
+        return self._records[name].get(ref)
+
+    def by_uuid(self, name, uuid):
+        """
+        Return:
+            namedtuple : the record of the object with the UUID, None if it is not in the inventory
+        """
+        return self.get(name, self._uuids[name].get(uuid))
+
+    def records(self, name):
+        """
+        Return:
+            list : all the records of the class
+        """
+        return list(self._records[name].values())
+
+    def vms_by_name(self, name_label, snapshots=False):
+        """
+        Args:
+            name_label (str): the VM name-label
+            snapshots (bool): include the snapshots with this name-label
+
+        Return:
+            list : the references of the VMs with the name-label
+        """
+        return [
+            ref for ref in self._vm_names.get(name_label, []) if snapshots or not self._records["VM"][ref].is_a_snapshot
+        ]
+
+    def vms(self):
+        """
+        Return:
+            list : the records of the VMs (not templates, snapshots or control domains)
+        """
+        return [
+            vm
+            for vm in self._records["VM"].values()
+            if not (vm.is_a_snapshot or vm.is_a_template or vm.is_control_domain)
+        ]
+
+    def vm_names(self):
+        """
+        Return:
+            list : the sorted name-labels of the VMs (not templates, snapshots or control domains)
+        """
+        return sorted({vm.name_label for vm in self.vms()})
+
+    def duplicates(self):
+        """
+        Return:
+            dict : name-label -> the references, of the names with more than one VM (not snapshot)
+        """
+        duplicates = dict()
+        for name in self._vm_names:
+            refs = self.vms_by_name(name)
+            if len(refs) > 1:
+                duplicates[name] = refs
+        return duplicates
+
+    def vm_vbds(self, vm_ref):
+        """
+        Return:
+            list : the VBD records of the VM
+        """
+        return list(self._children.get(("VBD", vm_ref), []))
+
+    def vm_vifs(self, vm_ref):
+        """
+        Return:
+            list : the VIF records of the VM
+        """
+        return list(self._children.get(("VIF", vm_ref), []))
+
+    def vm_disks(self, vm_ref):
+        """
+        Return:
+            list : the (VBD record, VDI record) of the disks of the VM
+        """
+        disks = list()
+        for vbd in self.vm_vbds(vm_ref):
+            vdi = self.get("VDI", vbd.VDI)
+            if vbd.type.lower() == "disk" and vdi is not None:
+                disks.append((vbd, vdi))
+        return disks
+
+
+class InventoryCache:
+    def __init__(self, path, pool=""):
+        """
+        Open (or create) the inventory cache
+
+        Args:
+            path (str): the sqlite3 database file
+            pool (str): the identity of the pool (the master address), the cache of
+                        another pool (or of other inventory fields) is discarded
+        """
+        self.path = path
+        self._identity = json.dumps({"pool": pool, "fields": FIELDS}, sort_keys=True)
+        self._db = sqlite3.connect(path, timeout=60)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS objects "
+                "(class TEXT, ref TEXT, record TEXT NOT NULL, PRIMARY KEY (class, ref))"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def _state(self):
+        return dict(self._db.execute("SELECT key, value FROM state"))
+
+    def restore(self, inventory):
+        """
+        Load the cached records into the inventory
+
+        Args:
+            inventory (Inventory): an empty inventory
+
+        Return:
+            bool : True if the cache was restored, False if it is empty or of another pool
+        """
+        state = self._state()
+        if state.get("identity") != self._identity or not state.get("token"):
+            return False
+        records = {name: {} for name in FIELDS}
+        for name, ref, record in self._db.execute("SELECT class, ref, record FROM objects"):
+            records[name][ref] = dict(zip(FIELDS[name], json.loads(record)))
+        inventory.add_records(records)
+        inventory.take_changes()
+        inventory.token = state["token"]
+        return True
+
+    def save(self, inventory):
+        """
+        Write the records that were changed since the last save (or restore), and the inventory token
+
+        Args:
+            inventory (Inventory): the inventory
+        """
+        changed = inventory.take_changes()
+        with self._db:
+            if self._state().get("identity") != self._identity:
+                self._db.execute("DELETE FROM objects")
+                changed = {(name, record.ref) for name in FIELDS for record in inventory.records(name)}
+            for name, ref in changed:
+                record = inventory.get(name, ref)
+                if record is None:
+                    self._db.execute("DELETE FROM objects WHERE class = ? AND ref = ?", (name, ref))
+                else:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO objects (class, ref, record) VALUES (?, ?, ?)",
+                        (name, ref, json.dumps(record[1:])),
+                    )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                [("identity", self._identity), ("token", inventory.token)],
+            )
+
+    def close(self):
+        self._db.close()
+
+
+def load_inventory(xapi, cache_path="", pool=""):
+    """
+    Load the inventory, from the cache and the events since the last run if there is a cache
+
+    Args:
+        xapi (object): the XenAPI session proxy (session.xenapi)
+        cache_path (str): the inventory cache file, "" to read the whole pool (get_all_records)
+        pool (str): the identity of the pool of the cache
+
+    Return:
+        Inventory : the loaded inventory
+    """
+    inventory = Inventory(xapi)
+    if not cache_path:
+        inventory.load()
+        return inventory
+    try:
+        cache = InventoryCache(cache_path, pool)
+        try:
+            restored = cache.restore(inventory)
+            try:
+                inventory.sync()
+            except Exception as ex:
+                if not restored:
+                    raise
+                # the token expired (EVENTS_LOST) or is invalid, start over from a full snapshot
+                logger.warning(f"Cannot apply the events since the last run ({ex}), reloading the inventory")
+                inventory = Inventory(xapi)
+                inventory.sync()
+            cache.save(inventory)
+        finally:
+            cache.close()
+    except sqlite3.Error as ex:
+        logger.warning(f"Cannot use the inventory cache {cache_path} : {ex}")
+        if not inventory.loaded:
+            inventory = Inventory(xapi)
+            inventory.load()
+    return inventory
+
+
+if __name__ == "__main__":
+    import os
+    import random
+    import tempfile
+    import types
+
+    logging.basicConfig(level=logging.INFO)
+
+    class FakeClass:
+        def __init__(self, records):
+            self._records = records
+
+        def get_all_records(self):
+            return self._records
+
+    # a pool with 5000 VMs, each with 2 disks and a VIF
+    pool = {name: {} for name in FIELDS}
+    pool["SR"]["sr"] = {"uuid": "sr-uuid", "name_label": "storage"}
+    pool["network"]["net"] = {"uuid": "net-uuid", "name_label": "network"}
+    for i in range(5000):
+        vm = f"vm{i}"
+        pool["VM"][vm] = {"uuid": f"{vm}-uuid", "name_label": f"vm-{i % 4990}", "is_a_snapshot": False}
+        pool["VIF"][f"vif{i}"] = {"uuid": f"vif{i}-uuid", "VM": vm, "device": "0", "network": "net"}
+        for disk in range(2):
+            pool["VBD"][f"vbd{i}-{disk}"] = {"uuid": "", "VM": vm, "VDI": f"vdi{i}-{disk}", "type": "Disk"}
+            pool["VDI"][f"vdi{i}-{disk}"] = {"uuid": f"vdi{i}-{disk}", "virtual_size": "1073741824", "SR": "sr"}
+    fake_xapi = type("FakeXenAPI", (), {name: FakeClass(records) for name, records in pool.items()})()
+    # event.from - all the objects on the first call, no events after that
+    events = [
+        {"class": name.lower(), "operation": "add", "ref": ref, "snapshot": record}
+        for name, records in pool.items()
+        for ref, record in records.items()
+    ]
+    event_from = lambda classes, token, timeout: {"events": events, "token": "1"}  # noqa: E731
+    fake_xapi.event = types.SimpleNamespace(**{"from": event_from})
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "inventory.db")
+        # the first run read all the objects, the second run restore them from the cache (no new events)
+        for run in ["first", "second"]:
+            start = time.perf_counter()
+            inventory = load_inventory(fake_xapi, cache_path, pool="demo")
+            seconds = time.perf_counter() - start
+            print(f"{run} run: inventory of {len(inventory.records('VM'))} VMs loaded in {seconds:.3f} Sec.")
+            events = []
+    start = time.perf_counter()
+    for _ in range(10000):
+        vm_ref = random.choice(inventory.vms_by_name(f"vm-{random.randrange(4990)}"))
+        size = sum(int(vdi.virtual_size) for _, vdi in inventory.vm_disks(vm_ref))
+    print(f"10000 lookups in {time.perf_counter() - start:.3f} Sec., {len(inventory.duplicates())} duplicate names")
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+This module contain a minimal NBD (Network Block Device) client, for reading
+only the changed blocks of the incremental (CBT) backups.
+
+The XAPI HTTP handler /export_raw_vdi can only stream the whole disk, so a
+delta backup that read it transfer (and read on the host) the full disk, and
+drop the unchanged blocks on this side. XAPI also serve the VDIs over NBD
+(VDI.get_nbd_info), when a pool network has the 'nbd' (TLS) or
+'insecure_nbd' purpose :
+
+    xe network-param-add param-name=purpose param-key=nbd uuid=<network uuid>
+
+and NBD read any range of the disk, so only the changed blocks are read :
+
+    client = NbdClient.connect(backend.vdi_nbd_info(snap_uuid))
+    stats = read_runs(client, cbt.changed_runs(bitmap, client.size), stages)
+
+Only the parts of the protocol that are needed are implemented - the fixed
+newstyle handshake, STARTTLS, the GO (or EXPORT_NAME) option, and the simple
+replies of the READ command.
+"""
+# Built-in modules
+import logging
+import socket
+import ssl
+import struct
+import time
+
+# 3ed party modules
+
+# Local modules
+from exporter import ExportError
+
+logger = logging.getLogger(__name__)
+
+NBD_PORT = 10809
+NBDMAGIC = b"NBDMAGIC"
+IHAVEOPT = 0x49484156454F5054
+REPLY_MAGIC = 0x0003E889045565A9
+REQUEST_MAGIC = 0x25609513
+SIMPLE_REPLY_MAGIC = 0x67446698
+# handshake flags
+FLAG_FIXED_NEWSTYLE = 0x01
+FLAG_NO_ZEROES = 0x02
+# options
+OPT_EXPORT_NAME = 1
+OPT_STARTTLS = 5
+OPT_GO = 7
+# option replies
+REP_ACK = 1
+REP_INFO = 3
+REP_ERR_UNSUP = 0x80000001
+INFO_EXPORT = 0
+# commands
+CMD_READ = 0
+CMD_DISC = 2
+# the largest read request (the servers limit the request size, 32 MiB is the usual limit)
+MAX_READ = 4 * 1024 * 1024
+
+
+class NbdError(ExportError):
+    pass
+
+
+class NbdClient:
+    def __init__(self, address, port, export_name, cert="", subject="", timeout=600):
+        """
+        Connect to the NBD server, and open the export
+
+        Args:
+            address (str): the NBD server address
+            port (int): the NBD server port
+            export_name (str): the export name
+            cert (str): the PEM certificate of the server, TLS is used if it is set
+            subject (str): the name in the server certificate
+            timeout (int): the timeout (in seconds) of each socket operation
+
+        Raises:
+            NbdError : if the server cannot be connected, or refuse the export
+            OSError : on connection failure
+        """
+        self.size = 0
+        self._handle = 0
+        self._sock = socket.create_connection((address, port), timeout=timeout)
+        try:
+            self._handshake(export_name, cert, subject or address)
+        except Exception:
+            self._sock.close()
+            raise
+
+    @classmethod
+    def connect(cls, servers, timeout=600):
+        """
+        Connect to the first NBD server that answer
+
+        Args:
+            servers (list): the VDI.get_nbd_info records : address, port, exportname, cert, subject
+            timeout (int): the timeout (in seconds) of each socket operation
+
+        Return:
+            NbdClient : the connected client, None if no server can be connected
+        """
+        for server in servers:
+            try:
+                return cls(
+                    server["address"],
+                    int(server.get("port", NBD_PORT)),
+                    server["exportname"],
+                    cert=server.get("cert", ""),
+                    subject=server.get("subject", ""),
+                    timeout=timeout,
+                )
+            except (OSError, NbdError) as ex:
+                logger.warning(f"Cannot connect to the NBD server {server.get('address')} : {ex}")
+        return None
+
+    def _recv(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise NbdError("The NBD server closed the connection")
+            data += chunk
+        return bytes(data)
+
+    def _recv_into(self, view):
+        while len(view):
+            size = self._sock.recv_into(view)
+            if not size:
+                raise NbdError("The NBD server closed the connection")
+            view = view[size:]
+
+    def _option(self, option, data=b""):
+        self._sock.sendall(struct.pack(">QII", IHAVEOPT, option, len(data)) + data)
+
+    def _option_reply(self, option):
+        magic, reply_option, reply, length = struct.unpack(">QIII", self._recv(20))
+        if magic != REPLY_MAGIC or reply_option != option:
+            raise NbdError(f"Invalid NBD option reply ({magic:#x}, {reply_option})")
+        return reply, self._recv(length)
+
+    def _handshake(self, export_name, cert, subject):
+        magic, opt_magic, flags = struct.unpack(">8sQH", self._recv(18))
+        if magic != NBDMAGIC or opt_magic != IHAVEOPT or not flags & FLAG_FIXED_NEWSTYLE:
+            raise NbdError("The server does not speak the fixed newstyle NBD protocol")
+        no_zeroes = flags & FLAG_NO_ZEROES
+        self._sock.sendall(struct.pack(">I", FLAG_FIXED_NEWSTYLE | no_zeroes))
+        if cert:
+            self._option(OPT_STARTTLS)
+            reply, _ = self._option_reply(OPT_STARTTLS)
+            if reply != REP_ACK:
+                raise NbdError(f"The NBD server refused TLS ({reply:#x})")
+            context = ssl.create_default_context(cadata=cert)
+            self._sock = context.wrap_socket(self._sock, server_hostname=subject)
+
+        name = export_name.encode()
+        self._option(OPT_GO, struct.pack(">I", len(name)) + name + struct.pack(">H", 0))
+        while True:
+            reply, data = self._option_reply(OPT_GO)
+            if reply == REP_INFO and struct.unpack(">H", data[:2])[0] == INFO_EXPORT:
+                self.size = struct.unpack(">Q", data[2:10])[0]
+            elif reply == REP_ACK:
+                return
+            elif reply == REP_ERR_UNSUP:
+                break
+            elif reply & 0x80000000:
+                raise NbdError(f"The NBD server refused the export {export_name} ({reply:#x}): {data!r}")
+        # old server, without the GO option
+        self._option(OPT_EXPORT_NAME, name)
+        self.size = struct.unpack(">QH", self._recv(10))[0]
+        if not no_zeroes:
+            self._recv(124)
+
+    def read(self, offset, view):
+        """
+        Read from the export
+
+        Args:
+            offset (int): the offset to read from
+            view (memoryview): the buffer to read into, all of it is filled
+        """
+        self._handle += 1
+        self._sock.sendall(struct.pack(">IHHQQI", REQUEST_MAGIC, 0, CMD_READ, self._handle, offset, len(view)))
+        magic, error, handle = struct.unpack(">IIQ", self._recv(16))
+        if magic != SIMPLE_REPLY_MAGIC or handle != self._handle:
+            raise NbdError(f"Invalid NBD reply ({magic:#x}, handle {handle})")
+        if error:
+            raise NbdError(f"NBD read of {len(view)} bytes at {offset} failed ({error})")
+        self._recv_into(view)
+
+    def close(self):
+        """
+        Disconnect from the server
+        """
+        try:
+            self._sock.sendall(struct.pack(">IHHQQI", REQUEST_MAGIC, 0, CMD_DISC, self._handle + 1, 0, 0))
+        except OSError:
+            pass
+        self._sock.close()
+
+
+def read_runs(client, runs, stages, buffer_size=MAX_READ):
+    """
+    Read the runs of the export through the stages, one after the other
+
+    Args:
+        client (NbdClient): the connected client
+        runs (iterable): the (offset, length) runs to read
+        stages (list): the chain of stages, the last one should write the data
+        buffer_size (int): the largest read request
+
+    Return:
+        dict : the read statistics : bytes, seconds, throughput (MB/Sec.)
+    """
+    for stage, next_stage in zip(stages, stages[1:]):
+        stage.next = next_stage
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    start = time.monotonic()
+    total = 0
+    try:
+        for offset, length in runs:
+            while length > 0:
+                size = min(length, buffer_size)
+                client.read(offset, view[:size])
+                stages[0].write(view[:size])
+                offset += size
+                length -= size
+                total += size
+        stages[0].close()
+    except Exception:
+        stages[0].abort()
+        raise
+    seconds = time.monotonic() - start
+    stats = {
+        "bytes": total,
+        "seconds": seconds,
+        "throughput": total / (1024 * 1024) / seconds if seconds > 0 else 0.0,
+    }
+    logger.info(f"Read {total} bytes over NBD in {seconds:.1f} Sec. ({stats['throughput']:.1f} MB/Sec.)")
+    return stats
+
+
+if __name__ == "__main__":
+    import hashlib
+    import sys
+
+    # python nbd.py <address> <port> <export name> : read the start of an export (insecure_nbd)
+    logging.basicConfig(level=logging.INFO)
+    client = NbdClient(sys.argv[1], int(sys.argv[2]), sys.argv[3])
+    data = bytearray(min(client.size, 1024 * 1024))
+    client.read(0, memoryview(data))
+    client.close()
+    print(client.size, hashlib.sha256(data).hexdigest())
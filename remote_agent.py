@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+This module is the remote helper agent that run on the Xen server (dom0).
+
+The agent is started once per run (see agent.RemoteAgent) and read batched
+requests from its STDIN, one JSON list of operations per line, and write the
+results to its STDOUT as one JSON list per line, in the same order.
+
+Every operation is a dictionary with the 'op' key and its arguments:
+
+    mkdir        path                        - create directory (and parents)
+    write_file   path, data, [append]        - atomic write (or append) of a text file
+    read_file    path                        - the content of a text file
+    touch        path                        - create an empty file / update its (or the directory) time
+    stat         path                        - existence, type, size and disk usage
+    list         path, [glob]                - sorted list of names in a directory (without the hidden names, like ls)
+    remove_tree  paths                       - delete files / directories trees
+    df           path                        - file-system capacity
+
+Every result is a dictionary with the 'ok' key, the 'error' key in case of
+failure and the operation specific output.
+
+Note: this module must not use any non built-in module, it is sent as is to
+the remote python interpreter.
+"""
+# Built-in modules
+import fnmatch
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+# 3ed party modules
+
+# Local modules
+
+
+def op_mkdir(path):
+    os.makedirs(path, exist_ok=True)
+    return {}
+
+
+def op_write_file(path, data, append=False):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    if append:
+        with open(path, "a") as fh:
+            fh.write(data)
+        return {}
+    # write to temporary file in the same directory and rename it, so the file
+    # is never seen partially written
+    fd, tmp_name = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, path)
+    except Exception:
+        os.unlink(tmp_name)
+        raise
+    return {}
+
+
+def op_read_file(path):
+    with open(path, "r") as fh:
+        return {"data": fh.read()}
+
+
+def op_touch(path):
+    if not os.path.isdir(path):
+        # like touch, create the file if it does not exist (a directory time is only updated)
+        with open(path, "a"):
+            pass
+    os.utime(path, None)
+    return {}
+
+
+def _disk_usage(path):
+    if not os.path.isdir(path):
+        return os.lstat(path).st_blocks * 512
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            total += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return total
+
+
+def op_stat(path):
+    if not os.path.lexists(path):
+        return {"exists": False}
+    st = os.stat(path)
+    return {
+        "exists": True,
+        "is_dir": os.path.isdir(path),
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "usage": _disk_usage(path),
+    }
+
+
+def _list_dir(path, pattern="*"):
+    # like ls and the shell globs, the names that start with '.' are hidden (temporary files,
+    # chunk store, checkpoints), unless the pattern itself starts with '.'
+    names = fnmatch.filter(os.listdir(path), pattern)
+    if not pattern.startswith("."):
+        names = [name for name in names if not name.startswith(".")]
+    return names
+
+
+def op_list(path, glob=""):
+    if not os.path.isdir(path):
+        return {"names": []}
+    if glob == "":
+        return {"names": sorted(_list_dir(path))}
+    # the glob can contain directories levels, like : '*/success*'
+    names = [""]
+    for part in glob.split("/"):
+        names = [
+            os.path.join(name, entry)
+            for name in names
+            if os.path.isdir(os.path.join(path, name))
+            for entry in _list_dir(os.path.join(path, name), part)
+        ]
+    return {"names": sorted(names)}
+
+
+def op_remove_tree(paths):
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+    return {}
+
+
+def op_df(path):
+    st = os.statvfs(path)
+    return {
+        "total": st.f_blocks * st.f_frsize,
+        "avail": st.f_bavail * st.f_frsize,
+        "used": (st.f_blocks - st.f_bfree) * st.f_frsize,
+    }
+
+
+OPERATIONS = {
+    "mkdir": op_mkdir,
+    "write_file": op_write_file,
+    "read_file": op_read_file,
+    "touch": op_touch,
+    "stat": op_stat,
+    "list": op_list,
+    "remove_tree": op_remove_tree,
+    "df": op_df,
+}
+
+
+def handle(request):
+    """
+    Run one operation
+
+    Args:
+        request (dict): the operation name ('op') and its arguments
+
+    Return:
+        dict : the operation results, 'ok' is False in case of failure
+    """
+    args = dict(request)
+    try:
+        result = OPERATIONS[args.pop("op")](**args)
+        result["ok"] = True
+    except Exception as ex:
+        result = {"ok": False, "error": f"{type(ex).__name__}: {ex}"}
+    return result
+
+
+def main():
+    for line in sys.stdin:
+        if line.strip() == "":
+            continue
+        try:
+            results = [handle(request) for request in json.loads(line)]
+        except ValueError as ex:
+            results = [{"ok": False, "error": f"Invalid request: {ex}"}]
+        sys.stdout.write(json.dumps(results) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+This module contain the retention policy of the backups : which backup
+directories of a VM are kept, and which are deleted.
+
+The policy has grandfather-father-son tiers :
+
+    last        - the newest backups (max_backups)
+    daily       - the newest backup of each of the last days with backups
+    weekly      - the newest backup of each of the last (ISO) weeks with backups
+    monthly     - the newest backup of each of the last months with backups
+
+A backup is kept if any tier keeps it. The policy of a section is set by
+max_backups, keep_daily, keep_weekly and keep_monthly, and can be overridden
+per VM, by the max_backups override of vm-export / vdi-export :
+
+    vm1:3           - keep the last 3 backups (and the section daily / weekly / monthly tiers)
+    vm1:3/7/4/12    - keep the last 3, 7 daily, 4 weekly and 12 monthly backups
+
+The whole delete set is computed in memory, from one listing of the VM
+backups directory (see plan()).
+"""
+# Built-in modules
+import collections
+import datetime
+import logging
+
+# 3ed party modules
+
+# Local modules
+from cbt import chain_dependencies
+
+logger = logging.getLogger(__name__)
+
+# the backup directory name format, see create_full_backup_dir()
+DIR_FORMAT = "backup-%Y%m%d-%H%M%S"
+
+Policy = collections.namedtuple("Policy", ["last", "daily", "weekly", "monthly"])
+
+
+def parse_policy(value, default):
+    """
+    Args:
+        value (str): the policy override : <last>[/<daily>[/<weekly>[/<monthly>]]], "" for no override
+        default (Policy): the section policy, for the tiers that are not in the override
+
+    Return:
+        Policy : the policy
+
+    Raises:
+        ValueError : if the override is invalid (non-numeric, or not positive number of last backups)
+    """
+    if value == "":
+        return default
+    values = [int(part) for part in value.split("/")]
+    if len(values) > len(Policy._fields) or values[0] < 1 or min(values) < 0:
+        raise ValueError(f"invalid retention: {value}")
+    return Policy(*(values + list(default[len(values) :])))
+
+
+def backup_time(name):
+    """
+    Args:
+        name (str): the backup directory name
+
+    Return:
+        datetime : the backup time, None if the name is not a backup directory name
+    """
+    try:
+        return datetime.datetime.strptime(name, DIR_FORMAT)
+    except ValueError:
+        return None
+
+
+def select_keep(names, policy):
+    """
+    Select the backups that the policy keeps
+
+    Args:
+        names (list): the backup directory names
+        policy (Policy): the retention policy
+
+    Return:
+        set : the names of the backups to keep
+    """
+    backups = sorted(((backup_time(name), name) for name in names if backup_time(name)), reverse=True)
+    keep = {name for _, name in backups[: policy.last]}
+    tiers = [
+        (policy.daily, lambda time: time.date()),
+        (policy.weekly, lambda time: time.isocalendar()[:2]),
+        (policy.monthly, lambda time: (time.year, time.month)),
+    ]
+    for count, period in tiers:
+        periods = set()
+        for time, name in backups:
+            if len(periods) >= count:
+                break
+            if period(time) not in periods:
+                # the newest backup of the period
+                periods.add(period(time))
+                keep.add(name)
+    return keep
+
+
+def plan(dirs, marked, policy, states=None):
+    """
+    Compute the backup directories to delete
+
+    Only the successful backups (with the success marker) are kept by the
+    policy. The unsuccessful backups that are older than the newest successful
+    backup are deleted too, and the directories that are not named like
+    backups are never deleted.
+
+    Args:
+        dirs (list): all the backup directory names
+        marked (list): the names of the successful backups
+        policy (Policy): the retention policy
+        states (dict): the backup name -> its CBT state, the bases of the kept
+                       incremental backups are kept too (None if not incremental)
+
+    Return:
+        list, set : the names of the backups to delete (oldest first), and the names that
+                    are kept only because kept incremental backups depend on them
+    """
+    marked = set(marked)
+    successful = [name for name in dirs if name in marked and backup_time(name)]
+    keep = select_keep(successful, policy)
+    newest = max((backup_time(name) for name in successful), default=None)
+    if newest is None:
+        return [], set()
+    dependencies = set()
+    if states is not None:
+        # never remove a backup that the kept (delta) backups depend on
+        needed = chain_dependencies(states, sorted(keep))
+        dependencies = needed - keep
+        keep |= needed
+    to_remove = [
+        name
+        for name in dirs
+        if name not in keep and backup_time(name) is not None and backup_time(name) <= newest
+    ]
+    return sorted(to_remove, key=backup_time), dependencies
+
+
+if __name__ == "__main__":
+    # a daily backup for 100 days
+    start = datetime.datetime(2024, 1, 1, 1, 0, 0)
+    names = [(start + datetime.timedelta(days=day)).strftime(DIR_FORMAT) for day in range(100)]
+    removed, _ = plan(names + ["backup-failed"], names, parse_policy("3/7/4/3", Policy(3, 0, 0, 0)))
+    kept = [name for name in names if name not in removed]
+    print(f"{len(removed)} backups removed, {len(kept)} kept : {kept}")
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+"""
+This module contain a minimal S3 (and S3 compatible) client, with only the
+operations the backups need, signed with AWS signature version 4, over
+http.client (no SDK dependency).
+
+The export streams are uploaded by the S3Writer stage as multipart uploads :
+the stream is cut into parts, the parts are uploaded concurrently, and the
+number of the parts in flight is bounded, so the memory is bounded too
+(part_size * (in_flight + 1)).
+
+    client = S3Client("http://127.0.0.1:9000", "backups", access_key, secret_key)
+    stages = [ChecksumStage(), S3Writer(client, "xen/vm1/backup-20240101-010000/vm1.xva")]
+
+Run this module to try it against a local in-memory S3 stand-in :
+
+    python s3.py
+"""
+# Built-in modules
+import base64
+import concurrent.futures
+import datetime
+import hashlib
+import hmac
+import http.client
+import logging
+import threading
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+# 3ed party modules
+
+# Local modules
+from exporter import Stage
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB
+DEFAULT_PART_SIZE = 64 * MB
+DEFAULT_IN_FLIGHT = 4
+MAX_PARTS = 10000
+MAX_RETRIES = 3
+DELETE_BATCH = 1000
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+
+class S3Error(OSError):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def _quote(value, safe="-_.~"):
+    return urllib.parse.quote(value, safe=safe)
+
+
+def _strip_ns(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _find_all(element, name):
+    return [child for child in element.iter() if _strip_ns(child.tag) == name]
+
+
+def _text(element, name, default=""):
+    for child in element:
+        if _strip_ns(child.tag) == name:
+            return child.text or default
+    return default
+
+
+class S3Client:
+    def __init__(self, endpoint, bucket, access_key, secret_key, region="us-east-1", timeout=600):
+        """
+        Initialize the client (path style addressing : <endpoint>/<bucket>/<key>)
+
+        Args:
+            endpoint (str): the service URL (http(s)://host[:port])
+            bucket (str): the bucket name
+            access_key (str): the access key id
+            secret_key (str): the secret access key
+            region (str): the signing region
+            timeout (int): the timeout (in seconds) of each socket operation
+        """
+        url = urllib.parse.urlsplit(endpoint)
+        self._scheme = url.scheme or "https"
+        self._host = url.netloc or url.path
+        self.bucket = bucket
+        self._access_key = access_key
+        self._secret_key = secret_key
+        self._region = region
+        self._timeout = timeout
+        self._local = threading.local()  # a connection per thread
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self._scheme == "https":
+                conn = http.client.HTTPSConnection(self._host, timeout=self._timeout)
+            else:
+                conn = http.client.HTTPConnection(self._host, timeout=self._timeout)
+            self._local.conn = conn
+        return conn
+
+    def _sign(self, method, path, query, headers, payload_hash):
+        """
+        Add the AWS signature version 4 headers
+
+        Return:
+            dict : the request headers
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date = now.strftime("%Y%m%d")
+        headers = {name.lower(): value for name, value in headers.items()}
+        headers["host"] = self._host
+        headers["x-amz-date"] = amz_date
+        headers["x-amz-content-sha256"] = payload_hash
+        names = sorted(headers)
+        canonical_headers = "".join(f"{name}:{str(headers[name]).strip()}\n" for name in names)
+        signed_headers = ";".join(names)
+        canonical_query = "&".join(f"{_quote(key)}={_quote(str(value))}" for key, value in sorted(query.items()))
+        canonical_request = "\n".join(
+            [method, _quote(path, safe="/-_.~"), canonical_query, canonical_headers, signed_headers, payload_hash]
+        )
+        scope = f"{date}/{self._region}/s3/aws4_request"
+        string_to_sign = "\n".join(
+            ["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()]
+        )
+        key = f"AWS4{self._secret_key}".encode()
+        for part in [date, self._region, "s3", "aws4_request"]:
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["Authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self._access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+        return headers
+
+    def request(self, method, key="", query=None, body=b"", headers=None, ok=(200, 204, 206)):
+        """
+        Send a signed request, retry on connection errors and server errors
+
+        Args:
+            method (str): the HTTP method
+            key (str): the object key ("" for the bucket)
+            query (dict): the query parameters
+            body (bytes): the request body
+            headers (dict): additional headers
+            ok (tuple): the statuses that are not errors
+
+        Return:
+            int, dict, bytes : the response status, headers (lower case names) and body
+        """
+        query = query or {}
+        path = f"/{self.bucket}/{key}" if key else f"/{self.bucket}"
+        url = _quote(path, safe="/-_.~")
+        if query:
+            url += "?" + "&".join(f"{_quote(k)}={_quote(str(v))}" for k, v in sorted(query.items()))
+        payload_hash = hashlib.sha256(body).hexdigest() if body else EMPTY_SHA256
+        error = None
+        for attempt in range(MAX_RETRIES):
+            signed = self._sign(method, path, query, headers or {}, payload_hash)
+            conn = self._connection()
+            try:
+                conn.request(method, url, body=body, headers=signed)
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as ex:
+                conn.close()
+                self._local.conn = None
+                error = S3Error(f"{method} {path} failed : {ex}")
+                logger.warning(f"{error}, attempt {attempt + 1} of {MAX_RETRIES}")
+                continue
+            response_headers = {name.lower(): value for name, value in response.getheaders()}
+            if response.status in ok:
+                return response.status, response_headers, data
+            error = S3Error(f"{method} {path} failed : {response.status} {data[:200]!r}", status=response.status)
+            if response.status < 500:
+                break
+            logger.warning(f"{error}, attempt {attempt + 1} of {MAX_RETRIES}")
+        raise error
+
+    def put_object(self, key, data):
+        self.request("PUT", key, body=bytes(data))
+
+    def get_object(self, key):
+        """
+        Return:
+            bytes : the object data, None if the object does not exist
+        """
+        try:
+            return self.request("GET", key)[2]
+        except S3Error as ex:
+            if ex.status == 404:
+                return None
+            raise
+
+    def head_object(self, key):
+        """
+        Return:
+            int : the object size, None if the object does not exist
+        """
+        try:
+            return int(self.request("HEAD", key)[1].get("content-length", 0))
+        except S3Error as ex:
+            if ex.status == 404:
+                return None
+            raise
+
+    def list_objects(self, prefix, delimiter=None):
+        """
+        List the objects with the prefix (all the result pages)
+
+        Args:
+            prefix (str): the key prefix
+            delimiter (str): group the keys by the delimiter after the prefix (the "directories")
+
+        Return:
+            list, list : the (key, size) of the objects, and the common prefixes
+        """
+        objects, prefixes = list(), list()
+        query = {"list-type": "2", "prefix": prefix}
+        if delimiter:
+            query["delimiter"] = delimiter
+        while True:
+            root = ElementTree.fromstring(self.request("GET", query=query)[2])
+            for content in _find_all(root, "Contents"):
+                objects.append((_text(content, "Key"), int(_text(content, "Size", "0"))))
+            for common in _find_all(root, "CommonPrefixes"):
+                prefixes.append(_text(common, "Prefix"))
+            if _text(root, "IsTruncated") != "true":
+                return objects, prefixes
+            query["continuation-token"] = _text(root, "NextContinuationToken")
+
+    def delete_objects(self, keys):
+        """
+        Delete objects, in batches of up to 1000 keys
+        """
+        keys = list(keys)
+        for start in range(0, len(keys), DELETE_BATCH):
+            root = ElementTree.Element("Delete")
+            ElementTree.SubElement(root, "Quiet").text = "true"
+            for key in keys[start : start + DELETE_BATCH]:
+                ElementTree.SubElement(ElementTree.SubElement(root, "Object"), "Key").text = key
+            body = ElementTree.tostring(root)
+            md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+            _, _, data = self.request("POST", query={"delete": ""}, body=body, headers={"Content-MD5": md5})
+            errors = _find_all(ElementTree.fromstring(data), "Error") if data else []
+            if errors:
+                raise S3Error(f"Failed to delete {len(errors)} object(s), e.g. {_text(errors[0], 'Key')}")
+
+    def create_multipart_upload(self, key):
+        data = self.request("POST", key, query={"uploads": ""})[2]
+        return _text(ElementTree.fromstring(data), "UploadId")
+
+    def upload_part(self, key, upload_id, number, data):
+        """
+        Return:
+            str : the part ETag
+        """
+        return self.request("PUT", key, query={"partNumber": number, "uploadId": upload_id}, body=data)[1]["etag"]
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        """
+        Args:
+            parts (list): the (part number, ETag) of the uploaded parts
+        """
+        root = ElementTree.Element("CompleteMultipartUpload")
+        for number, etag in sorted(parts):
+            part = ElementTree.SubElement(root, "Part")
+            ElementTree.SubElement(part, "PartNumber").text = str(number)
+            ElementTree.SubElement(part, "ETag").text = etag
+        _, _, data = self.request("POST", key, query={"uploadId": upload_id}, body=ElementTree.tostring(root))
+        # the service can fail the completion with 200 status and an error body
+        if data and _strip_ns(ElementTree.fromstring(data).tag) == "Error":
+            raise S3Error(f"Complete multipart upload of {key} failed : {data[:200]!r}")
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.request("DELETE", key, query={"uploadId": upload_id})
+
+
+class S3Writer(Stage):
+    def __init__(self, client, key, part_size=DEFAULT_PART_SIZE, in_flight=DEFAULT_IN_FLIGHT, path=None):
+        """
+        Upload the data to an object (the last stage of the chain). Small
+        objects are uploaded with one PUT, bigger ones as multipart upload,
+        with up to in_flight parts uploaded concurrently. The object exist
+        only when the upload is completed (close), a failed export abort the
+        upload.
+
+        Args:
+            client (S3Client): the S3 client
+            key (str): the object key
+            part_size (int): the size of the parts (at least 5 MB)
+            in_flight (int): maximum parts that are uploaded at the same time
+            path (str): the backup file path that the object stand for (default to the key)
+        """
+        super().__init__()
+        self.path = path or key
+        self._client = client
+        self._key = key
+        self._part_size = max(part_size, MIN_PART_SIZE)
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = list()  # (part number, future of the ETag)
+        self._slots = threading.BoundedSemaphore(in_flight)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=in_flight, thread_name_prefix="s3-upload")
+
+    def _upload_part(self, number, data):
+        try:
+            return self._client.upload_part(self._key, self._upload_id, number, data)
+        finally:
+            self._slots.release()
+
+    def _submit(self, data):
+        if self._upload_id is None:
+            self._upload_id = self._client.create_multipart_upload(self._key)
+        # wait for a free slot, so the memory is bounded by the in flight parts
+        self._slots.acquire()
+        number = len(self._parts) + 1
+        self._parts.append((number, self._executor.submit(self._upload_part, number, data)))
+        # fail fast if an earlier part failed
+        for _, future in self._parts:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self._part_size:
+            self._submit(bytes(self._buffer[: self._part_size]))
+            del self._buffer[: self._part_size]
+
+    def close(self):
+        try:
+            if self._upload_id is None:
+                self._client.put_object(self._key, self._buffer)
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                parts = [(number, future.result()) for number, future in self._parts]
+                self._client.complete_multipart_upload(self._key, self._upload_id, parts)
+            self._buffer = bytearray()
+        finally:
+            self._executor.shutdown()
+        logger.info(f"Uploaded {self._key} : {self.bytes_in} bytes in {max(len(self._parts), 1)} part(s)")
+
+    def abort(self):
+        for _, future in self._parts:
+            future.cancel()
+        self._executor.shutdown()
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            try:
+                self._client.abort_multipart_upload(self._key, self._upload_id)
+            except S3Error as ex:
+                logger.warning(f"Failed to abort the upload of {self._key} : {ex}")
+
+
+def serve_stand_in():
+    """
+    Start a local in-memory S3 stand-in (path style, no authentication), for trying the client
+
+    Return:
+        ThreadingHTTPServer : the server, its address is server.server_address
+    """
+    import http.server
+
+    objects = dict()
+    uploads = dict()
+    lock = threading.Lock()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status=200, body=b"", headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _parse(self):
+            url = urllib.parse.urlsplit(self.path)
+            _, _, key = urllib.parse.unquote(url.path).lstrip("/").partition("/")
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            return key, dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True)), body
+
+        def do_PUT(self):
+            key, query, body = self._parse()
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            with lock:
+                if "uploadId" in query:
+                    uploads[query["uploadId"]][int(query["partNumber"])] = (etag, body)
+                else:
+                    objects[key] = body
+            self._reply(headers={"ETag": etag})
+
+        def do_POST(self):
+            key, query, body = self._parse()
+            with lock:
+                if "uploads" in query:
+                    upload_id = hashlib.md5(f"{key}{len(uploads)}".encode()).hexdigest()
+                    uploads[upload_id] = dict()
+                    result = f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId>"
+                    return self._reply(body=f"{result}</InitiateMultipartUploadResult>".encode())
+                if "uploadId" in query:
+                    parts = uploads.pop(query["uploadId"])
+                    objects[key] = b"".join(parts[number][1] for number in sorted(parts))
+                    return self._reply(body=b"<CompleteMultipartUploadResult/>")
+                for element in _find_all(ElementTree.fromstring(body), "Key"):
+                    objects.pop(element.text, None)
+            self._reply(body=b"<DeleteResult/>")
+
+        def do_GET(self):
+            key, query, _ = self._parse()
+            if key:
+                with lock:
+                    data = objects.get(key)
+                return self._reply(body=data) if data is not None else self._reply(404, b"<Error/>")
+            prefix, delimiter = query.get("prefix", ""), query.get("delimiter")
+            contents, prefixes = list(), set()
+            with lock:
+                for name in sorted(objects):
+                    if not name.startswith(prefix):
+                        continue
+                    rest = name[len(prefix) :]
+                    if delimiter and delimiter in rest:
+                        prefixes.add(prefix + rest.split(delimiter)[0] + delimiter)
+                    else:
+                        contents.append(f"<Contents><Key>{name}</Key><Size>{len(objects[name])}</Size></Contents>")
+            common = "".join(f"<CommonPrefixes><Prefix>{name}</Prefix></CommonPrefixes>" for name in sorted(prefixes))
+            body = f"<ListBucketResult>{''.join(contents)}{common}<IsTruncated>false</IsTruncated></ListBucketResult>"
+            self._reply(body=body.encode())
+
+        def do_HEAD(self):
+            key, _, _ = self._parse()
+            with lock:
+                data = objects.get(key)
+            if data is None:
+                return self._reply(404)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+
+        def do_DELETE(self):
+            key, query, _ = self._parse()
+            with lock:
+                if "uploadId" in query:
+                    uploads.pop(query["uploadId"], None)
+                else:
+                    objects.pop(key, None)
+            self._reply(204)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import os
+
+    logging.basicConfig(level=logging.INFO)
+    server = serve_stand_in()
+    s3 = S3Client(f"http://127.0.0.1:{server.server_address[1]}", "backups", "access", "secret")
+    data = os.urandom(MB) * 23
+    writer = S3Writer(s3, "vm1/backup-1/vm1.xva", part_size=MIN_PART_SIZE, in_flight=2)
+    view = memoryview(data)
+    for start in range(0, len(data), 4 * MB):
+        writer.write(view[start : start + 4 * MB])
+    writer.close()
+    s3.put_object("vm1/backup-1/success", b"")
+    print(s3.get_object("vm1/backup-1/vm1.xva") == data, s3.head_object("vm1/backup-1/vm1.xva"))
+    print(s3.list_objects("vm1/"), s3.list_objects("vm1/", delimiter="/")[1])
+    s3.delete_objects([key for key, _ in s3.list_objects("vm1/")[0]])
+    print(s3.list_objects(""))
+    server.shutdown()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+This module contain the pipeline that run the backup stages (snapshot /
+export / cleanup) of different VMs at the same time, on bounded pools of
+workers, and the helpers that make the shared state safe to use from the
+workers.
+"""
+# Built-in modules
+import collections
+import heapq
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+# 3ed party modules
+
+# Local modules
+
+logger = logging.getLogger(__name__)
+
+
+class Counters:
+    def __init__(self):
+        """
+        Thread safe counters of the backups status
+        """
+        self._lock = threading.Lock()
+        self.success = 0
+        self.warning = 0
+        self.error = 0
+
+    def add(self, status):
+        """
+        Count a backup status
+
+        Args:
+            status (str): the backup status : success / warning / error
+        """
+        with self._lock:
+            if status == "success":
+                self.success += 1
+            elif status == "warning":
+                self.warning += 1
+            else:
+                self.error += 1
+
+
+class Pipeline:
+    def __init__(self, stages):
+        """
+        Initialize the pipeline object
+
+        Each stage has its own workers and its own bounded queue, so while one
+        VM is exported, the next VM is snapshotted and the previous VM
+        snapshot is removed. When the queue of the next stage is full the
+        workers of the stage wait, so the snapshots don't pile up ahead of
+        the export stage.
+
+        Args:
+            stages (list): list of the stages, each is a tuple of (name, workers, queue size)
+        """
+        self._stages = [(name, max(int(workers), 1), max(int(size), 1)) for name, workers, size in stages]
+        self.spans = dict()  # stage name -> seconds from its first start to its last end, of the last run
+
+    def run(self, jobs, counters):
+        """
+        Run all the jobs (in the given order) through the stages, and count
+        their status. The job context is passed from stage to stage, a stage
+        return the backup status to end the job, or None to pass it to the
+        next stage (the last stage must return the status).
+        A stage that raise an exception (even SystemExit) end the job with error.
+
+        Args:
+            jobs (list): list of jobs, each is a tuple of (name, stage functions, context),
+                         one function per stage, called with the context
+            counters (Counters): the status counters to update
+
+        Return:
+            list : the (status, duration in seconds, the busy time of each stage) of each job, in the order
+                   of the jobs, the duration is from the start of the first stage to the end of the job (with
+                   the time the job waited in the queues), the busy time is stage name -> seconds (without waiting)
+        """
+        # the jobs state is kept by their position, the names are not unique (same name-label VMs)
+        results = [None] * len(jobs)
+        done = threading.Condition()
+        queues = [queue.Queue(maxsize=size) for _, _, size in self._stages]
+        started = dict()
+        busy = collections.defaultdict(dict)
+        windows = dict()  # stage name -> [first start, last end]
+        windows_lock = threading.Lock()
+
+        def finish(position, name, status):
+            duration = time.monotonic() - started[position]
+            counters.add(status)
+            with done:
+                results[position] = (status, duration, dict(busy[position]))
+                done.notify_all()
+            logger.info(
+                f"The backup {name} ended with {status} after {duration:.1f} Sec. "
+                f"({', '.join(f'{stage} {seconds:.1f}' for stage, seconds in busy[position].items())} Sec.)"
+            )
+
+        def worker(index):
+            stage_name = self._stages[index][0]
+            while True:
+                item = queues[index].get()
+                if item is None:
+                    return
+                position, job = item
+                name, funcs, context = job
+                if index == 0:
+                    started[position] = time.monotonic()
+                logger.info(f"Worker {threading.current_thread().name} start : {stage_name} {name}")
+                stage_start = time.monotonic()
+                try:
+                    status = funcs[index](context)
+                except BaseException as ex:
+                    # including SystemExit, the job must end (finish) or the run wait for it forever
+                    logger.exception(f"The backup {name} failed in the {stage_name} stage : {ex!r}")
+                    status = "error"
+                stage_end = time.monotonic()
+                busy[position][stage_name] = stage_end - stage_start
+                with windows_lock:
+                    window = windows.setdefault(stage_name, [stage_start, stage_end])
+                    window[0] = min(window[0], stage_start)
+                    window[1] = max(window[1], stage_end)
+                if status is None and index + 1 == len(queues):
+                    logger.error(f"The backup {name} did not return status from the last stage")
+                    status = "error"
+                if status is None:
+                    # wait here if the next stage is full
+                    queues[index + 1].put(item)
+                else:
+                    finish(position, name, status)
+
+        threads = list()
+        for index, (stage_name, workers, _) in enumerate(self._stages):
+            for i in range(workers):
+                thread = threading.Thread(target=worker, args=(index,), name=f"{stage_name}_{i}", daemon=True)
+                thread.start()
+                threads.append((index, thread))
+
+        for item in enumerate(jobs):
+            queues[0].put(item)
+        with done:
+            done.wait_for(lambda: None not in results)
+
+        for index, thread in threads:
+            queues[index].put(None)
+        for _, thread in threads:
+            thread.join()
+        self.spans = {stage_name: end - begin for stage_name, (begin, end) in windows.items()}
+        return results
+
+
+class History:
+    def __init__(self, path):
+        """
+        The duration and size of the backups from previous runs, kept in a
+        JSON file, for estimating the backups duration.
+
+        Args:
+            path (str): the history file path
+        """
+        self._path = path
+        self._data = dict()
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as fh:
+                    self._data = json.load(fh)
+            except (OSError, ValueError) as ex:
+                logger.warning(f"Cannot read the backup history {path} : {ex}")
+
+    def get(self, name):
+        """
+        Args:
+            name (str): the job name
+
+        Return:
+            dict : the last 'duration' (in seconds) and 'size' (in bytes) of the job, None if not known
+        """
+        return self._data.get(name)
+
+    def update(self, name, duration, size):
+        self._data[name] = {"duration": duration, "size": size}
+
+    def throughput(self):
+        """
+        Return:
+            float : the average backup throughput (bytes per second), None if there is no history
+        """
+        size = sum(entry["size"] for entry in self._data.values() if entry["duration"] > 0)
+        duration = sum(entry["duration"] for entry in self._data.values() if entry["duration"] > 0)
+        return size / duration if duration > 0 and size > 0 else None
+
+    def save(self):
+        tmp_name = f"{self._path}.tmp"
+        try:
+            with open(tmp_name, "w") as fh:
+                json.dump(self._data, fh, indent=2, sort_keys=True)
+            os.replace(tmp_name, self._path)
+        except OSError as ex:
+            logger.warning(f"Cannot save the backup history {self._path} : {ex}")
+
+
+def estimate_costs(sizes, history):
+    """
+    Estimate the duration of each job, from its duration in previous runs, or
+    from its size and the average throughput of the previous runs.
+    Without any history, the size is used as the cost.
+
+    Args:
+        sizes (dict): the job name -> the expected export size in bytes
+        history (History): the backups history
+
+    Return:
+        dict, bool : the job name -> the estimated cost, and True if the costs are in seconds (False for bytes)
+    """
+    throughput = history.throughput()
+    if throughput is None:
+        return dict(sizes), False
+    costs = dict()
+    for name, size in sizes.items():
+        entry = history.get(name)
+        costs[name] = entry["duration"] if entry is not None else size / throughput
+    return costs, True
+
+
+def lpt_order(jobs, costs):
+    """
+    Order the jobs by the longest processing time first (LPT), which keep the
+    total run time (makespan) short when running on parallel workers.
+
+    Args:
+        jobs (list): list of jobs, see Scheduler.run()
+        costs (dict): the job name -> the estimated cost
+
+    Return:
+        list : the ordered jobs
+    """
+    return sorted(jobs, key=lambda job: costs.get(job[0], 0), reverse=True)
+
+
+def predict_makespan(costs, workers):
+    """
+    Predict the total run time (makespan) of running the jobs in the given
+    order on the workers, each job start on the first free worker.
+
+    Args:
+        costs (list): the estimated cost of each job, in the run order
+        workers (int): number of parallel workers
+
+    Return:
+        float : the predicted makespan (in the costs units)
+    """
+    loads = [0.0] * max(int(workers), 1)
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+class _PooledMethod:
+    def __init__(self, pool, path):
+        self._pool = pool
+        self._path = path
+
+    def __getattr__(self, name):
+        return _PooledMethod(self._pool, self._path + [name])
+
+    def __call__(self, *args):
+        return self._pool.call(self._path, args)
+
+
+class XenAPIPool:
+    def __init__(self, xenapi, login=None, size=1):
+        """
+        A pool of XenAPI sessions, used like one session proxy (session.xenapi).
+        The session proxy is not thread safe (one HTTP connection), so each call
+        run on a session that no other worker use at the moment, and the long
+        blocking calls (VM.snapshot, VDI.destroy) of one worker do not wait for
+        the calls of the other workers. More sessions are logged in only when
+        all the open sessions are busy.
+
+        Args:
+            xenapi (object): the logged-in session XenAPI proxy (session.xenapi), the first session of the pool
+            login (function): open another logged-in session, and return its XenAPI proxy
+            size (int): the maximum number of sessions (usually the number of workers)
+        """
+        self._login = login
+        self._size = max(int(size), 1) if login is not None else 1
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._idle.put(xenapi)
+        self._sessions = [xenapi]
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            login = len(self._sessions) < self._size
+            if login:
+                # reserve the place of the new session, the login itself run without the lock
+                self._sessions.append(None)
+        if not login:
+            return self._idle.get()
+        try:
+            xenapi = self._login()
+        except Exception:
+            with self._lock:
+                self._sessions.remove(None)
+            logger.warning("Cannot open another XenAPI session, waiting for a free session", exc_info=True)
+            return self._idle.get()
+        with self._lock:
+            self._sessions[self._sessions.index(None)] = xenapi
+        logger.info(f"Opened XenAPI session {len(self._sessions)} of {self._size}")
+        return xenapi
+
+    def call(self, path, args):
+        """
+        Call XenAPI method on a free session
+
+        Args:
+            path (list): the method path, like ['VM', 'snapshot']
+            args (tuple): the method arguments
+
+        Return:
+            the method result
+        """
+        xenapi = self._acquire()
+        try:
+            method = xenapi
+            for name in path:
+                method = getattr(method, name)
+            return method(*args)
+        finally:
+            self._idle.put(xenapi)
+
+    def __getattr__(self, name):
+        return _PooledMethod(self, [name])
+
+    def close(self):
+        """
+        Log out the sessions that the pool opened (not the first session)
+        """
+        with self._lock:
+            sessions, self._sessions = self._sessions[1:], self._sessions[:1]
+        for xenapi in sessions:
+            if xenapi is None:
+                continue
+            try:
+                xenapi.session.logout()
+            except Exception as ex:
+                logger.warning(f"Cannot log out the XenAPI session : {ex}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    cnt = Counters()
+    stage = lambda ctx: time.sleep(0.2)  # noqa: E731
+    jobs = [(f"job-{i}", (stage, stage, lambda ctx: "success"), {}) for i in range(4)]
+    print(Pipeline([("prepare", 1, 1), ("export", 2, 1), ("cleanup", 1, 1)]).run(jobs, cnt))
+    print(cnt.success, cnt.warning, cnt.error)
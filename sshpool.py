@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+This module contain a pool of persistent, multiplexed SSH connections.
+
+Every remote command used to open a new SSH connection (full key exchange and
+authentication). The pool keeps OpenSSH master connections (ControlMaster) open
+per user/host, and all the remote commands are run as sessions over those
+masters, so a full backup run need only a handful of handshakes.
+"""
+# Built-in modules
+import atexit
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+# 3ed party modules
+
+# Local modules
+
+logger = logging.getLogger(__name__)
+
+# The exit code of the ssh client when the connection itself failed
+SSH_ERROR = 255
+
+
+class SshPool:
+    def __init__(self, size=1, persist=600, connect_timeout=10, control_dir=None):
+        """
+        Initialize the pool object.
+
+        Args:
+            size (int): number of master connections to keep for each user/host
+            persist (int): time (in seconds) an idle master connection stay open
+            connect_timeout (int): the SSH connection timeout in seconds
+            control_dir (str): directory for the control sockets, default is a new temporary directory
+        """
+        self._size = max(int(size), 1)
+        self._persist = int(persist)
+        self._connect_timeout = int(connect_timeout)
+        self._own_dir = control_dir is None
+        self._dir = control_dir or tempfile.mkdtemp(prefix="vmb-ssh-")
+        self._lock = threading.Lock()
+        self._next = {}  # user@host -> next slot to use (round-robin)
+        self._alive = set()  # control paths of connected masters
+        self._connecting = {}  # control path -> event set when its master connection attempt ends
+        self._stats = {}  # user@host -> counters
+        atexit.register(self.close)
+
+    def _target(self, user, host):
+        return f"{user}@{host}"
+
+    def _control_path(self, target, slot):
+        digest = hashlib.sha1(target.encode()).hexdigest()[:12]
+        return os.path.join(self._dir, f"{digest}-{slot}")
+
+    def _host_stats(self, target):
+        return self._stats.setdefault(
+            target,
+            {
+                "handshakes": 0,
+                "handshake_time": 0.0,
+                "failed_handshakes": 0,
+                "commands": 0,
+                "exec_time": 0.0,
+                "reconnects": 0,
+            },
+        )
+
+    def _options(self, path):
+        return [
+            "-o",
+            f"ControlPath={path}",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            f"ConnectTimeout={self._connect_timeout}",
+        ]
+
+    def _connect(self, target, path):
+        """
+        Open a new master connection (in the background) for the target, the
+        handshake runs without holding the pool lock.
+
+        Return:
+            bool : True if the master connection is up, otherwise False
+        """
+        command = ["ssh", "-M", "-N", "-f"] + self._options(path)
+        command += ["-o", f"ControlPersist={self._persist}", target]
+        logger.info(f"Opening SSH master connection to {target} ({path})")
+        start = time.monotonic()
+        try:
+            cp = subprocess.run(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                timeout=self._connect_timeout * 3,
+            )
+            rc, err = cp.returncode, cp.stderr.decode().strip()
+        except Exception as ex:
+            rc, err = SSH_ERROR, str(ex)
+        elapsed = time.monotonic() - start
+
+        with self._lock:
+            stats = self._host_stats(target)
+            if rc != 0:
+                stats["failed_handshakes"] += 1
+            else:
+                stats["handshakes"] += 1
+                stats["handshake_time"] += elapsed
+                self._alive.add(path)
+        if rc != 0:
+            logger.error(f"Cannot open SSH master connection to {target} ({rc}): {err}")
+            return False
+        logger.info(f"SSH master connection to {target} is up after {elapsed:.3f} Sec.")
+        return True
+
+    def args(self, user, host):
+        """
+        Get the ssh command prefix that run over one of the master connections
+        of the user/host, the connection is opened if it is not up yet.
+
+        Args:
+            user (str): the remote user name
+            host (str): the remote host name / IP
+
+        Return:
+            list : the ssh command (as list) to prefix the remote command with
+        """
+        target = self._target(user, host)
+        connect = None
+        with self._lock:
+            # reserve the slot, the handshake itself runs outside the lock
+            slot = self._next.get(target, 0)
+            self._next[target] = (slot + 1) % self._size
+            path = self._control_path(target, slot)
+            connecting = self._connecting.get(path)
+            if connecting is None and (path not in self._alive or not os.path.exists(path)):
+                self._alive.discard(path)
+                connecting = connect = self._connecting[path] = threading.Event()
+        if connect is not None:
+            try:
+                self._connect(target, path)
+            finally:
+                with self._lock:
+                    del self._connecting[path]
+                connect.set()
+        elif connecting is not None:
+            # another thread is opening this master connection
+            connecting.wait(timeout=self._connect_timeout * 3)
+        # if the master is not up, ssh fall back to a regular (non shared) connection
+        return ["ssh", "-o", "ControlMaster=no"] + self._options(path) + [target]
+
+    def reconnect(self, user, host, args):
+        """
+        Check the master connection that a failed command (exit code 255) ran
+        over, and close it only if it is really lost, so the next command will
+        open a new one. The other masters of the user/host (and the sessions
+        running over them) are not touched, as the exit code 255 can also be
+        the remote side refusing the session (like sshd MaxSessions).
+
+        Args:
+            user (str): the remote user name
+            host (str): the remote host name / IP
+            args (list): the ssh command prefix that the command ran with, see args()
+
+        Return:
+            bool : True if the master connection was lost (and closed), otherwise False
+        """
+        target = self._target(user, host)
+        path = next((arg.split("=", 1)[1] for arg in args if arg.startswith("ControlPath=")), None)
+        if path is None:
+            return False
+        command = ["ssh", "-O", "check"] + self._options(path) + [target]
+        try:
+            cp = subprocess.run(
+                command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=self._connect_timeout
+            )
+            if cp.returncode == 0:
+                return False
+        except Exception as ex:
+            logger.warning(f"Cannot check the SSH master connection to {target} ({path}): {ex}")
+        logger.warning(f"Reconnecting the SSH master connection to {target} ({path})")
+        with self._lock:
+            self._host_stats(target)["reconnects"] += 1
+            self._alive.discard(path)
+        self._exit(target, path)
+        return True
+
+    def record(self, user, host, elapsed):
+        """
+        Record the execution time of a command that ran over the pool
+
+        Args:
+            user (str): the remote user name
+            host (str): the remote host name / IP
+            elapsed (float): the command execution time in seconds
+        """
+        with self._lock:
+            stats = self._host_stats(self._target(user, host))
+            stats["commands"] += 1
+            stats["exec_time"] += elapsed
+
+    def stats(self):
+        """
+        Return:
+            dict : copy of the counters of all the user/host in the pool
+        """
+        with self._lock:
+            return {target: dict(values) for target, values in self._stats.items()}
+
+    def report(self):
+        """
+        Log a summary of the handshake vs. execution time of all user/hosts
+        """
+        for target, stats in self.stats().items():
+            logger.info(
+                f"SSH pool {target}: {stats['handshakes']} handshake(s) "
+                f"({stats['handshake_time']:.3f} Sec.), {stats['commands']} command(s) "
+                f"({stats['exec_time']:.3f} Sec.), {stats['reconnects']} reconnect(s), "
+                f"{stats['failed_handshakes']} failed handshake(s)"
+            )
+
+    def _exit(self, target, path):
+        # called without the pool lock, the ssh control command can block
+        if os.path.exists(path):
+            command = ["ssh", "-O", "exit"] + self._options(path) + [target]
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def close(self):
+        """
+        Close all the master connections and remove the control directory
+        """
+        with self._lock:
+            masters = [
+                (target, self._control_path(target, slot)) for target in list(self._stats) for slot in range(self._size)
+            ]
+            self._alive.clear()
+        for target, path in masters:
+            self._exit(target, path)
+        if self._own_dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    pool = SshPool()
+    print(pool.args("root", "localhost"))
+    pool.report()
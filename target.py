@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+"""
+This module contain the storage targets of the backups : where the backup
+directories are created, listed and deleted, and where the export streams
+are written.
+
+    PosixTarget  - a file-system path, the backup directory operations run on
+                   the Xen server (or by the remote agent), the HTTP exports
+                   are written by this script (the default)
+    S3Target     - a bucket of S3 compatible object storage, the backup
+                   directories are key prefixes, the exports are uploaded as
+                   concurrent multipart uploads (HTTP export method only)
+
+The methods of the targets match the backup directory methods of Command
+(with the same return values), so the backup flow does not depend on the
+target.
+"""
+# Built-in modules
+import abc
+import fnmatch
+import logging
+
+# 3ed party modules
+
+# Local modules
+from exporter import DEFAULT_WRITE_SIZE, FileWriter, LargeFileWriter
+from s3 import DEFAULT_IN_FLIGHT, DEFAULT_PART_SIZE, MAX_PARTS, S3Client, S3Error, S3Writer
+
+logger = logging.getLogger(__name__)
+
+
+class Target(abc.ABC):
+    name = "base"
+
+    @abc.abstractmethod
+    def dir_list(self, path):
+        """
+        Args:
+            path (str): the directory path
+
+        Return:
+            list : the sorted names in the directory
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def path_exists(self, path):
+        """
+        Create an empty (marker) file, like 'touch'
+
+        Args:
+            path (str): the file path
+
+        Return:
+            int : 0 on success, otherwise non zero
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def path_delete(self, *paths):
+        """
+        Delete files and directories (recursively)
+
+        Args:
+            paths (str): the paths to delete
+
+        Return:
+            int : 0 on success, otherwise non zero
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def mkdir(self, path):
+        """
+        Args:
+            path (str): the directory path, the parents are created if needed
+
+        Return:
+            int : 0 on success, otherwise non zero
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def write_files(self, files):
+        """
+        Write (replace) number of text files
+
+        Args:
+            files (dict): the files to write, full path of the file -> list of lines
+
+        Return:
+            int : number of files that failed to be written
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_files(self, *paths):
+        """
+        Read number of (small) text files
+
+        Args:
+            paths (str): the full path of the files
+
+        Return:
+            dict : the file path -> its content, None for files that cannot be read
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def backup_dir_state(self, path, marker="success*"):
+        """
+        Args:
+            path (str): the path of the backups
+            marker (str): the (glob) name of the marker file
+
+        Return:
+            list, list : sorted list of the backup directories, and the directories with the marker
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def file_size(self, path):
+        """
+        Args:
+            path (str): the file path
+
+        Return:
+            int : the size in MB
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def disk_free(self, path):
+        """
+        Args:
+            path (str): a path in the target
+
+        Return:
+            dict : the 'total', 'used' and 'avail' capacity in bytes (empty dict on failure),
+                   None if the target has no capacity limit
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def path_changed(self, *paths):
+        """
+        Invalidate the cached listings of paths that were written by the writers (or by the host)
+
+        Args:
+            paths (str): the changed paths
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def writer(self, path, offset=0, keep_partial=False, size=0):
+        """
+        Args:
+            path (str): the backup file path
+            offset (int): continue a partially written file from this offset
+            keep_partial (bool): keep the partial file when the export fails
+            size (int): the expected size of the file, 0 if unknown
+
+        Return:
+            Stage : the last stage of the export chain, that write the backup file
+        """
+        raise NotImplementedError
+
+
+class PosixTarget(Target):
+    name = "posix"
+
+    def __init__(self, cmd, write_strategy="default", write_size=DEFAULT_WRITE_SIZE):
+        """
+        Args:
+            cmd (Command): the command object of the Xen server that the backup_dir is mounted on
+            write_strategy (str): how the exports are written - default (buffered writes), or the
+                                  LargeFileWriter strategy (batched / dontneed / direct)
+            write_size (int): the size of the writes of the LargeFileWriter
+        """
+        self._cmd = cmd
+        self._write_strategy = write_strategy
+        self._write_size = write_size
+
+    def dir_list(self, path):
+        return self._cmd.dir_list(path)
+
+    def path_exists(self, path):
+        return self._cmd.path_exists(path)
+
+    def path_delete(self, *paths):
+        return self._cmd.path_delete(*paths)
+
+    def mkdir(self, path):
+        return self._cmd.mkdir(path)
+
+    def write_files(self, files):
+        return self._cmd.write_files(files)
+
+    def read_files(self, *paths):
+        return self._cmd.read_files(*paths)
+
+    def backup_dir_state(self, path, marker="success*"):
+        return self._cmd.backup_dir_state(path, marker)
+
+    def file_size(self, path):
+        return self._cmd.file_size(path)
+
+    def disk_free(self, path):
+        return self._cmd.disk_free(path)
+
+    def path_changed(self, *paths):
+        self._cmd.path_changed(*paths)
+
+    def writer(self, path, offset=0, keep_partial=False, size=0):
+        if self._write_strategy == "default":
+            return FileWriter(path, offset=offset, keep_partial=keep_partial)
+        return LargeFileWriter(
+            path,
+            size=size,
+            write_size=self._write_size,
+            strategy=self._write_strategy,
+            offset=offset,
+            keep_partial=keep_partial,
+        )
+
+
+class S3Target(Target):
+    name = "s3"
+
+    def __init__(self, client, part_size=DEFAULT_PART_SIZE, in_flight=DEFAULT_IN_FLIGHT):
+        """
+        Args:
+            client (S3Client): the client of the bucket
+            part_size (int): the size of the multipart upload parts
+            in_flight (int): maximum parts of an upload that are uploaded at the same time
+        """
+        self._client = client
+        self._part_size = part_size
+        self._in_flight = in_flight
+
+    @staticmethod
+    def key(path):
+        """
+        Return:
+            str : the object key of a path (the backup_dir path, without the leading '/')
+        """
+        return path.strip("/")
+
+    def dir_list(self, path):
+        try:
+            prefixes = self._client.list_objects(f"{self.key(path)}/", delimiter="/")[1]
+        except S3Error as ex:
+            logger.error(f"Cannot list {path} : {ex}")
+            return []
+        return sorted(prefix.rstrip("/").rsplit("/", 1)[-1] for prefix in prefixes)
+
+    def path_exists(self, path):
+        try:
+            self._client.put_object(self.key(path), b"")
+        except S3Error as ex:
+            logger.error(f"Cannot create {path} : {ex}")
+            return 1
+        return 0
+
+    def path_delete(self, *paths):
+        try:
+            keys = list()
+            for path in paths:
+                keys += [key for key, _ in self._client.list_objects(f"{self.key(path)}/")[0]]
+                if self._client.head_object(self.key(path)) is not None:
+                    keys.append(self.key(path))
+            self._client.delete_objects(keys)
+        except S3Error as ex:
+            logger.error(f"Cannot delete {paths} : {ex}")
+            return 1
+        return 0
+
+    def mkdir(self, path):
+        # the "directories" are key prefixes, they exist when there are objects in them
+        return 0
+
+    def write_files(self, files):
+        failed = 0
+        for path, data in files.items():
+            try:
+                self._client.put_object(self.key(path), "".join(f"{line}\n" for line in data).encode())
+            except S3Error as ex:
+                logger.error(f"Cannot write {path} : {ex}")
+                failed += 1
+        return failed
+
+    def read_files(self, *paths):
+        contents = dict()
+        for path in paths:
+            try:
+                data = self._client.get_object(self.key(path))
+            except S3Error as ex:
+                logger.error(f"Cannot read {path} : {ex}")
+                data = None
+            contents[path] = data.decode() if data is not None else None
+        return contents
+
+    def backup_dir_state(self, path, marker="success*"):
+        """
+        Get the backup directories and the directories with the marker, from
+        one listing of the prefix (instead of listing every directory)
+        """
+        prefix = f"{self.key(path)}/"
+        try:
+            objects = self._client.list_objects(prefix)[0]
+        except S3Error as ex:
+            logger.error(f"Cannot list {path} : {ex}")
+            return [], []
+        dirs, marked = set(), set()
+        for key, _ in objects:
+            names = key[len(prefix) :].split("/")
+            if len(names) < 2:
+                continue  # a file, not a backup directory
+            dirs.add(names[0])
+            if len(names) == 2 and fnmatch.fnmatch(names[1], marker):
+                marked.add(names[0])
+        return sorted(dirs), sorted(marked)
+
+    def file_size(self, path):
+        try:
+            size = self._client.head_object(self.key(path))
+        except S3Error as ex:
+            logger.error(f"Cannot get the size of {path} : {ex}")
+            return 0
+        return int((size or 0) / (1024 * 1024))
+
+    def disk_free(self, path):
+        return None
+
+    def path_changed(self, *paths):
+        # the object listings are not cached
+        pass
+
+    def writer(self, path, offset=0, keep_partial=False, size=0):
+        if offset:
+            raise ValueError(f"The {self.name} target cannot continue a partial upload of {path}")
+        # the parts of big objects are bigger, an upload has up to MAX_PARTS parts
+        part_size = max(self._part_size, -(-size // MAX_PARTS))
+        return S3Writer(self._client, self.key(path), part_size, self._in_flight, path=path)
+
+
+def get_target(name, cmd, s3_settings=None, posix_settings=None):
+    """
+    Create target object by its name
+
+    Args:
+        name (str): the target name : posix / s3
+        cmd (Command): the command object, for the posix target
+        s3_settings (dict): the S3Client arguments (endpoint, bucket, access_key, secret_key, region),
+                            and the upload options (part_size, in_flight), for the s3 target
+        posix_settings (dict): the write options (write_strategy, write_size), for the posix target
+
+    Return:
+        Target : the target object
+    """
+    if name == S3Target.name:
+        settings = dict(s3_settings)
+        options = {key: settings.pop(key) for key in ["part_size", "in_flight"] if key in settings}
+        return S3Target(S3Client(**settings), **options)
+    return PosixTarget(cmd, **(posix_settings or {}))
+
+
+if __name__ == "__main__":
+    from s3 import serve_stand_in
+
+    logging.basicConfig(level=logging.INFO)
+    server = serve_stand_in()
+    s3_target = get_target(
+        "s3",
+        None,
+        {
+            "endpoint": f"http://127.0.0.1:{server.server_address[1]}",
+            "bucket": "backups",
+            "access_key": "access",
+            "secret_key": "secret",
+        },
+    )
+    for name in ["backup-20240101-010000", "backup-20240102-010000", "backup-20240103-010000"]:
+        s3_target.write_files({f"/BACKUPS/vm1/{name}/DISK-xvda/vbd.cfg": ["userdevice=0"]})
+        if name != "backup-20240103-010000":
+            s3_target.path_exists(f"/BACKUPS/vm1/{name}/success")
+    print(s3_target.dir_list("/BACKUPS/vm1"), s3_target.backup_dir_state("/BACKUPS/vm1"))
+    s3_target.path_delete("/BACKUPS/vm1/backup-20240101-010000")
+    print(s3_target.backup_dir_state("/BACKUPS/vm1"))
+    server.shutdown()
@@ -0,0 +1,6 @@
+# Built-in modules
+import os
+import sys
+
+# the modules are flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,44 @@
+# Built-in modules
+import types
+
+# 3ed party modules
+import pytest
+
+# Local modules
+import backend
+import target
+
+
+def failing(*args):
+    raise RuntimeError("HANDLE_INVALID")
+
+
+@pytest.fixture
+def xapi():
+    vm = types.SimpleNamespace(
+        get_by_name_label=lambda name: ["OpaqueRef:1"],
+        get_uuid=failing,
+        get_power_state=failing,
+    )
+    vdi = types.SimpleNamespace(
+        get_by_name_label=lambda name: ["OpaqueRef:2"],
+        get_by_uuid=lambda uuid: "OpaqueRef:2",
+        snapshot=lambda ref, options: "OpaqueRef:3",
+        get_uuid=failing,
+    )
+    return types.SimpleNamespace(VM=vm, VDI=vdi)
+
+
+def test_abstract_classes():
+    with pytest.raises(TypeError):
+        backend.Backend()
+    with pytest.raises(TypeError):
+        target.Target()
+
+
+def test_xenapi_lookup_failures_are_handled(xapi):
+    xenapi = backend.XenApiBackend(xapi)
+    assert xenapi.find_vm_by_name("vm1") == []
+    assert xenapi.is_vm_running("vm1") is False
+    assert xenapi.find_vdi_by_name("disk1") == []
+    assert xenapi.vdi_snapshot("uuid") == ""
@@ -0,0 +1,54 @@
+# Built-in modules
+import types
+
+# 3ed party modules
+
+# Local modules
+import command
+import target
+from cache import CachedXenAPI, TTLCache
+
+
+def test_xenapi_results_are_copies():
+    calls = []
+
+    def get_record(ref):
+        calls.append(ref)
+        return {"uuid": "vm1-uuid", "VBDs": ["OpaqueRef:1"]}
+
+    xapi = CachedXenAPI(types.SimpleNamespace(VM=types.SimpleNamespace(get_record=get_record)), TTLCache())
+    record = xapi.VM.get_record("OpaqueRef:0")
+    record["VBDs"].append("OpaqueRef:2")
+    assert xapi.VM.get_record("OpaqueRef:0") == {"uuid": "vm1-uuid", "VBDs": ["OpaqueRef:1"]}
+    assert calls == ["OpaqueRef:0"]
+
+
+def test_dir_list_results_are_copies(tmp_path):
+    (tmp_path / "backup-1").mkdir()
+    cmd = command.Command()
+    cmd.cache(TTLCache())
+    cmd.dir_list(str(tmp_path)).append("backup-2")
+    assert cmd.dir_list(str(tmp_path)) == ["backup-1"]
+
+
+def test_local_writes_invalidate_the_listings(tmp_path):
+    (tmp_path / "backup-1").mkdir()
+    cmd = command.Command()
+    cmd.cache(TTLCache())
+    assert cmd.start_agent()
+    try:
+        posix = target.PosixTarget(cmd)
+        assert posix.dir_list(str(tmp_path)) == ["backup-1"]
+        assert posix.backup_dir_state(str(tmp_path)) == (["backup-1"], [])
+
+        # written here (like the HTTP exports), not through the Command
+        writer = posix.writer(str(tmp_path / "backup-1" / "success"))
+        writer.write(memoryview(b"done"))
+        writer.close()
+        (tmp_path / "backup-2").mkdir()
+        assert posix.dir_list(str(tmp_path)) == ["backup-1"]
+        posix.path_changed(writer.path, str(tmp_path / "backup-2"))
+        assert posix.dir_list(str(tmp_path)) == ["backup-1", "backup-2"]
+        assert posix.backup_dir_state(str(tmp_path)) == (["backup-1", "backup-2"], ["backup-1"])
+    finally:
+        cmd.stop_agent()
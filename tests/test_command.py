@@ -0,0 +1,77 @@
+# Built-in modules
+import time
+
+# 3ed party modules
+
+# Local modules
+import command
+
+
+def test_stream_lines():
+    stream = command.CommandStream(["sh", "-c", "printf 'a\\nb\\nc'"])
+    assert list(stream) == ["a", "b", "c"]
+    assert stream.returncode == 0
+
+
+def test_stream_chunks():
+    stream = command.CommandStream(["sh", "-c", "head -c 200000 /dev/zero"], mode="chunks", chunk_size=4096)
+    chunks = list(stream)
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+    assert sum(len(chunk) for chunk in chunks) == 200000
+    assert stream.returncode == 0
+
+
+def test_stream_exit_code():
+    stream = command.CommandStream(["sh", "-c", "echo out; echo err >&2; exit 3"])
+    assert list(stream) == ["out"]
+    assert stream.returncode == 3
+    assert stream.stderr == "err"
+
+
+def test_stream_early_break_kills_the_command():
+    start = time.monotonic()
+    stream = command.CommandStream(["sh", "-c", "yes; sleep 30"], timeout=60)
+    for line in stream:
+        # the iterator is dropped on the break, and its cleanup kill the command
+        break
+    assert stream.returncode is not None
+    assert time.monotonic() - start < 10
+
+
+def test_stream_context_kills_the_command():
+    start = time.monotonic()
+    with command.CommandStream(["sleep", "30"], timeout=60) as stream:
+        pass
+    assert stream.returncode is not None
+    assert time.monotonic() - start < 10
+
+
+def test_stream_timeout():
+    stream = command.CommandStream(["sh", "-c", "echo first; sleep 30"], timeout=1)
+    assert list(stream) == ["first"]
+    assert stream.timed_out
+    assert stream.returncode is not None
+
+
+def test_stream_command_not_found():
+    stream = command.CommandStream(["/nonexistent/command"])
+    assert list(stream) == []
+    assert stream.returncode == 1
+
+
+def test_dir_list_shell_fallback(tmp_path):
+    for name in ["b", "a", "c"]:
+        (tmp_path / name).mkdir()
+    cmd = command.Command()
+    assert cmd.dir_list(str(tmp_path)) == ["a", "b", "c"]
+    # the error of a missing directory is not taken as a name
+    assert cmd.dir_list(str(tmp_path / "missing")) == []
+
+
+def test_run_xe_stream(monkeypatch):
+    monkeypatch.setattr(command.constnts, "xe_path", "/bin")
+    cmd = command.Command()
+    calls = []
+    monkeypatch.setattr(cmd, "run_remote", lambda cmd, out_format: calls.append((cmd, out_format)))
+    cmd.run_xe("vm-export uuid=x filename=y", out_format="stream")
+    assert calls == [("/bin/xe vm-export uuid=x filename=y", "stream")]
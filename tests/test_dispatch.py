@@ -0,0 +1,82 @@
+# Built-in modules
+import threading
+import types
+
+# 3ed party modules
+
+# Local modules
+from command import Command
+from dispatch import HostDispatcher
+
+
+def fake_xapi(vms):
+    """
+    A pool of two hosts (xen1 / xen2), the VMs are vm uuid -> (the resident host ref, the SR ref),
+    the SR 'local1' is attached only to xen1, the SR 'shared' to both hosts
+    """
+    pbds = {"local1": [("pbd1", "h1")], "shared": [("pbd2", "h1"), ("pbd3", "h2")]}
+    pbd_hosts = {pbd: host for sr_pbds in pbds.values() for pbd, host in sr_pbds}
+    return types.SimpleNamespace(
+        host=types.SimpleNamespace(
+            get_all_records=lambda: {
+                "h1": {"address": "xen1", "enabled": True},
+                "h2": {"address": "xen2", "enabled": True},
+            }
+        ),
+        VM=types.SimpleNamespace(
+            get_by_uuid=lambda uuid: uuid,
+            get_VBDs=lambda vm: [vm],
+            get_resident_on=lambda vm: vms[vm][0],
+        ),
+        VBD=types.SimpleNamespace(get_VDI=lambda vbd: vbd),
+        VDI=types.SimpleNamespace(get_SR=lambda vdi: vms[vdi][1]),
+        SR=types.SimpleNamespace(get_PBDs=lambda sr: [pbd for pbd, _ in pbds[sr]]),
+        PBD=types.SimpleNamespace(get_currently_attached=lambda pbd: True, get_host=lambda pbd: pbd_hosts[pbd]),
+    )
+
+
+def test_busy_resident_host_uses_a_free_host():
+    xapi = fake_xapi({"vm1": ("h1", "shared"), "vm2": ("h1", "shared")})
+    dispatcher = HostDispatcher(xapi, Command(host="xen1"), mode="affine", host_limit=1)
+    with dispatcher.slot("vm1") as first:
+        with dispatcher.slot("vm2") as second:
+            assert (first.host(), second.host()) == ("xen1", "xen2")
+
+
+def test_waits_for_the_only_host():
+    xapi = fake_xapi({"vm1": ("h1", "shared"), "vm2": ("h2", "local1")})
+    dispatcher = HostDispatcher(xapi, Command(host="xen1"), mode="affine", host_limit=1)
+    hosts = []
+
+    def export():
+        with dispatcher.slot("vm2") as host_cmd:
+            hosts.append(host_cmd.host())
+
+    with dispatcher.slot("vm1") as first:
+        assert first.host() == "xen1"
+        thread = threading.Thread(target=export, daemon=True)
+        thread.start()
+        thread.join(0.3)
+        # vm2 can run only on xen1 (its SR is not attached to xen2)
+        assert thread.is_alive() and hosts == []
+    thread.join(5)
+    assert hosts == ["xen1"]
+
+
+def test_concurrent_exports_spread_on_the_hosts():
+    xapi = fake_xapi({f"vm{i}": ("h1", "shared") for i in range(4)})
+    dispatcher = HostDispatcher(xapi, Command(host="xen1"), mode="affine", host_limit=1)
+    barrier = threading.Barrier(2)
+    running = []
+
+    def export(vm_uuid):
+        with dispatcher.slot(vm_uuid) as host_cmd:
+            running.append(host_cmd.host())
+            barrier.wait(timeout=5)
+
+    threads = [threading.Thread(target=export, args=(f"vm{i}",), daemon=True) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert sorted(running) == ["xen1", "xen2"]
@@ -0,0 +1,139 @@
+# Built-in modules
+import os
+import socket
+import struct
+import threading
+
+# 3ed party modules
+import pytest
+
+# Local modules
+import cbt
+import nbd
+from exporter import Stage
+
+
+class FakeNbdServer:
+    """
+    Serve an image over the fixed newstyle NBD protocol (without TLS), and record the reads
+    """
+
+    def __init__(self, image, go=True):
+        self.image = image
+        self.go = go
+        self.reads = []
+        self._sock = socket.socket()
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(1)
+        self.port = self._sock.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _recv(self, conn, size):
+        data = b""
+        while len(data) < size:
+            data += conn.recv(size - len(data))
+        return data
+
+    def _reply(self, conn, option, reply, data=b""):
+        conn.sendall(struct.pack(">QIII", nbd.REPLY_MAGIC, option, reply, len(data)) + data)
+
+    def _serve(self):
+        conn, _ = self._sock.accept()
+        with conn:
+            conn.sendall(nbd.NBDMAGIC + struct.pack(">QH", nbd.IHAVEOPT, nbd.FLAG_FIXED_NEWSTYLE | nbd.FLAG_NO_ZEROES))
+            self._recv(conn, 4)
+            while True:
+                _, option, length = struct.unpack(">QII", self._recv(conn, 16))
+                self._recv(conn, length)
+                if option == nbd.OPT_GO and self.go:
+                    info = struct.pack(">HQH", nbd.INFO_EXPORT, len(self.image), 0)
+                    self._reply(conn, option, nbd.REP_INFO, info)
+                    self._reply(conn, option, nbd.REP_ACK)
+                    break
+                if option == nbd.OPT_GO:
+                    self._reply(conn, option, nbd.REP_ERR_UNSUP)
+                elif option == nbd.OPT_EXPORT_NAME:
+                    conn.sendall(struct.pack(">QH", len(self.image), 0))
+                    break
+            while True:
+                _, _, command, handle, offset, length = struct.unpack(">IHHQQI", self._recv(conn, 28))
+                if command == nbd.CMD_DISC:
+                    return
+                self.reads.append((offset, length))
+                reply = struct.pack(">IIQ", nbd.SIMPLE_REPLY_MAGIC, 0, handle)
+                conn.sendall(reply + self.image[offset : offset + length])
+
+
+class Collect(Stage):
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+
+@pytest.mark.parametrize("go", [True, False])
+def test_read(go):
+    image = os.urandom(cbt.BLOCK_SIZE * 4)
+    server = FakeNbdServer(image, go=go)
+    client = nbd.NbdClient("127.0.0.1", server.port, "export")
+    assert client.size == len(image)
+    data = bytearray(100)
+    client.read(cbt.BLOCK_SIZE + 5, memoryview(data))
+    client.close()
+    assert data == image[cbt.BLOCK_SIZE + 5 : cbt.BLOCK_SIZE + 105]
+
+
+def test_connect_skips_dead_servers():
+    image = os.urandom(1000)
+    server = FakeNbdServer(image)
+    with socket.socket() as dead:
+        dead.bind(("127.0.0.1", 0))
+        dead_port = dead.getsockname()[1]
+    servers = [
+        {"address": "127.0.0.1", "port": dead_port, "exportname": "export"},
+        {"address": "127.0.0.1", "port": server.port, "exportname": "export"},
+    ]
+    client = nbd.NbdClient.connect(servers)
+    assert client is not None and client.size == 1000
+    client.close()
+
+
+def test_changed_runs():
+    bitmap = bytes([0b11000001])
+    size = cbt.BLOCK_SIZE * 10 + 100
+    assert list(cbt.changed_runs(bitmap, size)) == [
+        (0, 2 * cbt.BLOCK_SIZE),
+        (7 * cbt.BLOCK_SIZE, 3 * cbt.BLOCK_SIZE + 100),  # the last block, and the blocks after the bitmap
+    ]
+
+
+def test_read_only_the_changed_blocks(tmp_path):
+    # the disk grew by 2.5 blocks since the base
+    base = os.urandom(cbt.BLOCK_SIZE * 16)
+    image = bytearray(base) + os.urandom(cbt.BLOCK_SIZE * 5 // 2)
+    image[cbt.BLOCK_SIZE * 2 + 5] ^= 0xFF
+    image[cbt.BLOCK_SIZE * 9] ^= 0xFF
+    bitmap = bytes([0b00100000, 0b01000000])
+    server = FakeNbdServer(bytes(image))
+    client = nbd.NbdClient("127.0.0.1", server.port, "export")
+    collect = Collect()
+    stats = nbd.read_runs(client, cbt.changed_runs(bitmap, client.size), [collect], buffer_size=cbt.BLOCK_SIZE)
+    client.close()
+    assert stats["bytes"] == 2 * cbt.BLOCK_SIZE + len(image) - len(base)
+    assert sum(length for _, length in server.reads) == stats["bytes"]
+
+    # the same delta as filtering the whole disk
+    delta = cbt.DeltaStage(bitmap)
+    delta.next = Collect()
+    delta.write(memoryview(bytes(image)))
+    assert collect.data == delta.next.data
+
+    full, delta_file, bitmap_file, out = [str(tmp_path / name) for name in ["full", "delta", "bitmap", "out"]]
+    for path, data in [(full, base), (delta_file, collect.data), (bitmap_file, bitmap)]:
+        with open(path, "wb") as fh:
+            fh.write(data)
+    cbt.restore_chain([full, (delta_file, bitmap_file, len(image))], out)
+    with open(out, "rb") as fh:
+        assert fh.read() == image
@@ -0,0 +1,79 @@
+# Built-in modules
+import os
+
+# 3ed party modules
+import pytest
+
+# Local modules
+import agent
+import command
+import remote_agent
+
+
+@pytest.fixture
+def local_agent():
+    remote = agent.RemoteAgent([])
+    yield remote
+    remote.close()
+
+
+def test_touch_directory(tmp_path):
+    result = remote_agent.handle({"op": "touch", "path": str(tmp_path)})
+    assert result["ok"]
+    assert os.path.isdir(tmp_path)
+
+
+def test_touch_file(tmp_path):
+    path = tmp_path / "success"
+    assert remote_agent.handle({"op": "touch", "path": str(path)})["ok"]
+    assert path.is_file()
+
+
+def test_agent_stat_directory(tmp_path, local_agent):
+    results = local_agent.request(
+        [
+            {"op": "stat", "path": str(tmp_path)},
+            {"op": "stat", "path": str(tmp_path / "missing")},
+        ]
+    )
+    assert results[0]["ok"] and results[0]["exists"] and results[0]["is_dir"]
+    assert results[1]["ok"] and not results[1]["exists"]
+
+
+def test_command_exists_with_agent(tmp_path):
+    cmd = command.Command()
+    assert cmd.start_agent()
+    try:
+        assert cmd.exists(str(tmp_path)) == 0
+        assert cmd.exists(str(tmp_path / "missing")) == 1
+        assert cmd.path_exists(str(tmp_path)) == 0
+        assert not (tmp_path / "missing").exists()
+    finally:
+        cmd.stop_agent()
+
+
+def test_command_exists_without_agent(tmp_path):
+    cmd = command.Command()
+    assert cmd.exists(str(tmp_path)) == 0
+    assert cmd.exists(str(tmp_path / "missing")) == 1
+
+
+def test_list_hides_dot_names(tmp_path):
+    for name in ["backup-1", ".chunks", ".tmp-x"]:
+        (tmp_path / name).mkdir()
+    (tmp_path / "backup-1" / "success").touch()
+    (tmp_path / "backup-1" / ".checkpoint.tmp").touch()
+    assert remote_agent.op_list(str(tmp_path))["names"] == ["backup-1"]
+    assert remote_agent.op_list(str(tmp_path), glob="*/*")["names"] == ["backup-1/success"]
+    assert remote_agent.op_list(str(tmp_path), glob=".c*")["names"] == [".chunks"]
+
+
+def test_garbled_reply_falls_back_to_shell(tmp_path):
+    (tmp_path / "backup-1").mkdir()
+    cmd = command.Command()
+    # an "agent" that answer every line with garbage
+    cmd._agent = agent.RemoteAgent(["sh", "-c", 'while read line; do echo "{garbled"; done', "sh"])
+    with pytest.raises(agent.AgentError):
+        cmd._agent.request([{"op": "list", "path": str(tmp_path)}])
+    assert cmd.dir_list(str(tmp_path)) == ["backup-1"]
+    assert cmd.batch([{"op": "list", "path": str(tmp_path)}]) is None
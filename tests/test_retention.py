@@ -0,0 +1,88 @@
+# Built-in modules
+import datetime
+
+# 3ed party modules
+import pytest
+
+# Local modules
+from cbt import chain_dependencies
+from retention import DIR_FORMAT, Policy, parse_policy, plan, select_keep
+
+
+def daily_names(days, start=datetime.datetime(2024, 1, 1, 1, 0, 0)):
+    return [(start + datetime.timedelta(days=day)).strftime(DIR_FORMAT) for day in range(days)]
+
+
+def test_parse_policy():
+    default = Policy(3, 7, 4, 12)
+    assert parse_policy("", default) == default
+    assert parse_policy("5", default) == Policy(5, 7, 4, 12)
+    assert parse_policy("2/0/1", default) == Policy(2, 0, 1, 12)
+
+
+@pytest.mark.parametrize("value", ["0", "x", "1/2/3/4/5", "2/-1"])
+def test_parse_policy_invalid(value):
+    with pytest.raises(ValueError):
+        parse_policy(value, Policy(3, 0, 0, 0))
+
+
+def test_last_tier():
+    names = daily_names(10)
+    assert select_keep(names, Policy(3, 0, 0, 0)) == set(names[-3:])
+
+
+def test_daily_tier_keeps_the_newest_of_each_day():
+    start = datetime.datetime(2024, 1, 1, 1, 0, 0)
+    names = [(start + datetime.timedelta(hours=hour)).strftime(DIR_FORMAT) for hour in range(0, 72, 6)]
+    keep = select_keep(names, Policy(1, 3, 0, 0))
+    assert keep == {"backup-20240101-190000", "backup-20240102-190000", "backup-20240103-190000"}
+
+
+def test_weekly_and_monthly_tiers():
+    names = daily_names(100)  # 2024-01-01 (Monday) to 2024-04-09
+    weekly = select_keep(names, Policy(1, 0, 4, 0))
+    # the last day (Tuesday), and the Sundays of the 3 weeks before its week
+    assert sorted(weekly) == [
+        "backup-20240324-010000",
+        "backup-20240331-010000",
+        "backup-20240407-010000",
+        "backup-20240409-010000",
+    ]
+    monthly = select_keep(names, Policy(1, 0, 0, 3))
+    assert sorted(monthly) == ["backup-20240229-010000", "backup-20240331-010000", "backup-20240409-010000"]
+
+
+def test_plan_keeps_failed_and_foreign_directories():
+    names = daily_names(6)
+    failed = "backup-20240110-010000"  # newer than all the successful backups
+    old_failed = names[4]
+    removed, dependencies = plan(names + [failed, "lost+found"], names[:4] + names[5:], Policy(2, 0, 0, 0))
+    # the old unsuccessful backup is removed, the newer one may still be running / retried
+    assert removed == names[:3] + [old_failed]
+    assert dependencies == set()
+
+
+def test_plan_without_successful_backups():
+    names = daily_names(3)
+    assert plan(names, [], Policy(1, 0, 0, 0)) == ([], set())
+
+
+def test_plan_keeps_the_incremental_chain():
+    names = daily_names(6)
+    # a full backup on the first day, and deltas on the next days (each based on the previous one)
+    states = {name: {"base": base} for base, name in zip([None] + names, names)}
+    removed, dependencies = plan(names, names, Policy(2, 0, 0, 0), states=states)
+    assert removed == []
+    assert dependencies == set(names[:4])
+    # a new full backup cut the chain
+    states[names[4]] = {"base": None}
+    removed, dependencies = plan(names, names, Policy(2, 0, 0, 0), states=states)
+    assert removed == names[:4]
+    assert dependencies == set()
+
+
+def test_chain_dependencies():
+    states = {"a": None, "b": {"base": "a"}, "c": {"base": "b"}, "d": {"base": None}}
+    assert chain_dependencies(states, ["c"]) == {"a", "b", "c"}
+    assert chain_dependencies(states, ["d"]) == {"d"}
+    assert chain_dependencies(states, []) == set()
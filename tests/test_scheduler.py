@@ -0,0 +1,137 @@
+# Built-in modules
+import threading
+import time
+import types
+
+# 3ed party modules
+import pytest
+
+# Local modules
+from scheduler import Counters, Pipeline, XenAPIPool, lpt_order, predict_makespan
+
+
+def run_pipeline(jobs, timeout=10):
+    """
+    Run the pipeline in a thread, so a hang fails the test instead of blocking it
+    """
+    counters = Counters()
+    results = []
+    pipeline = Pipeline([("prepare", 1, 1), ("export", 2, 1), ("cleanup", 1, 1)])
+    thread = threading.Thread(target=lambda: results.append(pipeline.run(jobs, counters)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "the pipeline did not end"
+    return results[0], counters
+
+
+def test_duplicate_job_names():
+    stages = (lambda ctx: None, lambda ctx: None, lambda ctx: ctx["status"])
+    jobs = [
+        ("vm-export web", stages, {"status": "success"}),
+        ("vm-export web", stages, {"status": "warning"}),
+        ("vm-export db", stages, {"status": "success"}),
+    ]
+    results, counters = run_pipeline(jobs)
+    assert [status for status, _, _ in results] == ["success", "warning", "success"]
+    assert (counters.success, counters.warning, counters.error) == (2, 1, 0)
+    assert all(set(busy) == {"prepare", "export", "cleanup"} for _, _, busy in results)
+
+
+@pytest.mark.parametrize("error", [RuntimeError("failed"), SystemExit(1)])
+def test_stage_exception_ends_the_job(error):
+    def export(ctx):
+        raise error
+
+    jobs = [("vm-export web", (lambda ctx: None, export, lambda ctx: "success"), {})]
+    results, counters = run_pipeline(jobs)
+    assert results[0][0] == "error"
+    assert counters.error == 1
+
+
+def test_missing_status_is_error():
+    jobs = [("vm-export web", (lambda ctx: None, lambda ctx: None, lambda ctx: None), {})]
+    results, _ = run_pipeline(jobs)
+    assert results[0][0] == "error"
+
+
+def test_lpt_order_and_makespan():
+    jobs = [(name, (), {}) for name in ["a", "b", "c", "d"]]
+    costs = {"a": 1, "b": 4, "c": 2, "d": 3}
+    ordered = lpt_order(jobs, costs)
+    assert [job[0] for job in ordered] == ["b", "d", "c", "a"]
+    assert predict_makespan([costs[job[0]] for job in ordered], 2) == 5
+    assert predict_makespan([1, 2, 3], 1) == 6
+
+
+def test_export_span_matches_the_prediction():
+    seconds = [0.3, 0.2, 0.1]
+    stages = (lambda ctx: None, lambda ctx: time.sleep(ctx["export"]), lambda ctx: time.sleep(0.3) or "success")
+    jobs = [(f"vm-export {i}", stages, {"export": export}) for i, export in enumerate(seconds)]
+    pipeline = Pipeline([("prepare", 1, 1), ("export", 2, 1), ("cleanup", 1, 1)])
+    start = time.monotonic()
+    pipeline.run(jobs, Counters())
+    makespan = time.monotonic() - start
+    # the prediction is of the exports only, the whole run also has the cleanups
+    assert abs(pipeline.spans["export"] - predict_makespan(seconds, 2)) < 0.1
+    assert makespan > pipeline.spans["export"] + 0.2
+
+
+class FakeSession:
+    """
+    A XenAPI session proxy that is not thread safe : fail if two calls overlap
+    """
+
+    def __init__(self):
+        self.busy = False
+        self.logged_out = False
+        self.VM = types.SimpleNamespace(snapshot=self.snapshot)
+        self.session = types.SimpleNamespace(logout=self.logout)
+
+    def snapshot(self, vm, name):
+        assert not self.busy, "concurrent calls on one session"
+        self.busy = True
+        time.sleep(0.2)
+        self.busy = False
+        return f"{vm}/{name}"
+
+    def logout(self):
+        self.logged_out = True
+
+
+def test_xenapi_pool_runs_calls_in_parallel():
+    sessions = [FakeSession()]
+
+    def login():
+        sessions.append(FakeSession())
+        return sessions[-1]
+
+    pool = XenAPIPool(sessions[0], login=login, size=3)
+    results = []
+    threads = [
+        threading.Thread(target=lambda i=i: results.append(pool.VM.snapshot(f"vm{i}", "snap"))) for i in range(6)
+    ]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 6 calls of 0.2 Sec. on 3 sessions
+    assert time.monotonic() - start < 0.6
+    assert sorted(results) == [f"vm{i}/snap" for i in range(6)]
+    assert len(sessions) == 3
+    pool.close()
+    assert [session.logged_out for session in sessions] == [False, True, True]
+
+
+def test_xenapi_pool_without_login_uses_one_session():
+    session = FakeSession()
+    pool = XenAPIPool(session)
+    results = []
+    threads = [
+        threading.Thread(target=lambda i=i: results.append(pool.VM.snapshot(f"vm{i}", "snap"))) for i in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 3
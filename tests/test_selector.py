@@ -0,0 +1,120 @@
+# Built-in modules
+import re
+
+# 3ed party modules
+import pytest
+
+# Local modules
+from inventory import Inventory
+from selector import Selector, format_selection, literal_prefix, parse_definition, parse_size
+
+GB = 1024**3
+
+
+@pytest.fixture
+def inventory():
+    inventory = Inventory(None)
+    vms = {
+        "vm-web1": {"name_label": "web-1", "tags": ["nightly"], "power_state": "Running", "resident_on": "h1"},
+        "vm-web2": {"name_label": "web-2", "other_config": {"backup": "yes"}, "power_state": "Halted"},
+        "vm-db1": {"name_label": "db-1", "tags": ["weekly"], "power_state": "Running", "affinity": "h2"},
+        "vm-snap": {"name_label": "web-1", "tags": ["nightly"], "is_a_snapshot": True},
+    }
+    inventory.add_records(
+        {
+            "VM": {ref: dict(record, uuid=f"{ref}-uuid") for ref, record in vms.items()},
+            "host": {"h1": {"uuid": "h1-uuid", "name_label": "xen1"}, "h2": {"uuid": "h2-uuid", "name_label": "xen2"}},
+            "SR": {"sr1": {"uuid": "sr1-uuid", "name_label": "fast-ssd"}},
+            "VDI": {
+                "vdi1": {"uuid": "vdi1-uuid", "virtual_size": str(200 * GB), "SR": "sr1"},
+                "vdi2": {"uuid": "vdi2-uuid", "virtual_size": str(20 * GB), "SR": "sr1"},
+            },
+            "VBD": {
+                "vbd1": {"uuid": "vbd1-uuid", "VM": "vm-db1", "VDI": "vdi1", "type": "Disk"},
+                "vbd2": {"uuid": "vbd2-uuid", "VM": "vm-web1", "VDI": "vdi2", "type": "Disk"},
+            },
+        }
+    )
+    return inventory
+
+
+def test_parse_definition():
+    assert parse_definition("vm1") == ("vm1", "")
+    assert parse_definition(" vm1:3 ") == ("vm1", "3")
+    assert parse_definition("'web-.*':2") == ("web-.*", "2")
+    assert parse_definition("tag:nightly") == ("tag:nightly", "")
+    assert parse_definition("tag:nightly:4") == ("tag:nightly", "4")
+
+
+def test_parse_size():
+    assert parse_size(">100G") == (">", 100 * GB)
+    assert parse_size("<=1.5T") == ("<=", int(1.5 * 1024 * GB))
+    assert parse_size("512M") == ("=", 512 * 1024**2)
+    with pytest.raises(ValueError):
+        parse_size("big")
+
+
+def test_literal_prefix():
+    assert literal_prefix("web-.*") == "web-"
+    assert literal_prefix("web-0[0-4]$") == "web-0"
+    assert literal_prefix("webs?-1") == "web"
+    assert literal_prefix("web|db") == ""
+    assert literal_prefix(".*-99$") == ""
+
+
+def test_exact_names_and_regexes():
+    selector = Selector(["vm1:3", "web-.*", "web-2:5", "''"])
+    assert selector.select(["vm1", "vm2", "web-1", "web-2", "my-web-1"]) == {
+        "vm1": "3",
+        "web-1": "",
+        "web-2": "5",
+    }
+
+
+def test_last_definition_takes_precedence():
+    selector = Selector(["web-2:5", "web-.*:1", "db-[0-9]+:2", "db-1:7", ".*-1$:9"])
+    assert selector.select(["web-1", "web-2", "db-1", "db-2"]) == {
+        "web-1": "9",
+        "web-2": "1",
+        "db-1": "9",
+        "db-2": "2",
+    }
+
+
+def test_regexes_with_back_references():
+    # numbered groups cannot be combined in one alternation, they are matched one by one
+    selector = Selector([r"(a)\1-.*:2", "aa-1"])
+    assert selector.select(["aa-1", "aa-2", "ab-1"]) == {"aa-1": "", "aa-2": "2"}
+
+
+def test_invalid_regex():
+    with pytest.raises(re.error):
+        Selector(["web-[0-9"])
+
+
+def test_properties(inventory):
+    assert Selector(["tag:nightly:4"], inventory).select(["web-1", "web-2", "db-1"]) == {"web-1": "4"}
+    assert Selector(["other_config:backup=yes"], inventory).select(["web-1", "web-2"]) == {"web-2": ""}
+    assert Selector(["other_config:backup"], inventory).select(["web-1", "web-2"]) == {"web-2": ""}
+    assert set(Selector(["sr:fast-ssd"], inventory).select(["web-1", "web-2", "db-1"])) == {"web-1", "db-1"}
+    assert set(Selector(["sr:sr1-uuid"], inventory).select(["web-1", "web-2", "db-1"])) == {"web-1", "db-1"}
+    # resident on the host, or with affinity to it
+    assert Selector(["host:xen1"], inventory).select(["web-1", "web-2", "db-1"]) == {"web-1": ""}
+    assert Selector(["host:h2-uuid"], inventory).select(["web-1", "web-2", "db-1"]) == {"db-1": ""}
+    assert set(Selector(["power:running"], inventory).select(["web-1", "web-2", "db-1"])) == {"web-1", "db-1"}
+
+
+def test_size(inventory):
+    names = ["web-1", "web-2", "db-1"]
+    assert Selector(["size:>100G"], inventory).select(names) == {"db-1": ""}
+    assert set(Selector(["size:<=20G"], inventory).select(names)) == {"web-1", "web-2"}
+    assert Selector(["size:=0"], inventory).select(names) == {"web-2": ""}
+
+
+def test_properties_need_the_inventory():
+    with pytest.raises(ValueError):
+        Selector(["tag:nightly"])
+
+
+def test_format_selection():
+    assert format_selection({"vm1": "3", "web-1": ""}) == ["vm1:3", "web-1"]
@@ -0,0 +1,109 @@
+# Built-in modules
+import subprocess
+
+# 3ed party modules
+import pytest
+
+# Local modules
+import command
+import sshpool
+
+
+class FakeSsh:
+    """
+    Replace the ssh client of the pool : the masters connect, and the check of the
+    lost control paths fail
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.lost = set()
+
+    def __call__(self, args, **kwargs):
+        self.calls.append(args)
+        path = next(arg.split("=", 1)[1] for arg in args if arg.startswith("ControlPath="))
+        rc = 0
+        if "-M" in args:
+            open(path, "w").close()
+        elif "check" in args:
+            rc = 255 if path in self.lost else 0
+        return subprocess.CompletedProcess(args, rc, b"", b"")
+
+    def ops(self, op):
+        return [args for args in self.calls if op in args]
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    fake = FakeSsh()
+    monkeypatch.setattr(sshpool.subprocess, "run", fake)
+    pool = sshpool.SshPool(size=2, control_dir=str(tmp_path))
+    yield pool, fake
+    pool.close()
+
+
+def control_path(args):
+    return next(arg.split("=", 1)[1] for arg in args if arg.startswith("ControlPath="))
+
+
+def test_reconnect_keeps_live_master(pool):
+    pool, fake = pool
+    args = pool.args("root", "xen1")
+    assert not pool.reconnect("root", "xen1", args)
+    assert fake.ops("exit") == []
+
+
+def test_reconnect_only_the_lost_slot(pool):
+    pool, fake = pool
+    first, second = pool.args("root", "xen1"), pool.args("root", "xen1")
+    fake.lost.add(control_path(first))
+    assert pool.reconnect("root", "xen1", first)
+    assert [control_path(args) for args in fake.ops("exit")] == [control_path(first)]
+    assert pool.stats()["root@xen1"]["reconnects"] == 1
+    # the lost slot is opened again, the other is reused
+    assert control_path(pool.args("root", "xen1")) == control_path(first)
+    assert len(fake.ops("-M")) == 3
+    pool.args("root", "xen1")
+    assert len(fake.ops("-M")) == 3
+    assert control_path(second) != control_path(first)
+
+
+@pytest.mark.parametrize(
+    "cmd, read_only",
+    [
+        ("ls /backups", True),
+        ("/opt/xensource/bin/xe vm-list uuid=1 params=uuid", True),
+        ("/opt/xensource/bin/xe vm-snapshot vm=1 new-name-label=x", False),
+        ("/opt/xensource/bin/xe vdi-destroy uuid=1", False),
+        ("rm -rf /backups/vm1", False),
+        ("echo 'line' >> /backups/file", False),
+    ],
+)
+def test_is_read_only(cmd, read_only):
+    assert command.is_read_only(cmd) == read_only
+
+
+@pytest.mark.parametrize("cmd, runs", [("ls /backups", 2), ("rm -rf /backups/vm1", 1)])
+def test_run_remote_retry_only_read_only(pool, monkeypatch, cmd, runs):
+    pool, fake = pool
+    cmd_obj = command.Command(host="xen1", pool=pool)
+    ran = []
+
+    def run(args, timeout=600, **kwargs):
+        ran.append(args)
+        fake.lost.add(control_path(args))
+        return sshpool.SSH_ERROR, ""
+
+    monkeypatch.setattr(cmd_obj, "_run", run)
+    assert cmd_obj.run_remote(cmd, out_format="rc") == sshpool.SSH_ERROR
+    assert len(ran) == runs
+
+
+def test_run_remote_no_retry_when_master_alive(pool, monkeypatch):
+    pool, fake = pool
+    cmd_obj = command.Command(host="xen1", pool=pool)
+    ran = []
+    monkeypatch.setattr(cmd_obj, "_run", lambda args, **kwargs: ran.append(args) or (sshpool.SSH_ERROR, ""))
+    cmd_obj.run_remote("ls /backups", out_format="rc")
+    assert len(ran) == 1
+    assert fake.ops("exit") == []
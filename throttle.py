@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+This module contain the bandwidth throttle of the exports.
+
+The export data pass through a ThrottleStage, that take tokens (bytes) from
+token buckets - one global bucket, one bucket per host (the dom0 / NIC that
+stream the export) and one bucket per SR (the storage the disks are read
+from), so an export is limited by the most restrictive of them.
+
+With the adaptive mode, the rate of each bucket follow the contention : the
+latency probe is the time the export stream take to deliver the data (seconds
+per MB, without the throttle waits). When it grow over latency_factor times
+the lowest latency seen, the rate is halved (down to MIN_RATE), otherwise it
+grow back (by 25%) up to the configured limit.
+
+The limits can be changed while the backups are running (Throttle.apply),
+e.g. on SIGHUP, or by the control file that is polled by the monitor thread.
+The control file contain the throttle keys of the configuration file :
+
+    throttle_rate = 100
+    throttle_sr_rate = 40
+    throttle_host_rate = 0
+    throttle_adaptive = true
+"""
+# Built-in modules
+import configparser
+import logging
+import os
+import threading
+import time
+
+# 3ed party modules
+
+# Local modules
+from exporter import Stage
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+MIN_RATE = 1 * MB
+ADJUST_INTERVAL = 5
+CONTROL_INTERVAL = 2
+THROTTLE_KEYS = ["throttle_rate", "throttle_sr_rate", "throttle_host_rate", "throttle_adaptive"]
+
+
+class TokenBucket:
+    def __init__(self, name, limit=0, latency_factor=2.0):
+        """
+        Initialize the token bucket
+
+        Args:
+            name (str): the bucket name (for the log)
+            limit (float): the configured rate limit in bytes per second, 0 for unlimited
+            latency_factor (float): the adaptive mode back off when the latency grow by this factor
+        """
+        self.name = name
+        self.limit = limit
+        self.rate = limit  # the current rate, lower than the limit when the adaptive mode backed off
+        self.adaptive = False
+        self.latency_factor = latency_factor
+        self.waited = 0.0
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        # the adaptive mode observations of the current interval
+        self._bytes = 0
+        self._read_time = 0.0
+        self._interval_start = self._last
+        self._min_latency = None
+        self._peak_throughput = 0.0
+
+    def set_limit(self, limit, adaptive=False):
+        with self._lock:
+            self.limit = limit
+            self.rate = limit
+            self.adaptive = adaptive
+            self._tokens = min(self._tokens, float(limit))
+
+    def reserve(self, size):
+        """
+        Take size tokens from the bucket. The bucket can go into debt, so a
+        block bigger than the burst (one second of the rate) wait for its
+        time, and the next block wait for the debt.
+
+        Args:
+            size (int): the number of bytes
+
+        Return:
+            float : the number of seconds to wait until the tokens are available
+        """
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._last) * self.rate, float(self.rate))
+            self._last = now
+            self._tokens -= size
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waited += wait
+        return wait
+
+    def observe(self, size, read_time):
+        """
+        Record how long the export stream took to deliver size bytes, and
+        adjust the rate at the end of each interval (adaptive mode)
+
+        Args:
+            size (int): the number of bytes
+            read_time (float): the seconds it took to read them (without the throttle waits)
+        """
+        with self._lock:
+            if not self.adaptive:
+                return
+            self._bytes += size
+            self._read_time += read_time
+            now = time.monotonic()
+            elapsed = now - self._interval_start
+            if elapsed < ADJUST_INTERVAL or self._bytes < MB:
+                return
+            latency = self._read_time / (self._bytes / MB)
+            throughput = self._bytes / elapsed
+            self._bytes, self._read_time, self._interval_start = 0, 0.0, now
+            self._peak_throughput = max(self._peak_throughput, throughput)
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+                return
+            if latency > self._min_latency * self.latency_factor:
+                current = self.rate if self.rate > 0 else throughput
+                self.rate = max(current / 2, MIN_RATE)
+                logger.info(f"Throttle {self.name}: contention (latency {latency:.3f} s/MB), {self.rate / MB:.1f} MB/s")
+            elif self.rate > 0 and self.rate != self.limit:
+                self.rate *= 1.25
+                if self.limit > 0 and self.rate >= self.limit:
+                    self.rate = self.limit
+                elif self.limit <= 0 and self.rate >= self._peak_throughput * 2:
+                    self.rate = 0
+                logger.info(f"Throttle {self.name}: recovered to {self.rate / MB:.1f} MB/s")
+
+
+class Throttle:
+    def __init__(self, rate=0, sr_rate=0, host_rate=0, adaptive=False, latency_factor=2.0):
+        """
+        Initialize the throttle, see apply() for the arguments (MB per second, 0 for unlimited)
+        """
+        self._lock = threading.Lock()
+        self._settings = {"throttle_rate": 0, "throttle_sr_rate": 0, "throttle_host_rate": 0}
+        self._adaptive = False
+        self._latency_factor = latency_factor
+        self._global = TokenBucket("global", latency_factor=latency_factor)
+        self._buckets = {}  # "host:<address>" / "sr:<uuid>" -> TokenBucket
+        self._monitor = None
+        self._stop = threading.Event()
+        self.apply(
+            {
+                "throttle_rate": rate,
+                "throttle_sr_rate": sr_rate,
+                "throttle_host_rate": host_rate,
+                "throttle_adaptive": adaptive,
+            }
+        )
+
+    def _bucket_limit(self, key):
+        setting = "throttle_host_rate" if key.startswith("host:") else "throttle_sr_rate"
+        return self._settings[setting] * MB
+
+    def apply(self, values):
+        """
+        Change the limits, the running exports use the new limits from their next block
+
+        Args:
+            values (dict): the throttle keys to change (rates in MB per second, 0 for unlimited,
+                           throttle_adaptive as bool or 'true' / 'false'), the missing keys are not changed
+        """
+        with self._lock:
+            for key in THROTTLE_KEYS:
+                if key not in values:
+                    continue
+                if key == "throttle_adaptive":
+                    self._adaptive = str(values[key]).lower() == "true"
+                else:
+                    self._settings[key] = float(values[key])
+            self._global.set_limit(self._settings["throttle_rate"] * MB, self._adaptive)
+            for key, bucket in self._buckets.items():
+                bucket.set_limit(self._bucket_limit(key), self._adaptive)
+            settings = dict(self._settings, throttle_adaptive=self._adaptive)
+        logger.info(f"Throttle settings : {settings}")
+
+    def buckets(self, host="", srs=()):
+        """
+        Args:
+            host (str): the address of the host that stream the export
+            srs (iterable): the UUIDs of the SRs that the exported disks are on
+
+        Return:
+            list : the token buckets that limit the export
+        """
+        keys = [f"host:{host}"] + [f"sr:{sr}" for sr in sorted(srs)]
+        with self._lock:
+            for key in keys:
+                if key not in self._buckets:
+                    self._buckets[key] = TokenBucket(key, latency_factor=self._latency_factor)
+                    self._buckets[key].set_limit(self._bucket_limit(key), self._adaptive)
+            return [self._global] + [self._buckets[key] for key in keys]
+
+    def stage(self, host="", srs=()):
+        """
+        Return:
+            ThrottleStage : the stage that limit an export, see buckets()
+        """
+        return ThrottleStage(self.buckets(host, srs))
+
+    def _watch(self, path):
+        mtime = None
+        while not self._stop.wait(CONTROL_INTERVAL):
+            try:
+                current = os.stat(path).st_mtime
+                if current == mtime:
+                    continue
+                mtime = current
+                with open(path, "r") as fh:
+                    parser = configparser.ConfigParser()
+                    parser.read_string("[throttle]\n" + fh.read())
+                self.apply(dict(parser["throttle"]))
+                logger.info(f"Throttle control file {path} loaded")
+            except FileNotFoundError:
+                mtime = None
+            except (OSError, ValueError, configparser.Error) as ex:
+                logger.warning(f"Invalid throttle control file {path} : {ex}")
+
+    def watch(self, path):
+        """
+        Start the monitor thread, that apply the control file when it is changed
+
+        Args:
+            path (str): the control file path
+        """
+        self._monitor = threading.Thread(target=self._watch, args=(path,), name="throttle-control", daemon=True)
+        self._monitor.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._monitor is not None:
+            self._monitor.join()
+
+    def report(self):
+        """
+        Log how long the exports waited for each bucket
+        """
+        with self._lock:
+            for bucket in [self._global] + [self._buckets[key] for key in sorted(self._buckets)]:
+                if bucket.waited > 0:
+                    logger.info(f"Throttle {bucket.name}: waited {bucket.waited:.1f} Sec.")
+
+
+class ThrottleStage(Stage):
+    def __init__(self, buckets):
+        """
+        Limit the rate of the data that pass through the stage (the first
+        stage of the chain, so the time between the writes is the time the
+        export stream took to deliver the data)
+
+        Args:
+            buckets (list): the TokenBuckets to take the tokens from
+        """
+        super().__init__()
+        self._buckets = buckets
+        self._returned = None
+        self.waited = 0.0
+
+    def write(self, data):
+        now = time.monotonic()
+        if self._returned is not None:
+            for bucket in self._buckets:
+                bucket.observe(len(data), now - self._returned)
+        wait = max(bucket.reserve(len(data)) for bucket in self._buckets)
+        if wait > 0:
+            time.sleep(wait)
+            self.waited += wait
+        super().write(data)
+        self._returned = time.monotonic()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    throttle = Throttle(rate=20, sr_rate=10)
+    stage = throttle.stage("xen1", ["sr-1"])
+    stage.next = Stage()
+    stage.next.write = lambda data: None
+    start = time.monotonic()
+    for _ in range(5):
+        stage.write(memoryview(bytes(4 * MB)))
+    print(f"20 MB in {time.monotonic() - start:.1f} Sec. (limit 10 MB/s)")
+    throttle.report()
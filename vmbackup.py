@@ -4,11 +4,15 @@
 import configparser
 import datetime
 from email.mime.text import MIMEText
+import http.client
 import logging
 import re
+import signal
 import smtplib
 import socket
+import sqlite3
 import sys
+import threading
 import time
 
 # 3ed Party modules
@@ -16,8 +20,34 @@ import XenAPI
 
 # Local modules
 import argument
+from backend import get_backend
+from cache import CachedXenAPI, TTLCache
+import cbt
+import checkpoint
+from chunkstore import ChunkStage, ChunkStore
 from command import Command
+from compression import CODECS, ParallelCompressStage, check_codec
 from constnts import *
+from dispatch import HostDispatcher
+from exporter import (
+    WRITE_STRATEGIES,
+    ChecksumStage,
+    ExportError,
+    FileWriter,
+    GzipStage,
+    HttpExporter,
+    LargeFileWriter,
+    SparseFileWriter,
+)
+import integrity
+import retention
+from inventory import load_inventory
+import nbd
+from scheduler import Counters, History, Pipeline, XenAPIPool, estimate_costs, lpt_order, predict_makespan
+from selector import Selector, format_selection, parse_definition
+from sshpool import SshPool
+from target import get_target
+from throttle import Throttle
 
 # ############################ HARD CODED DEFAULTS ##########################
 # Some global constants
@@ -31,11 +61,19 @@ all_vms = list()  # list of all VMs in the Xen-Server
 vdi_export = list()  # list of vm for the vdi-export operation
 backup_vms = list()  # list of vms to back up
 message = ""
+status_log_lock = threading.Lock()  # the backup workers write to the same status log
 cmd = Command()
-
-vm_uuid = ""
-xvda_uuid = ""
-xvda_name_label = ""
+xapi = None  # the XenAPI session proxy, with cached read-only calls
+cache = None  # TTLCache of the read-only xe / XenAPI calls and directories listing
+backend = None  # the Backend that run the snapshot / cleanup operations
+dispatcher = None  # the HostDispatcher that choose the host of each export
+session_ref = ""  # the XenAPI session reference, for the HTTP exports
+chunk_store = None  # the ChunkStore of the deduplicated backups, see get_chunk_store()
+chunk_store_lock = threading.Lock()
+throttle = None  # the Throttle of the HTTP exports bandwidth
+target = None  # the Target that store the backups, see get_target()
+inventory = None  # the Inventory of the pool objects, see get_inventory()
+inventory_lock = threading.Lock()
 
 # Setting up and reading the configuration file
 # Note: all default variables should be in this file and also optionally some
@@ -93,22 +131,25 @@ def debug(msg):
     logger.debug(msg=msg)
 
 
-def select_vms(source_list):
-    global all_vms
-    tmp_list = list()
-    for inc_vm in source_list:
-        for svm in all_vms:
-            new_value, found_match = check_vm_in_server(inc_vm, svm)
-            if found_match:
-                tmp_list.append(new_value)
-                verbose(f"The vm {new_value} Exist !")
-        return tmp_list
+def select_vms(definitions, vms):
+    """
+    Select the VMs by the configuration definitions
+
+    Args:
+        definitions (list): the definitions, <name or regex>[:<max backups>] or <property>:<value>[:<max backups>]
+        vms (list): the VM names to select from
+
+    Return:
+        list : the <name>[:<max backups>] of the selected VMs
+    """
+    selected = format_selection(Selector(definitions, get_inventory()).select(vms))
+    for vm_parm in selected:
+        verbose(f"The vm {vm_parm} Exist !")
+    return selected
 
 
 def main(session):
-    success_cnt = 0
-    warning_cnt = 0
-    error_cnt = 0
+    counters = Counters()
 
     server_name = os.uname()[1].split(".")[0]
 
@@ -126,7 +167,7 @@ def main(session):
     )
 
     verbose(f"Try to create {touchfile}")
-    if not cmd.path_exists(touchfile) == 0:
+    if not target.path_exists(touchfile) == 0:
         verbose(
             "Failed to write to backup directory area - FATAL ERROR",
             level=logging.ERROR,
@@ -134,7 +175,7 @@ def main(session):
         sys.exit(1)
 
     else:
-        cmd.path_delete(touchfile)
+        target.path_delete(touchfile)
         verbose("Success: backup directory area is writable")
 
     verbose()
@@ -143,403 +184,1258 @@ def main(session):
     if int(config.get(section, "pool_db_backup", fallback=DEFAULT_POOL_DB_BACKUP)):
         verbose("*** begin backup_pool_metadata ***")
         if not backup_pool_metadata(server_name):
-            error_cnt += 1
-
-    # Iterate through all vdi-export= in cfg
-    title("vdi-export=")
-    for vm_parm in vdi_export:
-        verbose(f"*** vdi-export begin {vm_parm} ***")
-        beginTime = datetime.datetime.now()
-        this_status = "success"
-
-        # get values from vdi-export=
-        vm_name = get_vm_name(vm_parm)
-        vm_max_backups = get_vm_max_backups(vm_parm)
-        verbose(f"vdi-export - vm_name: {vm_name} max_backups: {vm_max_backups}")
-
-        status_log_vdi_export_begin(server_name, vm_name)
-
-        # verify vm_name exists with only one instance for this name returns error-message or vm_object if success
-        vm_object = verify_vm_name(vm_name)
-        if "ERROR" in vm_object:
-            verbose(f"verify_vm_name: {vm_object}")
-            status_log_vdi_export_end(server_name, f"ERROR verify_vm_name {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
+            counters.add("error")
+
+    # Run the vdi-export= and the vm-export= of the cfg through the backup pipeline, longest first
+    vdi_stages = (backup_vdi_export_prepare, backup_vdi_export_export, backup_vdi_export_finalize)
+    vm_stages = (backup_vm_export_prepare, backup_vm_export_export, backup_vm_export_finalize)
+    jobs = [
+        (f"vdi-export {get_vm_name(vm_parm)}", vdi_stages, {"vm_parm": vm_parm, "server_name": server_name})
+        for vm_parm in vdi_export
+    ]
+    jobs += [
+        (f"vm-export {get_vm_name(vm_parm)}", vm_stages, {"vm_parm": vm_parm, "server_name": server_name})
+        for vm_parm in backup_vms
+    ]
+    max_parallel = int(config.get(section, "max_parallel_exports", fallback=DEFAULT_MAX_PARALLEL_EXPORTS))
+    history = History(get_history_file())
+    sizes = {job[0]: get_export_size(get_vm_name(job[2]["vm_parm"]), job[0].split()[0]) for job in jobs}
+    costs, in_seconds = estimate_costs(sizes, history)
+    jobs = lpt_order(jobs, costs)
+    predicted = predict_makespan([costs[job[0]] for job in jobs], max_parallel)
+    if in_seconds:
+        verbose(f"Predicted exports time : {predicted / 60:.1f} Minute")
+    else:
+        verbose(f"Predicted exports time : {predicted / (1024 ** 3):.1f} GB on the longest worker (no history yet)")
+
+    queue_size = config.get(section, "pipeline_queue_size", fallback=DEFAULT_PIPELINE_QUEUE_SIZE)
+    pipeline = Pipeline(
+        [
+            ("prepare", config.get(section, "prepare_workers", fallback=DEFAULT_PREPARE_WORKERS), queue_size),
+            ("export", max_parallel, queue_size),
+            ("cleanup", config.get(section, "cleanup_workers", fallback=DEFAULT_CLEANUP_WORKERS), queue_size),
+        ]
+    )
+    title(f"backup of {len(jobs)} vm(s), {max_parallel} export(s) in parallel")
+    start = time.monotonic()
+    results = pipeline.run(jobs, counters)
+    makespan = time.monotonic() - start
+    verbose(f"Backups time : {makespan / 60:.1f} Minute")
+    if in_seconds:
+        # the prediction is of the export stage only (the costs are the exports busy time), so it is compared
+        # with the time from the first export start to the last export end, not with the whole pipeline run
+        exports_time = pipeline.spans.get("export", 0.0)
+        verbose(f"Predicted vs. actual exports time : {predicted / 60:.1f} / {exports_time / 60:.1f} Minute")
+    for (name, _, _), (status, duration, busy) in zip(jobs, results):
+        if status != "error":
+            # the export time (without the time in the queues), the predicted exports time is of the exports
+            history.update(name, busy.get("export", duration), sizes[name])
+    history.save()
+    if chunk_store is not None:
+        chunk_store.gc()
+        stats = chunk_store.stats()
+        verbose(
+            f"Chunk store : {stats['stored'] / (1024 ** 3):.2f} GB stored for "
+            f"{stats['referenced'] / (1024 ** 3):.2f} GB of backups"
+        )
+    ######################################################################
 
-        vm_backup_dir = os.path.join(config.get(section, "backup_dir", fallback=DEFAULT_BACKUP_DIR), vm_name)
-        # cleanup any old unsuccessful backups and create new full_backup_dir
-        full_backup_dir = process_backup_dir(vm_backup_dir)
-        # gather_vm_meta produces status: empty or warning-message
-        #   and globals: vm_uuid, xvda_uuid, xvda_uuid
-        #   => now only need: vm_uuid
-        #   since all VM metadta go into an XML file
-        vm_meta_status = gather_vm_meta(vm_object, full_backup_dir)
-        debug(f"The VM meta status is : {vm_meta_status}")
-        if vm_meta_status != "":
-            verbose(f"Couldn't gather vm meta: {vm_meta_status}", level=logging.WARNING)
-            this_status = "warning"
-            # non-fatal - finsh processing for this vm
+    verbose()
+    df_snapshots(f"Space status", min_capacity=1)
 
-        debug(f"The VXDA UUID is : {xvda_uuid}")
-        # vdi-export only uses xvda_uuid, xvda_uuid
-        if xvda_uuid == "":
-            verbose("gather_vm_meta has no xvda-uuid", level=logging.ERROR)
-            status_log_vdi_export_end(server_name, f"ERROR xvda-uuid not found {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
-        debug(f"The VXDA name is : {xvda_name_label}")
-        if xvda_name_label == "":
-            verbose("gather_vm_meta has no xvda-name-label", level=logging.ERROR)
-            status_log_vdi_export_end(server_name, f"ERROR xvda-name-label not found {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
+    cmd.stop_agent()
+    if cmd.pool() is not None:
+        cmd.pool().report()
+    dispatcher.report()
+    throttle.stop()
+    throttle.report()
+    if cache is not None:
+        cache.report()
 
-        # -----------------------------------------
-        # --- begin vdi-export command sequence ---
-        verbose("*** vdi-export begin xe command sequence")
-        # is vm currently running?
-        if cmd.check_if_vm_is_running(vm_name):
-            verbose(f"The vm {vm_name} is running")
-        else:
-            verbose(f"The vm {vm_name }is NOT running")
-
-        # list the vdi we will back up
-        command = f"vdi-list uuid={xvda_uuid}"
-        verbose(f"1.cmd: {command}")
-        if cmd.run_xe(command, out_format="rc") != 0:
-            verbose(f"ERROR {command}", level=logging.ERROR)
-            status_log_vdi_export_end(server_name, f"VDI-LIST-FAIL {vm_name}")
-            error_cnt += 1
-            # next vm
+    # gather a final vmbackup.py status
+    summary = f"Success:{counters.success}; Warnings:{counters.warning}; Errors:{counters.error}"
+
+    status_log = config.get(section, "status_log", fallback=DEFAULT_STATUS_LOG)
+    sub_suffix = f"{os.uname()[1]} {BASE_NAME}.py"
+    if counters.error > 0:
+        status_log_end(server_name, f"ERROR,{summary}")
+        send_email(f"ERROR {sub_suffix}", status_log)
+        verbose(f"{BASE_NAME} ended - ** ERRORS DETECTED ** - {summary}")
+    elif counters.warning > 0:
+        status_log_end(server_name, f"WARNING,{summary}")
+        send_email(f"WARNING {sub_suffix}", status_log)
+        verbose(f"{BASE_NAME} ended - ** WARNING(s) ** - {summary}")
+    else:
+        status_log_end(server_name, f"SUCCESS,{summary}")
+        send_email(f"Success {sub_suffix}", status_log)
+        verbose(f"{BASE_NAME} ended - Success - {summary}")
+
+    # done with main()
+    ######################################################################
+
+
+def backup_vdi_export_prepare(job):
+    """
+    First vdi-export stage: verify the VM, gather its metadata, and take a snapshot
+
+    Args:
+        job (dict): the backup job context, passed from stage to stage
+
+    Return:
+        str : the backup status (success / warning / error) if the backup ended, None to continue to the next stage
+    """
+    vm_parm = job["vm_parm"]
+    server_name = job["server_name"]
+
+    verbose(f"*** vdi-export begin {vm_parm} ***")
+    beginTime = datetime.datetime.now()
+    this_status = "success"
+
+    # get values from vdi-export=
+    vm_name = get_vm_name(vm_parm)
+    vm_retention = get_vm_retention(vm_parm)
+    verbose(f"vdi-export - vm_name: {vm_name} retention: {format_policy(vm_retention)}")
+
+    status_log_vdi_export_begin(server_name, vm_name)
+
+    # verify vm_name exists with only one instance for this name returns error-message or vm_object if success
+    vm_object = verify_vm_name(vm_name)
+    if "ERROR" in vm_object:
+        verbose(f"verify_vm_name: {vm_object}")
+        status_log_vdi_export_end(server_name, f"ERROR verify_vm_name {vm_name}")
+        return "error"
+
+    vm_backup_dir = os.path.join(config.get(section, "backup_dir", fallback=DEFAULT_BACKUP_DIR), vm_name)
+    full_backup_dir, resume_state = find_resumable_backup(vm_backup_dir, vm_name)
+    if full_backup_dir is not None:
+        verbose(f"Resuming the backup {full_backup_dir} from {resume_state['offset']} bytes")
+    else:
+        # cleanup any old unsuccessful backups and create new full_backup_dir
+        full_backup_dir = process_backup_dir(vm_backup_dir)
+        if full_backup_dir is None:
+            status_log_vdi_export_end(server_name, f"VDI-MKDIR-FAIL {vm_name}")
+            return "error"
+    # gather_vm_meta produces status: empty or warning-message
+    #   and the vm metadata: vm_uuid, xvda_uuid, xvda_name_label
+    #   => now only need: vm_uuid
+    #   since all VM metadta go into an XML file
+    vm_meta_status, vm_meta = gather_vm_meta(vm_object, full_backup_dir)
+    xvda_uuid = vm_meta["xvda_uuid"]
+    xvda_name_label = vm_meta["xvda_name_label"]
+    debug(f"The VM meta status is : {vm_meta_status}")
+    if vm_meta_status != "":
+        verbose(f"Couldn't gather vm meta: {vm_meta_status}", level=logging.WARNING)
+        this_status = "warning"
+        # non-fatal - finsh processing for this vm
+
+    debug(f"The VXDA UUID is : {xvda_uuid}")
+    # vdi-export only uses xvda_uuid, xvda_uuid
+    if xvda_uuid == "":
+        verbose("gather_vm_meta has no xvda-uuid", level=logging.ERROR)
+        status_log_vdi_export_end(server_name, f"ERROR xvda-uuid not found {vm_name}")
+        return "error"
+    debug(f"The VXDA name is : {xvda_name_label}")
+    if xvda_name_label == "":
+        verbose("gather_vm_meta has no xvda-name-label", level=logging.ERROR)
+        status_log_vdi_export_end(server_name, f"ERROR xvda-name-label not found {vm_name}")
+        return "error"
+
+    # -----------------------------------------
+    # --- begin vdi-export command sequence ---
+    verbose("*** vdi-export begin xe command sequence")
+    # is vm currently running?
+    if backend.is_vm_running(vm_name):
+        verbose(f"The vm {vm_name} is running")
+    else:
+        verbose(f"The vm {vm_name }is NOT running")
+
+    # list the vdi we will back up
+    command = f"vdi-list uuid={xvda_uuid}"
+    verbose(f"1.{backend.name}: {command}")
+    if not backend.vdi_exists(xvda_uuid):
+        verbose(f"ERROR {command}", level=logging.ERROR)
+        status_log_vdi_export_end(server_name, f"VDI-LIST-FAIL {vm_name}")
+        return "error"
+
+    # check for old vdi-snapshot for this xvda
+    snap_vdi_name_label = f"SNAP_{vm_name}_{xvda_name_label}"
+    # replace all spaces with '-'
+    snap_vdi_name_label = re.sub(r" ", r"-", snap_vdi_name_label)
+    verbose(f"check for prev-vdi-snapshot: {snap_vdi_name_label}")
+    results = backend.find_vdi_by_name(snap_vdi_name_label)
+    debug(f"List of all snaps is : {results}")
+    for old_snap_vdi_uuid in results:
+        if resume_state is not None and old_snap_vdi_uuid == resume_state["snapshot"]:
+            verbose(f"keep the snapshot of the resumed backup: {old_snap_vdi_uuid}")
             continue
+        verbose(f"cleanup old-snap-vdi-uuid: {old_snap_vdi_uuid}")
+        # vdi-destroy old vdi-snapshot
+        if not backend.vdi_destroy(old_snap_vdi_uuid):
+            verbose(f"Failed to destroy {old_snap_vdi_uuid}", level=logging.WARNING)
+            this_status = "warning"
+            # non-fatal - finish processing for this vm
 
-        # check for old vdi-snapshot for this xvda
-        snap_vdi_name_label = f"SNAP_{vm_name}_{xvda_name_label}"
-        # replace all spaces with '-'
-        snap_vdi_name_label = re.sub(r" ", r"-", snap_vdi_name_label)
-        verbose(f"check for prev-vdi-snapshot: {snap_vdi_name_label}")
-        command = f"vdi-list name-label='{snap_vdi_name_label}' params=uuid"
-        results = cmd.run_xe(command, out_format="last").split()
-        debug(f"List of all snaps is : {results}")
-        old_snap_vdi_uuid = results[-1] if len(results) >= 1 else ""
-        debug(f"The old snapshots is : {old_snap_vdi_uuid}")
-        if old_snap_vdi_uuid != "":
-            verbose(f"cleanup old-snap-vdi-uuid: {old_snap_vdi_uuid}")
-            # vdi-destroy old vdi-snapshot
-            if cmd.destroy_vdi_snapshot(old_snap_vdi_uuid) != "success":
-                verbose(f"Failed to run {command}", level=logging.WARNING)
-                this_status = "warning"
-                # non-fatal - finish processing for this vm
+    # === pre_cleanup code goes in here ===
+    debug(f"Pre clean mode is {pre_clean}")
+    if pre_clean:
+        pre_cleanup(vm_backup_dir, vm_retention)
 
-        # === pre_cleanup code goes in here ===
-        debug(f"Pre clean mode is {pre_clean}")
-        if pre_clean:
-            pre_cleanup(vm_backup_dir, vm_max_backups)
+    if is_incremental() and not backend.vdi_enable_cbt(xvda_uuid):
+        verbose(f"Failed to enable CBT on {xvda_uuid}", level=logging.ERROR)
+        status_log_vdi_export_end(server_name, f"VDI-ENABLE-CBT-FAIL {vm_name}")
+        return "error"
 
+    if resume_state is not None:
+        # continue the export of the retained snapshot
+        snap_vdi_uuid = resume_state["snapshot"]
+        verbose(f"snap-uuid (resumed): {snap_vdi_uuid}")
+    else:
         # take a vdi-snapshot of this vm
         command = f"vdi-snapshot uuid={xvda_uuid}"
-        verbose(f"2.cmd: {command}")
-        snap_vdi_uuid = cmd.run_xe(command, out_format="last")
+        verbose(f"2.{backend.name}: {command}")
+        snap_vdi_uuid = backend.vdi_snapshot(xvda_uuid)
         verbose(f"snap-uuid: {snap_vdi_uuid}")
         if snap_vdi_uuid == "":
             verbose(command, level=logging.ERROR)
             status_log_vdi_export_end(server_name, f"VDI-SNAPSHOT-FAIL {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
+            return "error"
 
         # change vdi-snapshot to unique name-label for easy id and cleanup
         command = f'vdi-param-set uuid={snap_vdi_uuid} name-label="{snap_vdi_name_label}"'
-        verbose(f"3.cmd: {command}")
-        if cmd.run_xe(command, out_format="rc") != 0:
+        verbose(f"3.{backend.name}: {command}")
+        if not backend.vdi_set_name_label(snap_vdi_uuid, snap_vdi_name_label):
             verbose(command, level=logging.ERROR)
             status_log_vdi_export_end(server_name, f"VDI-PARAM-SET-FAIL {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
+            return "error"
 
-        # actual-backup: vdi-export vdi-snapshot
-        command = "vdi-export "
-        command += f"format={config.get(section, 'vdi_export_format', fallback=DEFAULT_VDI_EXPORT_FORMAT)} "
-        command += f"uuid={snap_vdi_uuid} "
-        full_path_backup_file = os.path.join(
-            full_backup_dir,
-            f"{vm_name}.{config.get(section, 'vdi_export_format', fallback=DEFAULT_VDI_EXPORT_FORMAT)}",
-        )
-        command += f'filename="{full_path_backup_file}"'
-        verbose(f"4.cmd: {command}")
-        if cmd.run_xe(command, out_format="rc") == 0:
-            verbose("vdi-export success")
+    # pass to the next stage
+    job["vm_name"] = vm_name
+    job["vm_retention"] = vm_retention
+    job["this_status"] = this_status
+    job["beginTime"] = beginTime
+    job["vm_backup_dir"] = vm_backup_dir
+    job["full_backup_dir"] = full_backup_dir
+    job["snap_vdi_uuid"] = snap_vdi_uuid
+    job["vm_uuid"] = vm_meta["vm_uuid"]
+    job["disks"] = {"xvda": (xvda_uuid, snap_vdi_uuid)}
+
+
+def backup_vdi_export_export(job):
+    """
+    Second vdi-export stage: export the snapshot
+
+    Args:
+        job (dict): the backup job context, passed from stage to stage
+
+    Return:
+        str : the backup status (success / warning / error) if the backup ended, None to continue to the next stage
+    """
+    vm_name = job["vm_name"]
+    server_name = job["server_name"]
+    full_backup_dir = job["full_backup_dir"]
+    snap_vdi_uuid = job["snap_vdi_uuid"]
+    vm_uuid = job["vm_uuid"]
+
+    # actual-backup: vdi-export vdi-snapshot
+    command = "vdi-export "
+    command += f"format={config.get(section, 'vdi_export_format', fallback=DEFAULT_VDI_EXPORT_FORMAT)} "
+    command += f"uuid={snap_vdi_uuid} "
+    full_path_backup_file = os.path.join(
+        full_backup_dir,
+        f"{vm_name}.{config.get(section, 'vdi_export_format', fallback=DEFAULT_VDI_EXPORT_FORMAT)}",
+    )
+    command += f'filename="{full_path_backup_file}"'
+    with dispatcher.slot(vm_uuid) as host_cmd:
+        verbose(f"4.cmd ({host_cmd.host()}): {command}")
+        if is_incremental():
+            rc, full_path_backup_file = run_cbt_export(host_cmd, job)
         else:
-            verbose(f"{command} Failed to run", level=logging.ERROR)
-            status_log_vdi_export_end(server_name, f"VDI-EXPORT-FAIL {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
+            rc, full_path_backup_file = run_export(
+                host_cmd,
+                command,
+                snap_vdi_uuid,
+                full_path_backup_file,
+                export_format=config.get(section, "vdi_export_format", fallback=DEFAULT_VDI_EXPORT_FORMAT),
+                vdi_uuids=[snap_vdi_uuid],
+            )
+    if rc == 0:
+        verbose("vdi-export success")
+    else:
+        verbose(f"{command} Failed to run", level=logging.ERROR)
+        status_log_vdi_export_end(server_name, f"VDI-EXPORT-FAIL {vm_name}")
+        return "error"
+
+    # pass to the next stage
+    job["full_path_backup_file"] = full_path_backup_file
+
+
+def backup_vdi_export_finalize(job):
+    """
+    Last vdi-export stage: remove the snapshot, and cleanup old backups
 
-        # cleanup: vdi-destroy vdi-snapshot
-        if cmd.destroy_vdi_snapshot(snap_vdi_uuid, log_prefix="5.cmd") != "success":
-            verbose(f"{command} Failed to run", level=logging.WARNING)
+    Args:
+        job (dict): the backup job context, passed from stage to stage
+
+    Return:
+        str : the backup status (success / warning / error) if the backup ended, None to continue to the next stage
+    """
+    vm_name = job["vm_name"]
+    vm_retention = job["vm_retention"]
+    server_name = job["server_name"]
+    this_status = job["this_status"]
+    beginTime = job["beginTime"]
+    vm_backup_dir = job["vm_backup_dir"]
+    full_backup_dir = job["full_backup_dir"]
+    snap_vdi_uuid = job["snap_vdi_uuid"]
+    full_path_backup_file = job["full_path_backup_file"]
+
+    # cleanup: vdi-destroy vdi-snapshot (with CBT, keep its metadata as the next backup base)
+    if is_incremental():
+        if not keep_cbt_bases(job):
             this_status = "warning"
-            # non-fatal - finsh processing for this vm
+    elif not backend.vdi_destroy(snap_vdi_uuid):
+        verbose(f"vdi-destroy uuid={snap_vdi_uuid} Failed to run", level=logging.WARNING)
+        this_status = "warning"
+        # non-fatal - finsh processing for this vm
+
+    title("vdi-export end")
+    # --- end vdi-export command sequence ---
+    # ---------------------------------------
+
+    elapseTime = datetime.datetime.now() - beginTime
+    backup_file_size = int(get_backup_file_size(full_path_backup_file) / 1024)
+    debug(f"The size of the backup file is : [{str(backup_file_size)}GB]")
+    final_cleanup(
+        full_path_backup_file,
+        backup_file_size,
+        full_backup_dir,
+        vm_backup_dir,
+        vm_retention,
+    )
 
-        title("vdi-export end")
-        # --- end vdi-export command sequence ---
-        # ---------------------------------------
-
-        elapseTime = datetime.datetime.now() - beginTime
-        backup_file_size = cmd.run_remote(f"du -m {full_path_backup_file}", out_format="last").split()[0]
-        backup_file_size = int(int(backup_file_size) / 1024)
-        debug(f"The size of the backup file is : [{str(backup_file_size)}GB]")
-        final_cleanup(
-            full_path_backup_file,
-            backup_file_size,
-            full_backup_dir,
-            vm_backup_dir,
-            vm_max_backups,
+    if not check_all_backups_success(vm_backup_dir):
+        verbose(
+            "Cleanup needed - not all backup history is successful",
+            level=logging.WARNING,
         )
+        this_status = "warning"
 
-        if not check_all_backups_success(vm_backup_dir):
-            verbose(
-                "Cleanup needed - not all backup history is successful",
-                level=logging.WARNING,
-            )
-            this_status = "warning"
+    backup_time = f":{str(elapseTime.seconds / 60):.3} Minute"
 
-        backup_time = f":{str(elapseTime.seconds / 60):.3} Minute"
+    if this_status == "success":
+        verbose(f"{BASE_NAME} vdi-export {vm_name} - ***Success*** t{backup_time}")
+        status_log_vdi_export_end(
+            server_name,
+            f"SUCCESS {vm_name},elapse:{backup_time} ; size:{backup_file_size}G",
+        )
 
-        if this_status == "success":
-            success_cnt += 1
-            verbose(f"{BASE_NAME} vdi-export {vm_name} - ***Success*** t{backup_time}")
-            status_log_vdi_export_end(
-                server_name,
-                f"SUCCESS {vm_name},elapse:{backup_time} ; size:{backup_file_size}G",
-            )
+    elif this_status == "warning":
+        verbose(f"{BASE_NAME} vdi-export {vm_name} - ***WARNING*** t:{backup_time}")
+        status_log_vdi_export_end(
+            server_name, f"WARNING {vm_name},elapse:{backup_time} ; size:{backup_file_size}G"
+        )
 
-        elif this_status == "warning":
-            warning_cnt += 1
-            verbose(f"{BASE_NAME} vdi-export {vm_name} - ***WARNING*** t:{backup_time}")
-            status_log_vdi_export_end(
-                server_name, f"WARNING {vm_name},elapse:{backup_time} ; size:{backup_file_size}G"
-            )
+    else:
+        # this should never occur since all errors return before
+        this_status = "error"
+        verbose(f"{BASE_NAME} vdi-export {vm_name} - +++ERROR-INTERNAL+++ t:{backup_time}")
+        status_log_vdi_export_end(
+            server_name,
+            f"ERROR-INTERNAL {vm_name},elapse:{backup_time} ; size:{backup_file_size}G",
+        )
 
-        else:
-            # this should never occur since all errors do a continued on to the next vm_name
-            error_cnt += 1
-            verbose(f"{BASE_NAME} vdi-export {vm_name} - +++ERROR-INTERNAL+++ t:{backup_time}")
-            status_log_vdi_export_end(
-                server_name,
-                f"ERROR-INTERNAL {vm_name},elapse:{backup_time} ; size:{backup_file_size}G",
-            )
+    return this_status
 
-    # end of for vm_parm in config['vdi-export']:
-    ######################################################################
-    # Iterate through all vm-export= in cfg
-    title(msg="vm-export=")
-    for vm_parm in backup_vms:
-        verbose(f"*** vm-export begin {vm_parm}")
-        beginTime = datetime.datetime.now()
-        this_status = "success"
-
-        # get values from vdi-export=
-        vm_name = get_vm_name(vm_parm)
-        vm_max_backups = get_vm_max_backups(vm_parm)
-        verbose(f"vm-export - vm_name: {vm_name} max_backups: {vm_max_backups}")
-
-        status_log_vm_export_begin(server_name, vm_name)
-
-        vm_object = verify_vm_name(vm_name)
-        if "ERROR" in vm_object:
-            verbose(f"verify_vm_name: {vm_object}")
-            status_log_vm_export_end(server_name, f"ERROR verify_vm_name {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
 
-        vm_backup_dir = os.path.join(config.get(section, "backup_dir", fallback=DEFAULT_BACKUP_DIR), vm_name)
-        # cleanup any old unsuccessful backups and create new full_backup_dir
-        full_backup_dir = process_backup_dir(vm_backup_dir)
+def backup_vm_export_prepare(job):
+    """
+    First vm-export stage: verify the VM, gather its metadata, and take a snapshot
 
-        # gather_vm_meta produces status: empty or warning-message
-        #   and globals: vm_uuid, xvda_uuid, xvda_uuid
-        vm_meta_status = gather_vm_meta(vm_object, full_backup_dir)
-        if vm_meta_status != "":
-            verbose(f"gather_vm_meta: {vm_meta_status}", level=logging.WARNING)
+    Args:
+        job (dict): the backup job context, passed from stage to stage
+
+    Return:
+        str : the backup status (success / warning / error) if the backup ended, None to continue to the next stage
+    """
+    vm_parm = job["vm_parm"]
+    server_name = job["server_name"]
+
+    verbose(f"*** vm-export begin {vm_parm}")
+    beginTime = datetime.datetime.now()
+    this_status = "success"
+
+    # get values from vdi-export=
+    vm_name = get_vm_name(vm_parm)
+    vm_retention = get_vm_retention(vm_parm)
+    verbose(f"vm-export - vm_name: {vm_name} retention: {format_policy(vm_retention)}")
+
+    status_log_vm_export_begin(server_name, vm_name)
+
+    vm_object = verify_vm_name(vm_name)
+    if "ERROR" in vm_object:
+        verbose(f"verify_vm_name: {vm_object}")
+        status_log_vm_export_end(server_name, f"ERROR verify_vm_name {vm_name}")
+        return "error"
+
+    vm_backup_dir = os.path.join(config.get(section, "backup_dir", fallback=DEFAULT_BACKUP_DIR), vm_name)
+    # cleanup any old unsuccessful backups and create new full_backup_dir
+    full_backup_dir = process_backup_dir(vm_backup_dir)
+    if full_backup_dir is None:
+        status_log_vm_export_end(server_name, f"VM-MKDIR-FAIL {vm_name}")
+        return "error"
+
+    # gather_vm_meta produces status: empty or warning-message
+    #   and the vm metadata: vm_uuid, xvda_uuid, xvda_name_label
+    vm_meta_status, vm_meta = gather_vm_meta(vm_object, full_backup_dir)
+    vm_uuid = vm_meta["vm_uuid"]
+    if vm_meta_status != "":
+        verbose(f"gather_vm_meta: {vm_meta_status}", level=logging.WARNING)
+        this_status = "warning"
+        # non-fatal - finsh processing for this vm
+    # vm-export only uses vm_uuid
+    if vm_uuid == "":
+        verbose("gather_vm_meta has no vm-uuid", level=logging.ERROR)
+        status_log_vm_export_end(server_name, f"ERROR vm-uuid not found {vm_name}")
+        return "error"
+
+    # ----------------------------------------
+    # --- begin vm-export command sequence ---
+    verbose("*** vm-export begin xe command sequence")
+    # is vm currently running?
+    if backend.is_vm_running(vm_name):
+        verbose("vm is running")
+    else:
+        verbose("vm is NOT running")
+
+    # check for old vm-snapshot for this vm
+    snap_name = f"RESTORE_{vm_name}"
+    verbose(f"check for prev-vm-snapshot: {snap_name}")
+    for old_snap_vm_uuid in backend.find_vm_by_name(snap_name):
+        verbose(f"cleanup old-snap-vm-uuid: {old_snap_vm_uuid}")
+        # vm-uninstall old vm-snapshot
+        command = f"vm-uninstall uuid={old_snap_vm_uuid} force=true"
+        verbose(f"{backend.name}: {command}")
+        if not backend.vm_uninstall(old_snap_vm_uuid):
+            verbose(command, level=logging.WARNING)
             this_status = "warning"
+            status_log_vm_export_end(server_name, f"VM-UNINSTALL-FAIL-1 {vm_name}")
             # non-fatal - finsh processing for this vm
-        # vm-export only uses vm_uuid
-        if vm_uuid == "":
-            verbose("gather_vm_meta has no vm-uuid", level=logging.ERROR)
-            status_log_vm_export_end(server_name, f"ERROR vm-uuid not found {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
 
-        # ----------------------------------------
-        # --- begin vm-export command sequence ---
-        verbose("*** vm-export begin xe command sequence")
-        # is vm currently running?
-        if cmd.check_if_vm_is_running(vm_name):
-            verbose("vm is running")
-        else:
-            verbose("vm is NOT running")
-
-        # check for old vm-snapshot for this vm
-        snap_name = f"RESTORE_{vm_name}"
-        verbose(f"check for prev-vm-snapshot: {snap_name}")
-        command = f"vm-list name-label='{snap_name}' params=uuid"  # | /bin/awk -F': ' '{print $2}' | /bin/grep '-'"
-        old_snap_vm_uuid = cmd.run_xe(command, out_format="last")
-        if old_snap_vm_uuid != "":
-            verbose(f"cleanup old-snap-vm-uuid: {old_snap_vm_uuid}")
-            # vm-uninstall old vm-snapshot
-            command = f"vm-uninstall uuid={old_snap_vm_uuid} force=true"
-            verbose(f"cmd: {command}")
-            if cmd.run_xe(command, out_format="rc") != 0:
-                verbose(command, level=logging.WARNING)
-                this_status = "warning"
-                status_log_vm_export_end(server_name, f"VM-UNINSTALL-FAIL-1 {vm_name}")
-                # non-fatal - finsh processing for this vm
-
-        # === pre_cleanup code goes in here ===
-        debug(f"vm_backup_dir: {vm_backup_dir} ; vm_max_backups: {vm_max_backups}")
-        if pre_clean:
-            pre_cleanup(vm_backup_dir, vm_max_backups)
-
-        # take a vm-snapshot of this vm
-        command = f'vm-snapshot vm={vm_uuid} new-name-label="{snap_name}"'
-        verbose(f"1.cmd: {command}")
-        snap_vm_uuid = cmd.run_xe(command, out_format="last")
-        verbose(f"snap-uuid: {snap_vm_uuid}")
-        if snap_vm_uuid == "":
-            verbose(command, level=logging.ERROR)
-            status_log_vm_export_end(server_name, f"SNAPSHOT-FAIL {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
+    # === pre_cleanup code goes in here ===
+    debug(f"vm_backup_dir: {vm_backup_dir} ; vm_retention: {vm_retention}")
+    if pre_clean:
+        pre_cleanup(vm_backup_dir, vm_retention)
+
+    if is_incremental():
+        for device, vdi_uuid in backend.vm_disks(vm_uuid).items():
+            if not backend.vdi_enable_cbt(vdi_uuid):
+                verbose(f"Failed to enable CBT on {device} {vdi_uuid}", level=logging.ERROR)
+                status_log_vm_export_end(server_name, f"VDI-ENABLE-CBT-FAIL {vm_name}")
+                return "error"
+
+    # take a vm-snapshot of this vm
+    command = f'vm-snapshot vm={vm_uuid} new-name-label="{snap_name}"'
+    verbose(f"1.{backend.name}: {command}")
+    snap_vm_uuid = backend.vm_snapshot(vm_uuid, snap_name)
+    verbose(f"snap-uuid: {snap_vm_uuid}")
+    if snap_vm_uuid == "":
+        verbose(command, level=logging.ERROR)
+        status_log_vm_export_end(server_name, f"SNAPSHOT-FAIL {vm_name}")
+        return "error"
+
+    # change vm-snapshot so that it can be referenced by vm-export
+    command = f"template-param-set is-a-template=false ha-always-run=false uuid={snap_vm_uuid}"
+    verbose(f"2.{backend.name}: {command}")
+    if not backend.vm_set_exportable(snap_vm_uuid):
+        verbose(command, level=logging.ERROR)
+        status_log_vm_export_end(server_name, f"TEMPLATE-PARAM-SET-FAIL {vm_name}")
+        return "error"
+
+    # pass to the next stage
+    job["vm_name"] = vm_name
+    job["vm_retention"] = vm_retention
+    job["this_status"] = this_status
+    job["beginTime"] = beginTime
+    job["vm_backup_dir"] = vm_backup_dir
+    job["full_backup_dir"] = full_backup_dir
+    job["snap_vm_uuid"] = snap_vm_uuid
+    job["vm_uuid"] = vm_uuid
+    if is_incremental():
+        origin = backend.vm_disks(vm_uuid)
+        job["disks"] = {
+            device: (origin.get(device, ""), vdi_uuid) for device, vdi_uuid in backend.vm_disks(snap_vm_uuid).items()
+        }
+
+
+def backup_vm_export_export(job):
+    """
+    Second vm-export stage: export the snapshot
 
-        # change vm-snapshot so that it can be referenced by vm-export
-        command = f"template-param-set is-a-template=false ha-always-run=false uuid={snap_vm_uuid}"
-        verbose(f"2.cmd: {command}")
-        if cmd.run_xe(command, out_format="rc") != 0:
-            verbose(command, level=logging.ERROR)
-            status_log_vm_export_end(server_name, f"TEMPLATE-PARAM-SET-FAIL {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
+    Args:
+        job (dict): the backup job context, passed from stage to stage
 
-        # vm-export vm-snapshot
-        command = f"vm-export uuid={snap_vm_uuid}"
-        if compress:
-            full_path_backup_file = os.path.join(full_backup_dir, vm_name + ".xva.gz")
-            command = f'{command} filename="{full_path_backup_file}" compress=true'
-        else:
-            full_path_backup_file = os.path.join(full_backup_dir, vm_name + ".xva")
-            command = f'{command} filename="{full_path_backup_file}"'
-        verbose(f"3.cmd: {command}")
-        if cmd.run_xe(command, out_format="rc") == 0:
-            verbose("vm-export success")
+    Return:
+        str : the backup status (success / warning / error) if the backup ended, None to continue to the next stage
+    """
+    vm_name = job["vm_name"]
+    server_name = job["server_name"]
+    full_backup_dir = job["full_backup_dir"]
+    snap_vm_uuid = job["snap_vm_uuid"]
+    vm_uuid = job["vm_uuid"]
+
+    # vm-export vm-snapshot
+    command = f"vm-export uuid={snap_vm_uuid}"
+    if compress and get_compression() is None:
+        full_path_backup_file = os.path.join(full_backup_dir, vm_name + ".xva.gz")
+        command = f'{command} filename="{full_path_backup_file}" compress=true'
+    else:
+        full_path_backup_file = os.path.join(full_backup_dir, vm_name + ".xva")
+        command = f'{command} filename="{full_path_backup_file}"'
+    with dispatcher.slot(vm_uuid) as host_cmd:
+        if is_incremental():
+            verbose(f"3.cmd ({host_cmd.host()}): CBT export of {vm_name} disks")
+            rc, full_path_backup_file = run_cbt_export(host_cmd, job)
         else:
-            verbose(command, level=logging.ERROR)
-            status_log_vm_export_end(server_name, f"VM-EXPORT-FAIL {vm_name}")
-            error_cnt += 1
-            # next vm
-            continue
+            verbose(f"3.cmd ({host_cmd.host()}): {command}")
+            rc, full_path_backup_file = run_export(
+                host_cmd,
+                command,
+                snap_vm_uuid,
+                full_path_backup_file,
+                gzip=compress,
+                vdi_uuids=backend.vm_disks(snap_vm_uuid).values(),
+            )
+    if rc == 0:
+        verbose("vm-export success")
+    else:
+        verbose(command, level=logging.ERROR)
+        status_log_vm_export_end(server_name, f"VM-EXPORT-FAIL {vm_name}")
+        return "error"
 
-        # vm-uninstall vm-snapshot
+    # pass to the next stage
+    job["full_path_backup_file"] = full_path_backup_file
+
+
+def backup_vm_export_finalize(job):
+    """
+    Last vm-export stage: remove the snapshot, and cleanup old backups
+
+    Args:
+        job (dict): the backup job context, passed from stage to stage
+
+    Return:
+        str : the backup status (success / warning / error) if the backup ended, None to continue to the next stage
+    """
+    vm_name = job["vm_name"]
+    vm_retention = job["vm_retention"]
+    server_name = job["server_name"]
+    this_status = job["this_status"]
+    beginTime = job["beginTime"]
+    vm_backup_dir = job["vm_backup_dir"]
+    full_backup_dir = job["full_backup_dir"]
+    snap_vm_uuid = job["snap_vm_uuid"]
+    full_path_backup_file = job["full_path_backup_file"]
+
+    # vm-uninstall vm-snapshot (with CBT, keep the metadata of its disks as the next backup base)
+    if is_incremental():
+        if not keep_cbt_bases(job) or not backend.vm_destroy(snap_vm_uuid):
+            verbose(f"Failed to cleanup the CBT snapshot {snap_vm_uuid}", level=logging.WARNING)
+            this_status = "warning"
+    else:
         command = f"vm-uninstall uuid={snap_vm_uuid} force=true"
-        verbose(f"4.cmd: {command}")
-        if cmd.run_xe(command, out_format="rc") != 0:
+        verbose(f"4.{backend.name}: {command}")
+        if not backend.vm_uninstall(snap_vm_uuid):
             verbose(command, level=logging.WARNING)
             this_status = "warning"
             # non-fatal - finsh processing for this vm
 
-        title("vm-export end")
-        # --- end vm-export command sequence ---
-        # ----------------------------------------
-
-        elapseTime = datetime.datetime.now() - beginTime
-        backup_file_size = cmd.run_remote(f"du -m {full_path_backup_file}", out_format="last").split()[0]
-        debug(f"The size of the backup file is : {backup_file_size} G")
-        final_cleanup(
-            full_path_backup_file,
-            backup_file_size,
-            full_backup_dir,
-            vm_backup_dir,
-            vm_max_backups,
+    title("vm-export end")
+    # --- end vm-export command sequence ---
+    # ----------------------------------------
+
+    elapseTime = datetime.datetime.now() - beginTime
+    backup_file_size = get_backup_file_size(full_path_backup_file)
+    debug(f"The size of the backup file is : {backup_file_size} G")
+    final_cleanup(
+        full_path_backup_file,
+        backup_file_size,
+        full_backup_dir,
+        vm_backup_dir,
+        vm_retention,
+    )
+
+    if not check_all_backups_success(vm_backup_dir):
+        verbose(
+            "Cleanup needed - not all backup history is successful",
+            level=logging.WARNING,
         )
+        this_status = "warning"
+    suffix_msg = f"elapse:{str(elapseTime.seconds / 60)} size:{backup_file_size}G"
+    if this_status == "success":
+        verbose(f"{BASE_NAME} vm-export {vm_name} - *** Success *** ; {suffix_msg}")
+        status_log_vm_export_end(server_name, f"SUCCESS {vm_name},{suffix_msg}")
 
-        if not check_all_backups_success(vm_backup_dir):
-            verbose(
-                "Cleanup needed - not all backup history is successful",
-                level=logging.WARNING,
+    elif this_status == "warning":
+        verbose(f"{BASE_NAME} vm-export {vm_name} - *** WARNING *** ; {suffix_msg}")
+        status_log_vm_export_end(server_name, f"WARNING {vm_name},{suffix_msg}")
+
+    else:
+        # this should never occur since all errors return before
+        this_status = "error"
+        verbose(f"{BASE_NAME} vm-export {vm_name} - +++ ERROR-INTERNAL +++ ; {suffix_msg}")
+        status_log_vm_export_end(server_name, f"ERROR-INTERNAL {vm_name},{suffix_msg}")
+
+    return this_status
+
+
+def get_compression():
+    """
+    Return:
+        dict : the parallel compression options (codec, level, workers), None if compression is not configured
+    """
+    codec = config.get(section, "compression", fallback=DEFAULT_COMPRESSION)
+    if codec == "none":
+        return None
+    level = config.get(section, "compression_level", fallback="")
+    return {
+        "codec": codec,
+        "level": int(level) if level != "" else None,
+        "workers": int(config.get(section, "compression_workers", fallback=DEFAULT_COMPRESSION_WORKERS)) or None,
+    }
+
+
+def run_export(host_cmd, command, uuid, full_path_backup_file, export_format=None, gzip=False, vdi_uuids=()):
+    """
+    Run the export, with the configured export method :
+        xe   - run the xe vm-export / vdi-export command on the host
+        http - stream the export from the host XAPI HTTP handler, the file is
+               written by this script, so the backup_dir must be reachable here
+    The compression, dedup, sparse and integrity options apply only to the
+    HTTP exports (the xe exports are written by the host, see is_config_valid()).
+    With the compression configured, the export is compressed in parallel
+    while it is streamed, and the backup file get the codec suffix (.gz / .zst).
+    With the dedup configured, the export is stored in the chunk store, and
+    the backup file is replaced by its manifest (<file>.manifest).
+    With the sparse configured (and without compression / dedup), the zero
+    blocks of raw VDI exports are holes in the file, and the extent map of
+    the data is written next to it (<file>.extents).
+    The HTTP exports are throttled by the global, host and SR bandwidth limits,
+    and written to the backup target (file-system path / object storage).
+    With the resume_window configured, the raw VDI exports (without
+    compression / dedup) write checkpoints, and continue from the checkpoint
+    of the last failed export of the same snapshot.
+
+    Args:
+        host_cmd (Command): the command object of the host to export on
+        command (str): the xe export command
+        uuid (str): the UUID of the VM / VDI snapshot to export
+        full_path_backup_file (str): the backup file path
+        export_format (str): the VDI export format (raw / vhd), None for VM export
+        gzip (bool): compress the VM export (single stream, without the compression configured)
+        vdi_uuids (iterable): the UUIDs of the exported VDIs, for the SR bandwidth limits
+
+    Return:
+        int, str : 0 on success, otherwise 1 (or the xe exit code), and the backup file (or manifest) path
+    """
+    compression = get_compression()
+    store = get_chunk_store()
+    sparse = is_sparse() and export_format == "raw" and compression is None and store is None
+    resumable = is_resumable() and export_format == "raw"
+    if config.get(section, "export_method", fallback=DEFAULT_EXPORT_METHOD) != "http":
+        # the file is written by the host, it may not be reachable here to process it. the
+        # export output is logged while it runs, and not held until the export ends
+        with host_cmd.run_xe(command, out_format="stream") as stream:
+            for line in stream:
+                if line.strip():
+                    logger.info(f"xe: {line.strip()}")
+        target.path_changed(full_path_backup_file)
+        return stream.returncode, full_path_backup_file
+
+    compress_stage = None
+    if compression is not None:
+        compress_stage = ParallelCompressStage(**compression)
+        stages = [compress_stage]
+        full_path_backup_file += CODECS[compression["codec"]]
+    else:
+        stages = [GzipStage()] if gzip else []
+    stages.insert(0, get_throttle_stage(host_cmd, vdi_uuids))
+    integrity_settings = get_integrity()
+    if integrity_settings or resumable:
+        checksum = integrity.IntegrityStage(**(integrity_settings or {}))
+    else:
+        checksum = ChecksumStage()
+    offset, state = 0, None
+    if resumable:
+        offset, state = resume_checkpoint(full_path_backup_file, uuid, checksum)
+    if store is not None:
+        writer = ChunkStage(store, full_path_backup_file)
+    elif sparse:
+        extents = state.get("extents") if state else None
+        writer = SparseFileWriter(full_path_backup_file, offset=offset, extents=extents, keep_partial=resumable)
+    else:
+        # the raw image size is the VDI virtual size, preallocated by the LargeFileWriter
+        size = backend.vdi_virtual_size(uuid) if export_format == "raw" and compression is None else 0
+        writer = target.writer(full_path_backup_file, offset=offset, keep_partial=resumable, size=size)
+    if resumable:
+        interval = int(config.get(section, "checkpoint_interval", fallback=DEFAULT_CHECKPOINT_INTERVAL)) * 1024 * 1024
+        started = state["started"] if state else None
+        stages.append(checkpoint.CheckpointStage(uuid, checksum, writer, interval=interval, started=started))
+    stages += [checksum, writer]
+    exporter = HttpExporter(host_cmd.host(), session_ref)
+    try:
+        if export_format is None:
+            stats = exporter.export_vm(uuid, stages)
+        else:
+            stats = exporter.export_vdi(uuid, stages, export_format=export_format, offset=offset)
+    except (OSError, sqlite3.Error, http.client.HTTPException, ExportError) as ex:
+        verbose(f"HTTP export of {uuid} failed : {ex}", level=logging.ERROR)
+        return 1, full_path_backup_file
+    finally:
+        # the file is written here, not by the Command, so the cached listings are not aware of it
+        target.path_changed(full_path_backup_file)
+    verbose(f"Exported {stats['bytes'] / (1024 ** 3):.2f} GB at {stats['throughput']:.1f} MB/Sec.")
+    if compression is not None:
+        verbose(f"Compressed with {compression['codec']} to {compress_stage.ratio():.2f} of the export size")
+    if store is not None:
+        verbose(f"Stored in the chunk store, {writer.new_bytes / (1024 ** 3):.2f} GB new")
+    if sparse:
+        verbose(f"Wrote sparse image, {writer.hole_bytes / (1024 ** 3):.2f} GB of holes")
+    if isinstance(writer, LargeFileWriter):
+        writer_stats = writer.stats()
+        verbose(
+            f"Wrote in {writer_stats['writes']} write(s) at {writer_stats['throughput']:.1f} MB/Sec. ({writer.strategy})"
+        )
+    verbose(f"{checksum.algorithm} of {full_path_backup_file} : {checksum.hexdigest()}")
+    if integrity_settings:
+        return add_integrity(writer.path, checksum), writer.path
+    return 0, writer.path
+
+
+def is_resumable():
+    """
+    Return:
+        bool : True if the raw VDI exports of the section write checkpoints, and can be resumed
+    """
+    return (
+        float(config.get(section, "resume_window", fallback=DEFAULT_RESUME_WINDOW)) > 0
+        and config.get(section, "export_method", fallback=DEFAULT_EXPORT_METHOD) == "http"
+        and get_compression() is None
+        and not is_dedup()
+    )
+
+
+def find_resumable_backup(vm_backup_dir, vm_name):
+    """
+    Find the last failed vdi-export of the VM, if it can be resumed : it has
+    a checkpoint, its first checkpoint is within the resume window, and its
+    snapshot still exists.
+
+    Args:
+        vm_backup_dir (str): the VM backup directory
+        vm_name (str): the VM name
+
+    Return:
+        str, dict : the full path of the backup directory and its checkpoint, None, None if there is none
+    """
+    if not is_resumable() or config.get(section, "vdi_export_format", fallback=DEFAULT_VDI_EXPORT_FORMAT) != "raw":
+        return None, None
+    dir_not_success = get_last_backup_dir_that_failed(vm_backup_dir)
+    if not dir_not_success:
+        return None, None
+    full_backup_dir = os.path.join(vm_backup_dir, dir_not_success)
+    state = checkpoint.load(os.path.join(full_backup_dir, f"{vm_name}.raw"))
+    if state is None:
+        return None, None
+    window = float(config.get(section, "resume_window", fallback=DEFAULT_RESUME_WINDOW))
+    if time.time() - state["started"] > window * 3600:
+        verbose(f"The checkpoint of {full_backup_dir} is older than {window} Hours, not resuming")
+        return None, None
+    if not backend.vdi_exists(state["snapshot"]):
+        verbose(f"The snapshot of {full_backup_dir} does not exist, not resuming", level=logging.WARNING)
+        return None, None
+    return full_backup_dir, state
+
+
+def resume_checkpoint(full_path_backup_file, snap_uuid, hasher):
+    """
+    Verify the partial file of a failed export with its checkpoint
+
+    Args:
+        full_path_backup_file (str): the backup file path
+        snap_uuid (str): the UUID of the exported snapshot
+        hasher (IntegrityStage): the stage that hash the export, continue the hashing of the verified blocks
+
+    Return:
+        int, dict : the offset to continue the export from (0 to export from the start), and the checkpoint
+    """
+    state = checkpoint.load(full_path_backup_file)
+    if state is None or state["snapshot"] != snap_uuid:
+        return 0, None
+    if state["algorithm"] != hasher.algorithm or state["block_size"] != hasher.block_size:
+        verbose(f"The checkpoint of {full_path_backup_file} use other hashing, exporting from the start")
+        return 0, None
+    try:
+        offset = hasher.resume(f"{full_path_backup_file}.part", state["blocks"])
+    except OSError as ex:
+        verbose(f"Cannot resume {full_path_backup_file} : {ex}", level=logging.WARNING)
+        return 0, None
+    if offset < state["offset"]:
+        verbose(f"Only {offset} of {state['offset']} bytes of {full_path_backup_file} are valid", level=logging.WARNING)
+    verbose(f"Resuming the export of {full_path_backup_file} from {offset} bytes")
+    return offset, state
+
+
+def get_integrity():
+    """
+    Return:
+        dict : the integrity manifest options (algorithm, block_size), None if not configured
+    """
+    if config.get(section, "integrity", fallback=DEFAULT_INTEGRITY) != "true" or is_dedup() or not is_posix_target():
+        # the chunks of the dedup store are verified by their sha256 name, the object storage verify the uploads
+        return None
+    block_size = int(config.get(section, "integrity_block_size", fallback=DEFAULT_INTEGRITY_BLOCK_SIZE))
+    return {
+        "algorithm": config.get(section, "integrity_algorithm", fallback=DEFAULT_INTEGRITY_ALGORITHM),
+        "block_size": block_size * 1024 * 1024,
+    }
+
+
+def add_integrity(full_path_backup_file, stage=None):
+    """
+    Add a backup file to the integrity manifest of its backup directory
+
+    Args:
+        full_path_backup_file (str): the backup file path
+        stage (IntegrityStage): the stage that hashed the file while it was written,
+                                None to read and hash the file (small files written here, like the CBT bitmaps)
+
+    Return:
+        int : 0 on success (or integrity is not configured), otherwise 1
+    """
+    integrity_settings = get_integrity()
+    if integrity_settings is None:
+        return 0
+    backup_dir, name = os.path.split(full_path_backup_file)
+    try:
+        if stage is not None:
+            entry = stage.entry()
+        elif os.path.exists(full_path_backup_file):
+            entry = integrity.hash_file(full_path_backup_file, **integrity_settings)
+        else:
+            debug(f"{full_path_backup_file} is not reachable here, no integrity manifest")
+            return 0
+        integrity.add_file(backup_dir, name, entry, **integrity_settings)
+        target.path_changed(backup_dir)
+    except (OSError, ValueError) as ex:
+        verbose(f"Failed to write the integrity manifest of {full_path_backup_file} : {ex}", level=logging.ERROR)
+        return 1
+    return 0
+
+
+def get_backup_file_size(full_path_backup_file):
+    """
+    Args:
+        full_path_backup_file (str): the backup file path
+
+    Return:
+        int : the size in MB of the backup files in its directory from the integrity manifest,
+              or the disk usage of the backup file (du -m / the object size) if the directory has no manifest
+    """
+    size = integrity.manifest_size(os.path.dirname(full_path_backup_file)) if is_posix_target() else None
+    if size is None:
+        return target.file_size(full_path_backup_file)
+    return int(size / (1024 * 1024))
+
+
+def get_throttle_stage(host_cmd, vdi_uuids):
+    """
+    Args:
+        host_cmd (Command): the command object of the host that stream the export
+        vdi_uuids (iterable): the UUIDs of the exported VDIs
+
+    Return:
+        ThrottleStage : the stage that limit the export bandwidth
+    """
+    srs = {backend.vdi_sr(vdi_uuid) for vdi_uuid in vdi_uuids} - {""}
+    return throttle.stage(host_cmd.host(), srs)
+
+
+def get_throttle_settings(cfg):
+    """
+    Args:
+        cfg (ConfigParser): the configuration
+
+    Return:
+        dict : the throttle keys of the section, see Throttle.apply()
+    """
+    return {
+        "throttle_rate": cfg.get(section, "throttle_rate", fallback=DEFAULT_THROTTLE_RATE),
+        "throttle_sr_rate": cfg.get(section, "throttle_sr_rate", fallback=DEFAULT_THROTTLE_SR_RATE),
+        "throttle_host_rate": cfg.get(section, "throttle_host_rate", fallback=DEFAULT_THROTTLE_HOST_RATE),
+        "throttle_adaptive": cfg.get(section, "throttle_adaptive", fallback=DEFAULT_THROTTLE_ADAPTIVE),
+    }
+
+
+def reload_throttle(signum, frame):
+    """
+    SIGHUP handler: apply the throttle keys of the (re-read) configuration file
+    """
+    new_config = configparser.ConfigParser()
+    new_config.read(cfg_file)
+    try:
+        throttle.apply(get_throttle_settings(new_config))
+    except ValueError as ex:
+        verbose(f"Invalid throttle settings in {cfg_file} : {ex}", level=logging.WARNING)
+        return
+    verbose(f"Throttle settings reloaded from {cfg_file}")
+
+
+def is_posix_target():
+    """
+    Return:
+        bool : True if the backups of the section are stored in the backup_dir path (not object storage)
+    """
+    return config.get(section, "backup_target", fallback=DEFAULT_BACKUP_TARGET) == "posix"
+
+
+def get_s3_settings():
+    """
+    Return:
+        dict : the s3 target settings, see get_target()
+    """
+    return {
+        "endpoint": config.get(section, "s3_endpoint", fallback=""),
+        "bucket": config.get(section, "s3_bucket", fallback=""),
+        "access_key": config.get(section, "s3_access_key", fallback=""),
+        "secret_key": config.get(section, "s3_secret_key", fallback=""),
+        "region": config.get(section, "s3_region", fallback=DEFAULT_S3_REGION),
+        "part_size": int(config.get(section, "s3_part_size", fallback=DEFAULT_S3_PART_SIZE)) * 1024 * 1024,
+        "in_flight": int(config.get(section, "s3_upload_concurrency", fallback=DEFAULT_S3_UPLOAD_CONCURRENCY)),
+    }
+
+
+def get_write_settings():
+    """
+    Return:
+        dict : the write options of the posix target, see get_target()
+    """
+    return {
+        "write_strategy": config.get(section, "write_strategy", fallback=DEFAULT_WRITE_STRATEGY),
+        "write_size": int(config.get(section, "write_buffer_size", fallback=DEFAULT_WRITE_BUFFER_SIZE)) * 1024 * 1024,
+    }
+
+
+def is_sparse():
+    """
+    Return:
+        bool : True if the raw VDI images of the section are written as sparse files
+    """
+    return config.get(section, "sparse", fallback=DEFAULT_SPARSE) == "true"
+
+
+def is_dedup():
+    """
+    Return:
+        bool : True if the backups of the section are stored in the chunk store
+    """
+    return config.get(section, "dedup", fallback=DEFAULT_DEDUP) == "true"
+
+
+def get_chunk_store():
+    """
+    Return:
+        ChunkStore : the chunk store (opened on the first call), None if dedup is not configured
+    """
+    global chunk_store
+    if not is_dedup():
+        return None
+    with chunk_store_lock:
+        if chunk_store is None:
+            root = config.get(section, "chunk_store", fallback="") or os.path.join(
+                config.get(section, "backup_dir", fallback=DEFAULT_BACKUP_DIR), ".chunks"
             )
-            this_status = "warning"
-        suffix_msg = f"elapse:{str(elapseTime.seconds / 60)} size:{backup_file_size}G"
-        if this_status == "success":
-            success_cnt += 1
-            verbose(f"{BASE_NAME} vm-export {vm_name} - *** Success *** ; {suffix_msg}")
-            status_log_vm_export_end(server_name, f"SUCCESS {vm_name},{suffix_msg}")
+            verbose(f"Using the chunk store at {root}")
+            chunk_store = ChunkStore(root)
+        return chunk_store
+
+
+def release_backup_dirs(tmp_vm_backup_dir, dirs_to_remove):
+    """
+    Release the chunks of the backups that are going to be deleted
+
+    Args:
+        tmp_vm_backup_dir (str): the path of the backups
+        dirs_to_remove (list): the names of the backup directories
+    """
+    store = get_chunk_store()
+    if store is None:
+        return
+    for name in dirs_to_remove:
+        try:
+            count = store.release_dir(os.path.join(tmp_vm_backup_dir, name))
+            debug(f"Released {count} manifest(s) of {tmp_vm_backup_dir}/{name}")
+        except (OSError, ValueError, sqlite3.Error) as ex:
+            verbose(f"Cannot release the chunks of {tmp_vm_backup_dir}/{name} : {ex}", level=logging.WARNING)
+
+
+def is_incremental():
+    """
+    Return:
+        bool : True if the backups of the section are incremental (CBT)
+    """
+    return config.get(section, "incremental", fallback=DEFAULT_INCREMENTAL) == "true"
+
+
+def get_cbt_states(path, dirs):
+    """
+    Args:
+        path (str): the path of the backups
+        dirs (list): the backup directories names
+
+    Return:
+        dict : the backup directory name -> its CBT state (None if it is not incremental backup)
+    """
+    files = target.read_files(*[os.path.join(path, name, cbt.STATE_FILE) for name in dirs])
+    return {name: cbt.parse_state(files[os.path.join(path, name, cbt.STATE_FILE)]) for name in dirs}
+
 
-        elif this_status == "warning":
-            warning_cnt += 1
-            verbose(f"{BASE_NAME} vm-export {vm_name} - *** WARNING *** ; {suffix_msg}")
-            status_log_vm_export_end(server_name, f"WARNING {vm_name},{suffix_msg}")
+def get_cbt_base(vm_backup_dir):
+    """
+    Find the last successful backup, that the current backup can be a delta of
+
+    Args:
+        vm_backup_dir (str): the path of the VM backups
+
+    Return:
+        str, dict : the backup directory name and its CBT state, None, None if there is no base
+    """
+    dirs, success_dirs = target.backup_dir_state(vm_backup_dir)
+    if not success_dirs:
+        return None, None
+    name = success_dirs[-1]
+    return name, get_cbt_states(vm_backup_dir, [name])[name]
+
+
+def export_changed_blocks(exporter, snap_uuid, bitmap, stages):
+    """
+    Export the changed blocks of a VDI snapshot. The changed blocks are read
+    over NBD when the VDI is served by an NBD server (a pool network with the
+    nbd / insecure_nbd purpose), otherwise the whole disk is streamed from the
+    HTTP export, and the unchanged blocks are dropped here.
+
+    Args:
+        exporter (HttpExporter): the HTTP exporter, when the VDI is not served over NBD
+        snap_uuid (str): the VDI snapshot UUID
+        bitmap (bytes): the raw bitmap of the changed blocks
+        stages (list): the chain of stages, the last one should write the changed blocks
+
+    Return:
+        int, int : the disk size in bytes, and the number of changed blocks
+
+    Raises:
+        ExportError / OSError / HTTPException : on export failure
+    """
+    client = nbd.NbdClient.connect(backend.vdi_nbd_info(snap_uuid))
+    if client is None:
+        verbose(
+            f"No NBD server for {snap_uuid}, the whole disk is read to export the changed blocks",
+            level=logging.WARNING,
+        )
+        delta = cbt.DeltaStage(bitmap)
+        stats = exporter.export_vdi(snap_uuid, [stages[0], delta] + stages[1:], export_format="raw")
+        return stats["bytes"], delta.changed_blocks
+    try:
+        runs = list(cbt.changed_runs(bitmap, client.size))
+        nbd.read_runs(client, runs, stages)
+    finally:
+        client.close()
+    return client.size, sum((length + cbt.BLOCK_SIZE - 1) // cbt.BLOCK_SIZE for _, length in runs)
+
+
+def run_cbt_export(host_cmd, job):
+    """
+    Export the snapshots of the VM disks (HTTP raw export). If the last
+    backup is a CBT backup, only the blocks that changed since its snapshots
+    are written (delta + bitmap files), otherwise a full raw image is written.
+    A new full backup is taken after cbt_full_every deltas.
+
+    Args:
+        host_cmd (Command): the command object of the host to export on
+        job (dict): the backup job context, with the 'disks' : device -> (VDI UUID, snapshot UUID)
 
+    Return:
+        int, str : 0 on success, otherwise 1, and the path of the first backup file
+    """
+    vm_name = job["vm_name"]
+    full_backup_dir = job["full_backup_dir"]
+    if not job["disks"]:
+        verbose(f"No disks to export for {vm_name}", level=logging.ERROR)
+        return 1, ""
+    base_name, base_state = get_cbt_base(job["vm_backup_dir"])
+    # the snapshots of the last backup are replaced by the new ones, even if this is a full backup
+    job["cbt_previous"] = base_state
+    full_every = int(config.get(section, "cbt_full_every", fallback=DEFAULT_CBT_FULL_EVERY))
+    if base_state is None or base_state["depth"] >= full_every:
+        base_name, base_state = None, None
+    state = cbt.new_state(base_name, base_state["depth"] + 1 if base_state else 0)
+
+    exporter = HttpExporter(host_cmd.host(), session_ref)
+    files = list()
+    for device, (vdi_uuid, snap_uuid) in sorted(job["disks"].items()):
+        disk = {"vdi": vdi_uuid, "snapshot": snap_uuid}
+        bitmap = None
+        base_disk = base_state["disks"].get(device) if base_state else None
+        if base_disk is not None and base_disk["vdi"] == vdi_uuid and backend.vdi_exists(base_disk["snapshot"]):
+            encoded = backend.vdi_list_changed_blocks(base_disk["snapshot"], snap_uuid)
+            if encoded != "":
+                bitmap = cbt.decode_bitmap(encoded)
+        if bitmap is None and base_state is not None:
+            verbose(f"No CBT base for {vm_name} {device}, exporting the full disk", level=logging.WARNING)
+
+        integrity_settings = get_integrity()
+        checksum = integrity.IntegrityStage(**integrity_settings) if integrity_settings else ChecksumStage()
+        if bitmap is None:
+            disk["file"] = f"{vm_name}-{device}.raw"
+            if is_sparse():
+                writer = SparseFileWriter(os.path.join(full_backup_dir, disk["file"]))
+            else:
+                size = backend.vdi_virtual_size(snap_uuid)
+                writer = target.writer(os.path.join(full_backup_dir, disk["file"]), size=size)
+            stages = [checksum, writer]
         else:
-            # this should never occur since all errors do a continued on to the next vm_name
-            error_cnt += 1
-            verbose(f"{BASE_NAME} vm-export {vm_name} - +++ ERROR-INTERNAL +++ ; {suffix_msg}")
-            status_log_vm_export_end(server_name, f"ERROR-INTERNAL {vm_name},{suffix_msg}")
+            disk["file"] = f"{vm_name}-{device}.delta"
+            disk["bitmap"] = f"{vm_name}-{device}.bitmap"
+            writer = FileWriter(os.path.join(full_backup_dir, disk["bitmap"]))
+            writer.write(memoryview(bitmap))
+            writer.close()
+            if add_integrity(writer.path) != 0:
+                return 1, ""
+            stages = [checksum, target.writer(os.path.join(full_backup_dir, disk["file"]))]
+        stages.insert(0, get_throttle_stage(host_cmd, [snap_uuid]))
+        try:
+            if bitmap is None:
+                stats = exporter.export_vdi(snap_uuid, stages, export_format="raw")
+                disk_size = stats["bytes"]
+            else:
+                disk_size, changed_blocks = export_changed_blocks(exporter, snap_uuid, bitmap, stages)
+        except (OSError, http.client.HTTPException, ExportError) as ex:
+            verbose(f"CBT export of {vm_name} {device} failed : {ex}", level=logging.ERROR)
+            return 1, ""
+        finally:
+            target.path_changed(full_backup_dir)
+        disk["sha256"] = checksum.hexdigest()
+        disk["size"] = disk_size
+        if integrity_settings and add_integrity(os.path.join(full_backup_dir, disk["file"]), checksum) != 0:
+            return 1, ""
+        if bitmap is None:
+            verbose(f"Full export of {device} : {disk_size / (1024 ** 3):.2f} GB")
+        else:
+            disk["changed_blocks"] = changed_blocks
+            verbose(
+                f"Delta export of {device} : {changed_blocks} changed block(s) "
+                f"of {disk_size // cbt.BLOCK_SIZE}, base {base_name}"
+            )
+        state["disks"][device] = disk
+        files.append(os.path.join(full_backup_dir, disk["file"]))
 
-    # end of for vm_parm in config['vm-export']:
-    ######################################################################
+    if target.write_files({os.path.join(full_backup_dir, cbt.STATE_FILE): cbt.dump_state(state).splitlines()}):
+        verbose(f"Failed to write the CBT state of {vm_name}", level=logging.ERROR)
+        return 1, ""
+    return 0, files[0] if files else ""
 
-    verbose()
-    df_snapshots(f"Space status", min_capacity=1)
 
-    # gather a final vmbackup.py status
-    summary = f"Success:{success_cnt}; Warnings:{warning_cnt}; Errors:{error_cnt}"
+def keep_cbt_bases(job):
+    """
+    Destroy the data of the exported VDI snapshots and keep their metadata
+    (with the CBT log) as the base for the next backup, and destroy the
+    previous bases, that are not needed anymore.
+
+    Args:
+        job (dict): the backup job context
 
+    Return:
+        bool : True on success, otherwise False
+    """
+    ok = True
+    for device, (vdi_uuid, snap_uuid) in job["disks"].items():
+        verbose(f"{backend.name}: vdi-data-destroy uuid={snap_uuid}")
+        if not backend.vdi_data_destroy(snap_uuid):
+            ok = False
+        # unique name-label, so it is not removed as old snapshot
+        backend.vdi_set_name_label(snap_uuid, f"CBT_{job['vm_name']}_{device}")
+    previous = job.get("cbt_previous") or {"disks": {}}
+    for disk in previous["disks"].values():
+        if backend.vdi_exists(disk["snapshot"]) and not backend.vdi_destroy(disk["snapshot"]):
+            ok = False
+    return ok
+
+
+def get_history_file():
+    """
+    Return:
+        str : the path of the backup history file (next to the status log, if not configured)
+    """
     status_log = config.get(section, "status_log", fallback=DEFAULT_STATUS_LOG)
-    sub_suffix = f"{os.uname()[1]} {BASE_NAME}.py"
-    if error_cnt > 0:
-        status_log_end(server_name, f"ERROR,{summary}")
-        send_email(f"ERROR {sub_suffix}", status_log)
-        verbose(f"{BASE_NAME} ended - ** ERRORS DETECTED ** - {summary}")
-    elif warning_cnt > 0:
-        status_log_end(server_name, f"WARNING,{summary}")
-        send_email(f"WARNING {sub_suffix}", status_log)
-        verbose(f"{BASE_NAME} ended - ** WARNING(s) ** - {summary}")
-    else:
-        status_log_end(server_name, f"SUCCESS,{summary}")
-        send_email(f"Success {sub_suffix}", status_log)
-        verbose(f"{BASE_NAME} ended - Success - {summary}")
+    default = os.path.join(os.path.dirname(status_log), DEFAULT_HISTORY_FILE)
+    return config.get(section, "history_file", fallback=default)
 
-    # done with main()
-    ######################################################################
+
+def get_export_size(vm_name, export_type):
+    """
+    Estimate the size of the VM export, from the size of its disks
+
+    Args:
+        vm_name (str): the VM name
+        export_type (str): vm-export (all the disks used data) or vdi-export (the whole first disk)
+
+    Return:
+        int : the estimated size in bytes, 0 if the VM is not found
+    """
+    size = 0
+    try:
+        for vm in get_inventory().vms_by_name(vm_name):
+            for vbd, vdi in inventory.vm_disks(vm):
+                if export_type == "vdi-export":
+                    if vbd.device == "xvda":
+                        size += int(vdi.virtual_size)
+                else:
+                    size += int(vdi.physical_utilisation)
+    except Exception as ex:
+        verbose(f"Cannot estimate the export size of {vm_name} : {ex}", level=logging.WARNING)
+    return size
+
+
+def get_section_retention():
+    """
+    Return:
+        Policy : the retention policy of the section (max_backups, keep_daily, keep_weekly and keep_monthly)
+    """
+    return retention.Policy(
+        int(config.get(section, "max_backups", fallback=DEFAULT_MAX_BACKUPS)),
+        int(config.get(section, "keep_daily", fallback=DEFAULT_KEEP_DAILY)),
+        int(config.get(section, "keep_weekly", fallback=DEFAULT_KEEP_WEEKLY)),
+        int(config.get(section, "keep_monthly", fallback=DEFAULT_KEEP_MONTHLY)),
+    )
 
 
-def get_vm_max_backups(vm_parm):
-    # get max_backups from optional vm-export=VM-NAME:MAX-BACKUP override
-    # NOTE - if not present then return config['max_backups']
-    data = vm_parm.split(":")
+def get_vm_retention(vm_parm):
+    # get the retention from optional vm-export=VM-NAME:MAX-BACKUP[/DAILY/WEEKLY/MONTHLY] override
+    # NOTE - if not present then return the section retention
     try:
-        res = int(data[1])
-    except (IndexError, ValueError):
-        int(config.get(section, "max_backups", fallback=DEFAULT_MAX_BACKUPS))
-        res = int(config.get(section, "max_backups", fallback=DEFAULT_MAX_BACKUPS))
+        return retention.parse_policy(parse_definition(vm_parm)[1], get_section_retention())
+    except ValueError:
+        return get_section_retention()
+
 
-    return res if res > 0 else int(config.get(section, "max_backups", fallback=DEFAULT_MAX_BACKUPS))
+def format_policy(policy):
+    return f"last {policy.last}, daily {policy.daily}, weekly {policy.weekly}, monthly {policy.monthly}"
 
 
 def is_vm_backups_valid(vm_parm):
     """
-    Verify that the VM name is valid in the format : <name>:<MaxBackups>
-    where MaxBackups is integer and > 0
+    Verify that the VM name is valid in the format : <name>:<MaxBackups> (or
+    <property>:<value>:<MaxBackups>) where MaxBackups is integer and > 0, or
+    the retention tiers <MaxBackups>/<Daily>/<Weekly>/<Monthly>
 
     Args:
         vm_parm (str):  the vm name from configuration
@@ -547,10 +1443,8 @@ def is_vm_backups_valid(vm_parm):
     Return:
         bool : True if the full name is valid, False otherwise
     """
-    data = vm_parm.split(":")
     try:
-        res = int(data[1]) > 0
-    except IndexError:
+        retention.parse_policy(parse_definition(vm_parm)[1], retention.Policy(1, 0, 0, 0))
         res = True
     except ValueError:
         res = False
@@ -565,32 +1459,91 @@ def get_vm_name(vm_parm):
 
 def verify_vm_name(tmp_vm_name):
     debug(f"Verify {tmp_vm_name}")
-    vm = session.xenapi.VM.get_by_name_label(tmp_vm_name)
-    vmref = [x for x in session.xenapi.VM.get_by_name_label(tmp_vm_name) if not session.xenapi.VM.get_is_a_snapshot(x)]
+    vmref = get_inventory().vms_by_name(tmp_vm_name)
     debug(f"VM refs of {tmp_vm_name} are : {vmref}")
     if len(vmref) > 1:
         verbose(f"duplicate VM name found: {tmp_vm_name} | {vmref}", level=logging.ERROR)
         return f"ERROR more than one vm with the name {tmp_vm_name}"
-    elif len(vm) == 0:
+    elif len(vmref) == 0:
         return f"ERROR no machines found with the name {tmp_vm_name}"
-    return vm[0]
+    return vmref[0]
+
+
+def get_inventory():
+    """
+    Return:
+        Inventory : the inventory of the pool objects, loaded on the first call (from the cache and
+                    the events since the last run, or in bulk)
+    """
+    global inventory
+    with inventory_lock:
+        if inventory is None:
+            inventory = load_inventory(
+                xapi, get_inventory_cache_file(), pool=config.get(section, "xen_server", fallback=DEFAULT_XENSERVER)
+            )
+        return inventory
+
+
+def get_inventory_cache_file():
+    """
+    Return:
+        str : the path of the inventory cache (next to the status log, if not configured), "" for no cache
+    """
+    status_log = config.get(section, "status_log", fallback=DEFAULT_STATUS_LOG)
+    default = os.path.join(os.path.dirname(status_log), DEFAULT_INVENTORY_CACHE)
+    return config.get(section, "inventory_cache", fallback=default)
+
+
+def get_record(class_name, ref):
+    """
+    Get the record of a pool object, from the inventory (the objects that were
+    created after the inventory was loaded are read from the XenAPI)
+
+    Args:
+        class_name (str): the XenAPI class name (VM / VBD / VDI / SR / VIF / network)
+        ref (str): the object reference
+
+    Return:
+        dict : the object record
+    """
+    record = get_inventory().get(class_name, ref)
+    if record is None:
+        return getattr(xapi, class_name).get_record(ref)
+    return record._asdict()
 
 
 def gather_vm_meta(vm_object, tmp_full_backup_dir):
-    global vm_uuid
-    global xvda_uuid
-    global xvda_name_label
+    """
+    Export the VM metadata into the backup directory
+
+    Args:
+        vm_object (str): the VM reference
+        tmp_full_backup_dir (str): the backup directory
+
+    Return:
+        str, dict : empty string or warning-message, and the vm metadata (vm_uuid, xvda_uuid, xvda_name_label)
+    """
     vm_uuid = ""
     xvda_uuid = ""
     xvda_name_label = ""
     tmp_error = ""
 
-    vm_record = session.xenapi.VM.get_record(vm_object)
+    vm_record = get_record("VM", vm_object)
     vm_uuid = vm_record["uuid"]
 
     verbose("Exporting VM metadata XML info")
     command = f"vm-export metadata=true uuid={vm_uuid} filename={tmp_full_backup_dir}/vmm.tar"
-    if cmd.run_xe(command, out_format="rc") != 0:
+    if not is_posix_target():
+        # the host cannot write into the object storage, stream the metadata tar from XAPI
+        try:
+            exporter = HttpExporter(cmd.host(), session_ref)
+            exporter.export_metadata(vm_uuid, [target.writer(f"{tmp_full_backup_dir}/vmm.tar")])
+            debug(f"Metadata was exported into {tmp_full_backup_dir}/vmm.tar")
+        except (OSError, http.client.HTTPException, ExportError) as ex:
+            verbose(f"Cannot export metadata : {ex}", level=logging.WARNING)
+        finally:
+            target.path_changed(f"{tmp_full_backup_dir}/vmm.tar")
+    elif cmd.run_xe(command, out_format="rc") != 0:
         verbose(f"Cannot export metadata : {command}", level=logging.WARNING)
         # this_status = "warning"
         # non-fatal - finish processing for this vm
@@ -616,11 +1569,12 @@ def gather_vm_meta(vm_object, tmp_full_backup_dir):
     title("vm-export metadata end")
 
     verbose("Writing disk info")
+    meta_files = dict()  # all the metadata files, written in one batch
     vbd_cnt = 0
     debug(f"list of VDBs is : {vm_record['VBDs']}")
     for vbd in vm_record["VBDs"]:
         verbose(f"vbd: {vbd}")
-        vbd_record = session.xenapi.VBD.get_record(vbd)
+        vbd_record = get_record("VBD", vbd)
         # For each vbd, find out if it's a disk
         if vbd_record["type"].lower() != "disk":
             continue
@@ -634,17 +1588,11 @@ def gather_vm_meta(vm_object, tmp_full_backup_dir):
             vbd_cnt += 1
             vbd_record_device = vbd_cnt
 
-        vdi_record = session.xenapi.VDI.get_record(vbd_record["VDI"])
+        vdi_record = get_record("VDI", vbd_record["VDI"])
         verbose(f"disk: {vdi_record['name_label']} - begin")
 
         # now write out the vbd info.
         device_path = f"{tmp_full_backup_dir}/DISK-{vbd_record_device}"
-        debug(f"Try to create {device_path}")
-        if cmd.run_remote(f"mkdir -p {device_path}", out_format="rc") == 0:
-            debug(f" {device_path} created !")
-        else:
-            debug(f" {device_path} didn't created !")
-
         vbd_file = f"{device_path}/vbd.cfg"
         vdi_file = f"{device_path}/vdi.cfg"
 
@@ -652,17 +1600,17 @@ def gather_vm_meta(vm_object, tmp_full_backup_dir):
         for key in ["userdevice", "bootable", "mode", "type", "unpluggable", "empty"]:
             vbd_output.append(f"{key}={vbd_record[key]}")
         vbd_output.append(f"orig_uuid={vbd_record['uuid']}")
-        cmd.write_to_file(filename=vbd_file, data=vbd_output)
+        meta_files[vbd_file] = vbd_output
 
         # now write out the vdi info.
         vdi_output = list()
         for key in ["name_label", "name_description", "virtual_size", "type", "sharable", "read_only"]:
             vdi_output.append(f"{key}={vdi_record[key]}")
 
-        sr_uuid = session.xenapi.SR.get_record(vdi_record["SR"])["uuid"]
-        vdi_output.append("orig_uuid={vdi_record['uuid']}")
+        sr_uuid = get_record("SR", vdi_record["SR"])["uuid"]
+        vdi_output.append(f"orig_uuid={vdi_record['uuid']}")
         vdi_output.append(f"orig_sr_uuid={sr_uuid}")
-        cmd.write_to_file(filename=vdi_file, data=vdi_output)
+        meta_files[vdi_file] = vdi_output
 
         # other_config and qos stuff is not backed up
         if vbd_record_device == "xvda":
@@ -672,23 +1620,23 @@ def gather_vm_meta(vm_object, tmp_full_backup_dir):
     # Write metadata files for vifs.  These are put in VIFs directory
     verbose("Writing VIF info")
     for vif in vm_record["VIFs"]:
-        vif_record = session.xenapi.VIF.get_record(vif)
+        vif_record = get_record("VIF", vif)
         verbose(f"Writing VIF: {vif_record['device']}")
         device_path = f"{tmp_full_backup_dir}/VIFs"
-        debug(f"Try to create {device_path}")
-        if cmd.run_remote(f"mkdir -p {device_path}", out_format="rc") == 0:
-            debug(f" {device_path} created !")
-        else:
-            debug(f" {device_path} didn't created !")
         vif_file = f"{device_path}/vif-{vif_record['device']}vbd.cfg"
-        network_name = session.xenapi.network.get_record(vif_record["network"])["name_label"]
+        network_name = get_record("network", vif_record["network"])["name_label"]
         vif_output = list()
         for key in ["device", "MTU", "MAC", "other_config", "uuid"]:
             vif_output.append(f"{key}={vif_record[key]}")
         vif_output.append(f"network_name_label={network_name}")
-        cmd.write_to_file(filename=vif_file, data=vif_output)
+        meta_files[vif_file] = vif_output
+
+    debug(f"Writing {len(meta_files)} metadata file(s)")
+    failed = target.write_files(meta_files)
+    if failed:
+        tmp_error += f"failed to write {failed} metadata file(s) "
 
-    return tmp_error
+    return tmp_error, {"vm_uuid": vm_uuid, "xvda_uuid": xvda_uuid, "xvda_name_label": xvda_name_label}
 
 
 def final_cleanup(
@@ -696,52 +1644,63 @@ def final_cleanup(
     tmp_backup_file_size,
     tmp_full_backup_dir,
     tmp_vm_backup_dir,
-    tmp_vm_max_backups,
+    tmp_vm_retention,
 ):
     # mark this a successful backup, note: this will 'touch' a file named 'success'
     # if backup size is greater than 60G, then nfs server side compression occurs
-    if int(tmp_backup_file_size) > 60:
+    # (unless the backup is already compressed by the parallel compression)
+    if get_compression() is None and int(tmp_backup_file_size) > 60:
         verbose(f"*** LARGE FILE > 60G: {tmp_full_path_backup_file} : {tmp_backup_file_size}G")
         # forced compression via background gzip (requires nfs server side script)
-        cmd.run_remote(f"touch {tmp_full_backup_dir}/success_compress")
+        target.path_exists(f"{tmp_full_backup_dir}/success_compress")
         verbose(f"*** success_compress: {tmp_full_path_backup_file} : {tmp_backup_file_size}G")
     else:
-        cmd.run_remote(f"touch {tmp_full_backup_dir}/success")
+        target.path_exists(f"{tmp_full_backup_dir}/success")
         verbose(f"*** success: {tmp_full_path_backup_file} : {tmp_backup_file_size}G")
 
-    # Remove the oldest if more than tmp_vm_max_backups
-    dir_to_remove = get_dir_to_remove(tmp_vm_backup_dir, tmp_vm_max_backups)
-    while dir_to_remove:
-        verbose(f"Deleting oldest backup {tmp_vm_backup_dir}/{dir_to_remove} ")
-        # remove dir - if throw exception then stop processing
-        cmd.run_remote(f" rm -rf {tmp_vm_backup_dir}/{dir_to_remove}")
-        dir_to_remove = get_dir_to_remove(tmp_vm_backup_dir, tmp_vm_max_backups)
+    # Remove the backups that the retention policy does not keep
+    remove_backup_dirs(tmp_vm_backup_dir, get_dirs_to_remove(tmp_vm_backup_dir, tmp_vm_retention))
 
 
-def pre_cleanup(tmp_vm_backup_dir, tmp_vm_max_backups):
+def pre_cleanup(tmp_vm_backup_dir, tmp_vm_retention):
     """
     Run a cleanup in the backup directory, by deleting the oldest backup and
-    leave only (max_backup -1) backups.
+    leave only (max_backup -1) last backups (and the daily / weekly / monthly
+    backups of the retention policy).
 
     Args:
         tmp_vm_backup_dir (str): the path of the backups
-        tmp_vm_max_backups (int): the number of maximum backup that can saved
+        tmp_vm_retention (Policy): the retention policy of the backups
     """
     debug(f" ==== tmp_vm_backup_dir: {tmp_vm_backup_dir}")
-    debug(f" ==== tmp_vm_max_backups: {tmp_vm_max_backups}")
+    debug(f" ==== tmp_vm_retention: {tmp_vm_retention}")
     verbose(f"success identifying directory : {tmp_vm_backup_dir}")
-    # Remove the oldest if more than tmp_vm_max_backups -1
-    pre_vm_max_backups = tmp_vm_max_backups - 1
+    # Remove the oldest if more than max_backups -1
+    pre_vm_max_backups = tmp_vm_retention.last - 1
     verbose(f"pre_VM_max_backups: {pre_vm_max_backups} ")
     if pre_vm_max_backups < 1:
         verbose(f"No pre_cleanup needed for {tmp_vm_backup_dir} ")
     else:
-        dir_to_remove = get_dir_to_remove(tmp_vm_backup_dir, tmp_vm_max_backups)
-        while dir_to_remove:
-            verbose(f"Deleting oldest backup {tmp_vm_backup_dir}/{dir_to_remove}")
-            # remove dir - if throw exception then stop processing
-            cmd.path_delete(f"{tmp_vm_backup_dir}/{dir_to_remove}")
-            dir_to_remove = get_dir_to_remove(tmp_vm_backup_dir, tmp_vm_max_backups)
+        remove_backup_dirs(
+            tmp_vm_backup_dir, get_dirs_to_remove(tmp_vm_backup_dir, tmp_vm_retention._replace(last=pre_vm_max_backups))
+        )
+
+
+def remove_backup_dirs(tmp_vm_backup_dir, dirs_to_remove):
+    """
+    Delete backup directories, all in one batch.
+
+    Args:
+        tmp_vm_backup_dir (str): the path of the backups
+        dirs_to_remove (list): the names of the backup directories to delete
+    """
+    if not dirs_to_remove:
+        return
+    for dir_to_remove in dirs_to_remove:
+        verbose(f"Deleting oldest backup {tmp_vm_backup_dir}/{dir_to_remove}")
+    release_backup_dirs(tmp_vm_backup_dir, dirs_to_remove)
+    if target.path_delete(*[f"{tmp_vm_backup_dir}/{name}" for name in dirs_to_remove]) != 0:
+        verbose(f"Failed to delete old backups from {tmp_vm_backup_dir}", level=logging.WARNING)
 
 
 # cleanup old unsuccessful backup and create new full_backup_dir
@@ -752,15 +1711,18 @@ def process_backup_dir(tmp_vm_backup_dir):
 
     Args:
         tmp_vm_backup_dir (str):
-    :return:
+
+    Return:
+        str : the full path of the backup directory, None if it cannot be created
     """
     # if last backup was not successful, then delete it
     verbose(f"Check for last ** Unsuccessful ** backup: {tmp_vm_backup_dir}")
     dir_not_success = get_last_backup_dir_that_failed(tmp_vm_backup_dir)
     if dir_not_success:
         verbose(f"Delete last ** Unsuccessful ** backup {tmp_vm_backup_dir}/{dir_not_success}")
+        release_backup_dirs(tmp_vm_backup_dir, [dir_not_success])
         # remove last unsuccessful backup  - if throw exception then stop processing
-        if cmd.run_remote(f"rm -rf {tmp_vm_backup_dir}/{dir_not_success}", out_format="rc") == 0:
+        if target.path_delete(f"{tmp_vm_backup_dir}/{dir_not_success}") == 0:
             verbose(f"The directory {tmp_vm_backup_dir}/{dir_not_success} was deleted successfully")
         else:
             verbose(f"Failed to delete {tmp_vm_backup_dir}/{dir_not_success} !", level=logging.WARNING)
@@ -780,7 +1742,7 @@ def create_full_backup_dir(vm_base_path):
         vm_base_path (str): the base path for the backup directory
 
     Return:
-        str : the full path of the backup directory
+        str : the full path of the backup directory, None if it cannot be created
     """
     # Check that directory exists
 
@@ -788,30 +1750,33 @@ def create_full_backup_dir(vm_base_path):
     verbose(f"new backup_dir: {tmp_backup_dir}")
 
     debug(f"Make sure that the directory {tmp_backup_dir} exist.")
-    if cmd.run_remote(f"mkdir -p {tmp_backup_dir}", out_format="rc") != 0:
-        verbose(f"Cannot create directory {tmp_backup_dir}")
-        sys.exit(1)
+    if target.mkdir(tmp_backup_dir) != 0:
+        verbose(f"Cannot create directory {tmp_backup_dir}", level=logging.ERROR)
+        return None
     else:
         debug(f"The directory {tmp_backup_dir} created successfully")
     return tmp_backup_dir
 
 
-def get_dir_to_remove(path, numbackups):
+def get_dirs_to_remove(path, policy):
     """
-    Find the oldest backup and select for deletion
+    Select the backups that the retention policy does not keep, from one
+    listing of the backups (all the delete set is computed in memory)
 
     Args:
         path (str): path of the backups
-        numbackups (int): number of maximum backups to save
+        policy (Policy): the retention policy
 
     Return:
-        str / bool : the path of the backup to delete, otherwise False
+        list : the names of the backups to delete (oldest first), empty list if none
     """
-    dirs = cmd.dir_list(path)
-    if len(dirs) > numbackups and len(dirs) > 1:
-        return dirs[0]
-    else:
-        return False
+    dirs, marked = target.backup_dir_state(path)
+    # never remove a backup that the kept (delta) backups depend on
+    states = get_cbt_states(path, dirs) if is_incremental() else None
+    to_remove, dependencies = retention.plan(dirs, marked, policy, states)
+    for name in sorted(dependencies):
+        verbose(f"Keeping {path}/{name} - newer incremental backups depend on it")
+    return to_remove
 
 
 def get_last_backup_dir_that_failed(path):
@@ -826,20 +1791,17 @@ def get_last_backup_dir_that_failed(path):
     """
     # if the last backup dir was not success, then return that backup dir
     debug(f"Check if {path} exists.")
-    dirs = cmd.dir_list(path)
+    dirs, success_dirs = target.backup_dir_state(path)
     verbose(f"All backup directories are : {dirs}")
     if len(dirs) < 1:
         return False
     # note: dirs[-1] is the last entry
     debug(f"The latest backup dir is: {dirs[-1]}")
-    last_backup_path = f"{path}/{dirs[-1]}/success*"
-    debug(f"Looking for file(s) : {last_backup_path}")
-    res = cmd.dir_list(last_backup_path)
-    if len(res) == 0:
+    if dirs[-1] not in success_dirs:
         debug(f"no success file(s) at {dirs[-1]}")
         return dirs[-1]
     else:
-        debug(f"No failed backup exists : {res}")
+        debug(f"No failed backup exists : {success_dirs}")
         return False
 
 
@@ -854,11 +1816,10 @@ def check_all_backups_success(path):
         bool : True if the last backup completed successfully otherwise False
     """
     # expect at least one backup dir, and all should be successful
-    dirs = cmd.dir_list(path)
+    dirs, success_dirs = target.backup_dir_state(path)
     if len(dirs) == 0:
         return False
-    res = cmd.dir_list(f"{path}/{dirs[-1]}/success*")
-    if len(res) == 0:
+    if dirs[-1] not in success_dirs:
         verbose(f"Directory not successful - {dirs[-1]}", level=logging.WARNING)
         return False
     return True
@@ -883,7 +1844,7 @@ def backup_pool_metadata(svr_name):
         config.get(section, "backup_dir", fallback=DEFAULT_BACKUP_DIR),
         "METADATA_" + svr_name,
     )
-    if cmd.run_remote(f"mkdir -p {metadata_base}", out_format="rc") != 0:
+    if cmd.mkdir(metadata_base) != 0:
         verbose(f"creating directory {metadata_base} Failed", level=logging.ERROR)
         return False
 
@@ -907,12 +1868,15 @@ def df_snapshots(log_msg, min_capacity=1024):
         log_msg (str): message string to display before the command output
         min_capacity (int): the minimum capacity that need to be.
     """
-    command = f"df -T {config.get(section, 'backup_dir', fallback=DEFAULT_BACKUP_DIR)}"
-    verbose(f"{log_msg} : {command}")
-    result = cmd.run_remote(command, out_format="list")
-    for line in result:
-        verbose(line)
-    avail = int(result[-1].split()[-3]) / (1024 * 1024)
+    backup_dir = config.get(section, "backup_dir", fallback=DEFAULT_BACKUP_DIR)
+    verbose(f"{log_msg} : {backup_dir}")
+    result = target.disk_free(backup_dir)
+    if result is None:
+        verbose(f"The {target.name} target has no capacity limit")
+        return
+    for key, value in result.items():
+        verbose(f"  {key} : {int(value / (1024 * 1024 * 1024))} GB")
+    avail = result.get("avail", 0) / (1024 * 1024 * 1024)
     verbose(f"The Available storage for backup is : {int(avail)} GB")
     if avail < min_capacity:
         verbose(f"There is not enough capacity < {str(min_capacity/1024)} T")
@@ -998,38 +1962,6 @@ def is_xe_master():
     return False
 
 
-def check_vm_in_server(full_name, vm):
-    """
-    Compare the configuration VM name (can be REGEX) with part of max_backups
-    to VM name from the server.
-    if it matches, return the new name with the max_backup and true, otherwise
-    it returns '' and false.
-
-    Args:
-        full_name (str): The VM name from configuration (can be REGEX)
-                         include max_backup
-        vm (str): The VM name from the server (xen-server)
-
-    Return:
-        str, bool : The name, and true if found
-    """
-    found_match = False
-    new_value = ""
-    values = full_name.split(":")
-    vm_name = values[0]
-    vm_backups_part = values[1] if len(values) > 1 else ""
-    normal_name = re.match("^[\w\s\-\_]+$", vm_name) is not None
-    if not normal_name and not re.compile(vm_name):
-        verbose(f"invalid regex: {key} = {vm_name}", level=logging.ERROR)
-    if (normal_name and vm_name == vm) or (not normal_name and re.match(vm_name, vm)):
-        if vm_backups_part == "":
-            new_value = vm
-        else:
-            new_value = f"{vm}:{vm_backups_part}"
-        found_match = True
-    return new_value, found_match
-
-
 def is_config_valid():
     """
     Verify that all configuration is valid
@@ -1037,6 +1969,7 @@ def is_config_valid():
     Return:
         bool : True if configuration is valid, else False
     """
+    global all_vms
     global vdi_export
     global backup_vms
     for key in ["pool_db_backup", "max_backups"]:
@@ -1061,6 +1994,15 @@ def is_config_valid():
         )
         return False
 
+    for key, default in [
+        ("keep_daily", DEFAULT_KEEP_DAILY),
+        ("keep_weekly", DEFAULT_KEEP_WEEKLY),
+        ("keep_monthly", DEFAULT_KEEP_MONTHLY),
+    ]:
+        if not config.get(section, key, fallback=str(default)).isdigit():
+            verbose(f"Config {key} non-numeric -> {config.get(section, key)}", level=logging.ERROR)
+            return False
+
     if config.get(section, "vdi_export_format", fallback="") not in ["raw", "vhd"]:
         verbose(
             f"Config vdi_export_format invalid -> {config.get(section, 'vdi_export_format', fallback='')}",
@@ -1068,7 +2010,94 @@ def is_config_valid():
         )
         return False
 
-    if cmd.path_exists(config.get(section, "backup_dir", fallback="")) != 0:
+    if is_incremental() and config.get(section, "export_method", fallback=DEFAULT_EXPORT_METHOD) != "http":
+        verbose("Config incremental needs export_method = http", level=logging.ERROR)
+        return False
+
+    compression = config.get(section, "compression", fallback=DEFAULT_COMPRESSION)
+    if is_dedup() and (compression != "none" or is_incremental()):
+        verbose("Config dedup cannot be used with compression or incremental", level=logging.ERROR)
+        return False
+    # the xe exports are written by the host, the backup_dir path may not be the same storage here
+    http_only = [
+        key
+        for key, enabled in [("compression", compression != "none"), ("dedup", is_dedup()), ("sparse", is_sparse())]
+        if enabled
+    ]
+    if http_only and config.get(section, "export_method", fallback=DEFAULT_EXPORT_METHOD) != "http":
+        verbose(f"Config {', '.join(http_only)} needs export_method = http", level=logging.ERROR)
+        return False
+
+    throttle_settings = get_throttle_settings(config)
+    try:
+        for key, value in throttle_settings.items():
+            if key != "throttle_adaptive" and float(value) < 0:
+                raise ValueError(f"{key} = {value}")
+    except ValueError as ex:
+        verbose(f"Config throttle invalid -> {ex}", level=logging.ERROR)
+        return False
+    if config.get(section, "export_method", fallback=DEFAULT_EXPORT_METHOD) != "http" and (
+        any(float(value) > 0 for key, value in throttle_settings.items() if key != "throttle_adaptive")
+        or throttle_settings["throttle_adaptive"] == "true"
+    ):
+        verbose("Config throttle is applied only with export_method = http", level=logging.WARNING)
+
+    if config.get(section, "integrity_algorithm", fallback=DEFAULT_INTEGRITY_ALGORITHM) not in integrity.ALGORITHMS:
+        verbose(
+            f"Config integrity_algorithm invalid -> {config.get(section, 'integrity_algorithm')}",
+            level=logging.ERROR,
+        )
+        return False
+
+    if compression != "none":
+        try:
+            check_codec(compression)
+        except ValueError as ex:
+            verbose(f"Config compression invalid -> {ex}", level=logging.ERROR)
+            return False
+
+    backup_target = config.get(section, "backup_target", fallback=DEFAULT_BACKUP_TARGET)
+    if backup_target not in ["posix", "s3"]:
+        verbose(f"Config backup_target invalid -> {backup_target}", level=logging.ERROR)
+        return False
+    if backup_target == "s3":
+        if config.get(section, "export_method", fallback=DEFAULT_EXPORT_METHOD) != "http":
+            verbose("Config backup_target = s3 needs export_method = http", level=logging.ERROR)
+            return False
+        if is_sparse() or is_dedup() or is_incremental() or is_resumable():
+            verbose(
+                "Config backup_target = s3 cannot be used with sparse, dedup, incremental or resume_window",
+                level=logging.ERROR,
+            )
+            return False
+        if int(config.get(section, "pool_db_backup", fallback=DEFAULT_POOL_DB_BACKUP)):
+            verbose("Config backup_target = s3 cannot be used with pool_db_backup", level=logging.ERROR)
+            return False
+        try:
+            s3_settings = get_s3_settings()
+        except ValueError as ex:
+            verbose(f"Config s3 invalid -> {ex}", level=logging.ERROR)
+            return False
+        missing = [key for key in ["endpoint", "bucket", "access_key", "secret_key"] if not s3_settings[key]]
+        if missing or s3_settings["part_size"] < 5 * 1024 * 1024 or s3_settings["in_flight"] < 1:
+            verbose(
+                f"Config s3 invalid -> missing {missing}, or s3_part_size < 5, or s3_upload_concurrency < 1",
+                level=logging.ERROR,
+            )
+            return False
+
+    write_strategy = config.get(section, "write_strategy", fallback=DEFAULT_WRITE_STRATEGY)
+    if write_strategy not in ["default"] + WRITE_STRATEGIES:
+        verbose(f"Config write_strategy invalid -> {write_strategy}", level=logging.ERROR)
+        return False
+    if not config.get(section, "write_buffer_size", fallback=str(DEFAULT_WRITE_BUFFER_SIZE)).isdigit():
+        verbose(
+            f"Config write_buffer_size non-numeric -> {config.get(section, 'write_buffer_size')}",
+            level=logging.ERROR,
+        )
+        return False
+
+    if backup_target == "posix" and cmd.exists(config.get(section, "backup_dir", fallback="")) != 0:
         verbose(
             f"Config backup_dir does not exist -> {config.get(section, 'backup_dir', fallback='')}",
             level=logging.ERROR,
@@ -1081,17 +2110,23 @@ def is_config_valid():
             verbose(f"vm_max_backup is invalid - {vm_parm}", level=logging.ERROR)
             tmp_return = False
 
-    # Remove all excluded vms from the all vm's list
-    for inc_vm in config[section]["exclude"].split(","):
-        for vm in all_vms:
-            new_value, found_match = check_vm_in_server(inc_vm, vm)
-            if found_match:
-                all_vms.remove(new_value)
-                verbose(f"The vm {new_value} will be excluded !")
-
-    # Verify that no duplicat name exists
-    vdi_export = select_vms(vdi_export)
-    backup_vms = select_vms(backup_vms)
+    try:
+        # Remove all excluded vms from the all vm's list
+        excluded = Selector(config.get(section, "exclude", fallback="").split(","), get_inventory()).select(all_vms)
+        for vm in excluded:
+            verbose(f"The vm {vm} will be excluded !")
+        all_vms = [vm for vm in all_vms if vm not in excluded]
+
+        # vdi-export take precedence over vm-export
+        vdi_export = select_vms(vdi_export, all_vms)
+        vdi_names = {get_vm_name(vm_parm) for vm_parm in vdi_export}
+        backup_vms = select_vms(backup_vms, [vm for vm in all_vms if vm not in vdi_names])
+    except re.error as ex:
+        verbose(f"Config invalid regex -> {ex.pattern} : {ex}", level=logging.ERROR)
+        return False
+    except ValueError as ex:
+        verbose(f"Config invalid selection -> {ex}", level=logging.ERROR)
+        return False
     return tmp_return
 
 
@@ -1103,14 +2138,13 @@ def get_all_vms():
         list
     """
     global all_vms
-    command = "vm-list is-control-domain=false is-a-snapshot=false params=name-label --minimal"
-    all_vms = cmd.run_xe(command, out_format="string").split(",")
+    all_vms = get_inventory().vm_names()
 
 
 def write_status_log_msg(op, server, script=f"{BASE_NAME}.py", status=""):
     date = time.strftime("%Y/%m/%d %H:%M:%S")
     msg = f"{date},{script},{server},{op} {status}\n"
-    with open(config.get(section, "status_log", fallback=DEFAULT_STATUS_LOG), "a") as fh:
+    with status_log_lock, open(config.get(section, "status_log", fallback=DEFAULT_STATUS_LOG), "a") as fh:
         fh.write(msg)
     debug(msg.strip())
 
@@ -1178,9 +2212,66 @@ if __name__ == "__main__":
 
     cmd.user(config.get(section, "xen_user", fallback=DEFAULT_USER))
     cmd.host(config.get(section, "xen_server", fallback=DEFAULT_XENSERVER))
+    if config.get(section, "ssh_multiplex", fallback=DEFAULT_SSH_MULTIPLEX) == "true":
+        cmd.pool(
+            SshPool(
+                size=config.get(section, "ssh_pool_size", fallback=DEFAULT_SSH_POOL_SIZE),
+                persist=config.get(section, "ssh_control_persist", fallback=DEFAULT_SSH_CONTROL_PERSIST),
+            )
+        )
+    if int(config.get(section, "cache_ttl", fallback=DEFAULT_CACHE_TTL)) > 0:
+        cache = TTLCache(default_ttl=int(config.get(section, "cache_ttl", fallback=DEFAULT_CACHE_TTL)))
+        cmd.cache(cache)
+    if config.get(section, "remote_agent", fallback=DEFAULT_REMOTE_AGENT) == "true":
+        cmd.start_agent(python=config.get(section, "agent_python", fallback=DEFAULT_AGENT_PYTHON))
 
     debug(f"Xen-server is {cmd.host()}, and going to connect with user {cmd.user()}")
 
+    # acquire a xapi session by logging in
+    debug(f"Try to open an API session to {config.get(section, 'xen_server', fallback=DEFAULT_XENSERVER)}")
+    username = config.get(section, "xen_user", fallback=DEFAULT_USER)
+    xapi_url = f"http://{config.get(section, 'xen_server', fallback=DEFAULT_XENSERVER)}/"
+    try:
+        session = XenAPI.Session(xapi_url)
+        debug(f"session is: {session}")
+        debug(f"Try to open session with User:{username} , Password:{password}")
+        session.login_with_password(username, password)
+        hosts = session.xenapi.host.get_all()
+        debug(f"All hosts are : {hosts}")
+    except XenAPI.Failure as e:
+        verbose(f"[{e}] ===>")
+        if e.details[0] == "HOST_IS_SLAVE":
+            xapi_url = "http://" + e.details[1]
+            session = XenAPI.Session(xapi_url)
+            session.xenapi.login_with_password(username, password)
+            hosts = session.xenapi.host.get_all()
+        else:
+            verbose(f"XenAPI authentication error [{e}]", level=logging.ERROR)
+            sys.exit(1)
+
+    # the backup workers share a pool of XenAPI sessions, a session for each worker that call XenAPI
+    def login():
+        worker_session = XenAPI.Session(xapi_url)
+        worker_session.xenapi.login_with_password(username, password)
+        return worker_session.xenapi
+
+    session_ref = session._session
+    xapi_pool = XenAPIPool(
+        session.xenapi,
+        login=login,
+        size=sum(
+            int(config.get(section, key, fallback=default))
+            for key, default in [
+                ("prepare_workers", DEFAULT_PREPARE_WORKERS),
+                ("max_parallel_exports", DEFAULT_MAX_PARALLEL_EXPORTS),
+                ("cleanup_workers", DEFAULT_CLEANUP_WORKERS),
+            ]
+        ),
+    )
+    xapi = xapi_pool
+    if cache is not None:
+        xapi = CachedXenAPI(xapi, cache, ttls=XENAPI_CACHE_TTL)
+
     get_all_vms()
 
     debug(f"The list of all VMs in the Xen-Server: ({cmd.host()}) are : {all_vms}")
@@ -1202,31 +2293,34 @@ if __name__ == "__main__":
         verbose("No VMs loaded", level=logging.ERROR)
         sys.exit(1)
 
-    # acquire a xapi session by logging in
-    debug(f"Try to open an API session to {config.get(section, 'xen_server', fallback=DEFAULT_XENSERVER)}")
-    username = config.get(section, "xen_user", fallback=DEFAULT_USER)
-    try:
-        session = XenAPI.Session(f"http://{config.get(section, 'xen_server', fallback=DEFAULT_XENSERVER)}/")
-        debug(f"session is: {session}")
-        debug(f"Try to open session with User:{username} , Password:{password}")
-        session.login_with_password(username, password)
-        hosts = session.xenapi.host.get_all()
-        debug(f"All hosts are : {hosts}")
-    except XenAPI.Failure as e:
-        verbose(f"[{e}] ===>")
-        if e.details[0] == "HOST_IS_SLAVE":
-            session = XenAPI.Session("http://" + e.details[1])
-            session.xenapi.login_with_password(username, password)
-            hosts = session.xenapi.host.get_all()
-        else:
-            verbose(f"XenAPI authentication error [{e}]", level=logging.ERROR)
-            sys.exit(1)
+    backend = get_backend(config.get(section, "backend", fallback=DEFAULT_BACKEND), cmd, xapi)
+    debug(f"Using the {backend.name} backend")
+    target = get_target(
+        config.get(section, "backup_target", fallback=DEFAULT_BACKUP_TARGET),
+        cmd,
+        get_s3_settings() if not is_posix_target() else None,
+        get_write_settings(),
+    )
+    debug(f"Using the {target.name} target")
+    dispatcher = HostDispatcher(
+        xapi,
+        cmd,
+        mode=config.get(section, "export_dispatch", fallback=DEFAULT_EXPORT_DISPATCH),
+        host_limit=config.get(section, "host_export_limit", fallback=DEFAULT_HOST_EXPORT_LIMIT),
+    )
+    throttle = Throttle(
+        latency_factor=float(config.get(section, "throttle_latency_factor", fallback=DEFAULT_THROTTLE_LATENCY_FACTOR))
+    )
+    throttle.apply(get_throttle_settings(config))
+    if config.get(section, "throttle_control", fallback="") != "":
+        throttle.watch(config.get(section, "throttle_control"))
+    signal.signal(signal.SIGHUP, reload_throttle)
 
     if preview:
         # check for duplicate names
         verbose("Checking all VMs for duplicate names ...")
         for vm in all_vms:
-            vmref = [x for x in session.xenapi.VM.get_by_name_label(vm) if not session.xenapi.VM.get_is_a_snapshot(x)]
+            vmref = get_inventory().vms_by_name(vm)
             debug(f"All VM refs of {vm} are : {vmref}")
             if len(vmref) > 1:
                 verbose(f"Duplicate VM name found: {vm} | {vmref}", level=logging.ERROR)
@@ -1246,3 +2340,5 @@ if __name__ == "__main__":
         verbose(f"Session EXCEPTION - {sys.exc_info()[0]}", level=logging.ERROR)
         verbose(f"NOTE: see {BASE_NAME} output for details", level=logging.ERROR)
         raise
+    finally:
+        xapi_pool.close()